@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""Checks that events too large for a Kinesis record reach S3 intact through the claim check path.
+
+Runs beats-in, azure-in and the processor with queue.claim_check's settings (see
+src/docker/logstash-in/plugins/logstash/filters/claim_check.rb), and sends:
+
+    beats    ordinary events, and events with a `--oversized-bytes` pad field, which beats-in stages
+             in the bench-staging bucket and the processor fetches back
+    azure    batches of `--azure-records` records, which azure-in splits into messages of at most
+             `--azure-chunk-bytes`, and batches of one record with a `--oversized-bytes` pad field,
+             which are staged
+
+Every event sent is then looked for in S3, with its pad the size it was sent with. With `--baseline`
+the claim check and the Azure split are off, to show what Kinesis rejects without them:
+
+    python3 claim_check.py
+    python3 claim_check.py --oversized-bytes 4000000 --max-record-bytes 500000
+    python3 claim_check.py --baseline
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import re
+import socket
+import sys
+import time
+from datetime import datetime, timezone
+
+import loadgen
+from run import (BUCKETS, RESULTS, aws_clients, compose, create_resources, image_ids, node_stats, pipelines_running,
+                 prepare, wait_for)
+
+STAGING_BUCKET = "bench-staging"
+BEATS_SEQ = re.compile(r"bench_seq=(\d+)")
+# Sequence numbers of the Azure records start here, so they never collide with the beats events'
+AZURE_SEQ_START = 10 ** 7
+
+
+def plugin_stats(service, pipeline_id, plugin_id):
+    """The node stats of one filter, or {} when the pipeline or filter isn't there."""
+    stats = node_stats(service) or {}
+    pipeline = stats.get("pipelines", {}).get(pipeline_id, {})
+    for plugin in pipeline.get("plugins", {}).get("filters", []):
+        if plugin.get("id") == plugin_id:
+            return {k: v for k, v in plugin.items() if k not in ("id", "name")}
+    return {}
+
+
+def send_beats(args, rng):
+    """Sends the beats events; returns {seq: pad bytes} for each."""
+    expected = {}
+    client = loadgen.LumberjackClient("localhost", 5044)
+    for seq in range(args.beats_events + args.oversized_events):
+        event = loadgen.beat_event(rng, seq)
+        if seq >= args.beats_events:
+            event["pad"] = "x" * args.oversized_bytes
+        expected[seq] = len(event.get("pad", ""))
+        client.send([event])
+    return expected
+
+
+def send_azure(args, rng):
+    """Sends the Azure batches as lines to azure-in's stand-in input; returns {seq: pad bytes} for each record."""
+    expected = {}
+    seq = AZURE_SEQ_START
+    with socket.create_connection(("localhost", 5600)) as sock:
+        for _ in range(args.azure_batches):
+            batch = loadgen.azure_batch(rng, seq, args.azure_records)
+            sock.sendall(json.dumps(batch, separators=(",", ":")).encode() + b"\n")
+            expected.update({seq + i: 0 for i in range(args.azure_records)})
+            seq += args.azure_records
+        for _ in range(args.oversized_events):
+            batch = loadgen.azure_batch(rng, seq, 1)
+            batch["records"][0]["pad"] = "x" * args.oversized_bytes
+            sock.sendall(json.dumps(batch, separators=(",", ":")).encode() + b"\n")
+            expected[seq] = args.oversized_bytes
+            seq += 1
+    return expected
+
+
+def read_archived(s3):
+    """Returns {seq: pad bytes} for every benchmark event archived to S3, and the events tagged _claim_check_failure."""
+    archived = {}
+    failures = 0
+    for bucket in BUCKETS:
+        for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket):
+            for obj in page.get("Contents", []):
+                body = s3.get_object(Bucket=bucket, Key=obj["Key"])["Body"].read()
+                for line in gzip.decompress(body).splitlines():
+                    event = json.loads(line)
+                    if "_claim_check_failure" in event.get("tags", []):
+                        failures += 1
+                    record = event.get("event_data")
+                    if isinstance(record, dict) and "benchSeq" in record:
+                        archived[record["benchSeq"]] = len(record.get("pad", ""))
+                        continue
+                    match = BEATS_SEQ.search(event.get("message", ""))
+                    if match:
+                        archived[int(match.group(1))] = len(event.get("pad", ""))
+    return archived, failures
+
+
+def staged_objects(s3):
+    count = 0
+    total = 0
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=STAGING_BUCKET):
+        for obj in page.get("Contents", []):
+            count += 1
+            total += obj["Size"]
+    return {"objects": count, "bytes": total}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--beats-events", type=int, default=200, help="Ordinary beats events")
+    parser.add_argument("--oversized-events", type=int, default=5, help="Oversized beats events, and oversized Azure records")
+    parser.add_argument("--oversized-bytes", type=int, default=1500000, help="Size of each oversized event's pad field")
+    parser.add_argument("--azure-batches", type=int, default=5)
+    parser.add_argument("--azure-records", type=int, default=4000, help="Records per Azure batch, about 350 bytes each")
+    parser.add_argument("--max-record-bytes", type=int, default=1000000, help="queue.claim_check.max_record_bytes")
+    parser.add_argument("--azure-chunk-bytes", type=int, default=524288, help="queue.claim_check.azure_chunk_bytes")
+    parser.add_argument("--baseline", action="store_true", help="Switch the claim check and the Azure split off")
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds to wait for every event to reach S3")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--name", help="Result name, defaults to claim-check or claim-check-baseline")
+    parser.add_argument("--build", action="store_true", help="Rebuild the images before running")
+    parser.add_argument("--keep", action="store_true", help="Leave the containers running afterwards")
+    args = parser.parse_args()
+
+    services = ["beats-in", "azure-in"]
+    prepare({
+        "CLAIM_CHECK_ENABLED": "false" if args.baseline else "true",
+        "CLAIM_CHECK_BUCKET": STAGING_BUCKET,
+        "CLAIM_CHECK_PREFIX": "bench",
+        "CLAIM_CHECK_MAX_BYTES": str(args.max_record_bytes),
+        # Larger than any batch, so none is split
+        "AZURE_CHUNK_BYTES": str(2 ** 31 - 1 if args.baseline else args.azure_chunk_bytes)
+    })
+    rng = random.Random(args.seed)
+
+    compose("down", "-v", "--remove-orphans")
+    try:
+        compose("up", "-d", "localstack", "minio")
+        kinesis, s3 = aws_clients()
+        create_resources(kinesis, s3, 1)
+        s3.create_bucket(Bucket=STAGING_BUCKET)
+        compose("up", "-d", *([] if args.build else ["--no-build"]), *services, "processor")
+        for service in services:
+            wait_for(service, lambda: pipelines_running(service, 1))
+        # The parent, beats, syslog, azure, fallback and config_sync pipelines
+        wait_for("processor", lambda: pipelines_running("processor", 6))
+
+        started = time.time()
+        expected = send_beats(args, rng)
+        expected.update(send_azure(args, rng))
+        sent = time.time() - started
+
+        archived = {}
+        failures = 0
+
+        def all_archived():
+            nonlocal archived, failures
+            archived, failures = read_archived(s3)
+            return all(seq in archived for seq in expected)
+        delivered = wait_for("every event in S3", all_archived, timeout=args.timeout, required=False)
+        plugins = {
+            "beats-in": {
+                "claim_check": plugin_stats("beats-in", "logstash-ingress", "claim_check")
+            },
+            "azure-in": {
+                "azure_chunk": plugin_stats("azure-in", "logstash-ingress", "azure_chunk"),
+                "claim_check": plugin_stats("azure-in", "logstash-ingress", "claim_check")
+            },
+            "processor": {
+                "claim_check": plugin_stats("processor", "parent", "claim_check")
+            }
+        }
+        staged = staged_objects(s3)
+    finally:
+        if not args.keep:
+            compose("down", "-v", "--remove-orphans")
+
+    missing = sorted(seq for seq in expected if seq not in archived)
+    damaged = sorted(seq for seq in expected if seq in archived and archived[seq] != expected[seq])
+    oversized = [seq for seq, pad in expected.items() if pad > 0]
+    result = {
+        "name": args.name or ("claim-check-baseline" if args.baseline else "claim-check"),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "images": image_ids(),
+        "config": {
+            "baseline": args.baseline, "beats_events": args.beats_events, "oversized_events": args.oversized_events,
+            "oversized_bytes": args.oversized_bytes, "azure_batches": args.azure_batches, "azure_records": args.azure_records,
+            "max_record_bytes": args.max_record_bytes, "azure_chunk_bytes": args.azure_chunk_bytes
+        },
+        "send_seconds": round(sent, 1),
+        "delivered": delivered,
+        "events_sent": len(expected),
+        "events_archived": sum(1 for seq in expected if seq in archived),
+        "oversized_sent": len(oversized),
+        "oversized_archived": sum(1 for seq in oversized if seq in archived),
+        "missing_events": len(missing),
+        "missing_sample": missing[:20],
+        "damaged_events": len(damaged),
+        "claim_check_failures": failures,
+        "staged": staged,
+        "plugins": plugins
+    }
+
+    os.makedirs(RESULTS, exist_ok=True)
+    path = os.path.join(RESULTS, f"{result['name']}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps(result, indent=2))
+    print(f"Wrote {path}", file=sys.stderr)
+    if not args.baseline and (missing or damaged or failures):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
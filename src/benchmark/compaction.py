@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Seeds a local minio with an archive of small Logstash objects and compacts it.
+
+Writes `--files` gzip json_lines objects of winlogbeat events for each of `--hosts` hosts in each
+of `--hours` closed hours, laid out like the beats s3 output, then runs the compactor in
+src/docker/compactor against them and checks that every event is in the compacted files.
+
+    docker compose up -d minio
+    python3 compaction.py --hosts 100 --hours 2 --files 30 --events 200 --format parquet --workers 4
+
+Reports objects and bytes before and after, the compactor's throughput, and the peak memory of
+its worker processes.
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import resource
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "docker", "compactor"))
+
+import loadgen
+import pyarrow as pa
+import pyarrow.parquet as pq
+from compactor import CompactorConfig, run, s3_client
+
+MINIO = "http://localhost:9000"
+BUCKET = "bench-compaction"
+
+
+def seed(client, args, now):
+    rng = random.Random(1)
+    seq = 0
+    objects = 0
+    size = 0
+    for hour_offset in range(2, args.hours + 2):
+        hour = (now - timedelta(hours=hour_offset)).replace(minute=0, second=0, microsecond=0)
+        for host in range(args.hosts):
+            prefix = (f"beat=winlogbeat/version=7.6.2/name=WKS{host:05d}/log_name=Security/"
+                      f"year={hour:%Y}/month={hour:%m}/day={hour:%d}/hour={hour:%H}/")
+            for part in range(args.files):
+                lines = []
+                for i in range(args.events):
+                    event = loadgen.beat_event(rng, seq)
+                    event.pop("@metadata")
+                    event["@timestamp"] = (hour + timedelta(seconds=rng.randrange(3600))).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+                    lines.append(json.dumps(event))
+                    seq += 1
+                body = gzip.compress(("\n".join(lines) + "\n").encode())
+                client.put_object(Bucket=BUCKET, Key=f"{prefix}ls.s3.{part:05d}.txt.gz", Body=body)
+                objects += 1
+                size += len(body)
+    return seq, objects, size
+
+
+def count_rows(client):
+    rows = 0
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=BUCKET, Prefix="compacted/"):
+        for item in page.get("Contents", []):
+            key = item["Key"]
+            data = client.get_object(Bucket=BUCKET, Key=key)["Body"].read()
+            if key.endswith(".parquet"):
+                rows += pq.ParquetFile(pa.BufferReader(data)).metadata.num_rows
+            elif key.endswith(".json.zst"):
+                with pa.CompressedInputStream(pa.BufferReader(data), "zstd") as stream:
+                    rows += stream.read().count(b"\n")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hosts", type=int, default=100)
+    parser.add_argument("--hours", type=int, default=2)
+    parser.add_argument("--files", type=int, default=30, help="Objects per host per hour; Logstash uploads one every S3_FILE_MAX_TIME minutes")
+    parser.add_argument("--events", type=int, default=200, help="Events per object")
+    parser.add_argument("--format", choices=["parquet", "json_zstd"], default="parquet")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--row-group-mb", type=float, default=64)
+    parser.add_argument("--endpoint", default=MINIO)
+    args = parser.parse_args()
+
+    # The compactor's worker processes read these too
+    os.environ.update({"AWS_ACCESS_KEY_ID": "bench", "AWS_SECRET_ACCESS_KEY": "benchbench", "AWS_DEFAULT_REGION": "us-east-1"})
+    client = s3_client(args.endpoint)
+    try:
+        client.create_bucket(Bucket=BUCKET)
+    except client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+    for page in client.get_paginator("list_objects_v2").paginate(Bucket=BUCKET):
+        keys = [{"Key": item["Key"]} for item in page.get("Contents", [])]
+        if keys:
+            client.delete_objects(Bucket=BUCKET, Delete={"Objects": keys, "Quiet": True})
+
+    now = datetime.now(timezone.utc)
+    events, objects_in, bytes_in = seed(client, args, now)
+    print(f"Seeded {objects_in} objects, {bytes_in / 2 ** 20:.1f} MiB, {events} events", file=sys.stderr)
+
+    config = CompactorConfig(buckets=[BUCKET], format=args.format, columns=["host.name", "winlog.event_id"], workers=args.workers,
+                             row_group_mb=args.row_group_mb, s3_endpoint=args.endpoint)
+    started = time.monotonic()
+    totals = run(config, now=now)
+    elapsed = time.monotonic() - started
+    rows = count_rows(client)
+
+    result = {
+        "format": args.format,
+        "workers": args.workers,
+        "partitions": totals["partitions"],
+        "objects_in": objects_in,
+        "objects_out": totals["objects_out"],
+        "mib_in": round(bytes_in / 2 ** 20, 1),
+        "mib_out": round(totals["bytes_out"] / 2 ** 20, 1),
+        "events_per_second": round(events / elapsed, 1),
+        "seconds": round(elapsed, 1),
+        # ru_maxrss is in KiB on Linux, and covers the largest single worker
+        "peak_worker_rss_mib": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        "events_in": events,
+        "events_out": rows,
+        "complete": rows == events and totals["failed"] == 0
+    }
+    json.dump(result, sys.stdout, indent=2)
+    print()
+    if not result["complete"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""Measures the per-event CPU cost of Logstash filter snippets.
+
+Each snippet (a file of filter plugins, see filters/) runs in a container of the logstash-out
+image with a generator input, one worker and a null output, once for N events and once for 5N.
+The difference between the two runs is the cost of 4N events without JVM startup and shutdown.
+
+    python3 filter_bench.py filters/beats_metadata_json.conf filters/beats_metadata_copy.conf --events 100000 --rate 10000
+
+A whole pipeline file can be given instead of a snippet, and only its filter section is used.
+By default every event is a winlogbeat event; --corpus replays the lines of a file instead:
+
+    python3 filter_bench.py filters/syslog_generic.conf ../docker/logstash-out/pipelines/20-syslog.conf --corpus corpus/syslog.log --type syslog
+
+The first snippet is the baseline that the others are compared against. Build the image first
+with `docker compose build processor` (or run.py --build), or pass --image. Snippets are read
+from this checkout, but the scripts and patterns they use come from the image.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+import loadgen
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Beats events arrive with the beat's @metadata set; the generator can't set it, so the setup filter does
+PIPELINE = """
+input {
+    generator {
+__GENERATOR__
+    }
+}
+filter {
+    mutate {
+        id => "setup"
+        add_field => {
+            "[@metadata][beat]" => "winlogbeat"
+            "[@metadata][type]" => "_doc"
+            "[@metadata][version]" => "7.6.2"
+        }
+    }
+__FILTERS__
+}
+output {
+    null { }
+}
+"""
+
+
+def sample_event():
+    event = loadgen.beat_event(random.Random(1), 1)
+    event.pop("@metadata")
+    return json.dumps(event, separators=(",", ":"))
+
+
+def quote(value):
+    """Quotes a string for a Logstash config, which has no escapes by default."""
+    if "'" not in value:
+        return f"'{value}'"
+    if '"' not in value:
+        return f'"{value}"'
+    raise ValueError(f"Cannot quote a line with both kinds of quote: {value}")
+
+
+def generator(args, count):
+    """Returns the generator settings for about `count` events, and the number it will generate."""
+    settings = []
+    if args.type:
+        settings.append(f"type => {quote(args.type)}")
+    if args.corpus:
+        # The generator repeats the corpus `count` times
+        with open(args.corpus) as f:
+            lines = [line.rstrip("\n") for line in f if line.strip()]
+        repeats = max(1, count // len(lines))
+        settings.append(f"count => {repeats}")
+        settings.append("lines => [ " + ", ".join(quote(line) for line in lines) + " ]")
+        return "\n".join(" " * 8 + s for s in settings), repeats * len(lines)
+    settings += [f"count => {count}", f"message => {quote(sample_event())}", "codec => json"]
+    return "\n".join(" " * 8 + s for s in settings), count
+
+
+def read_filters(path):
+    """Returns a snippet's filter plugins, or the contents of the filter section of a pipeline file."""
+    with open(path) as f:
+        text = f.read()
+    match = re.search(r"^filter\s*\{", text, re.MULTILINE)
+    if not match:
+        return text
+    # Count braces outside comments to find the end of the section
+    depth = 0
+    lines = []
+    for line in text[match.end():].splitlines(keepends=True):
+        if not line.lstrip().startswith("#"):
+            for index, char in enumerate(line):
+                depth += {"{": 1, "}": -1}.get(char, 0)
+                if depth < 0:
+                    lines.append(line[:index])
+                    return "".join(lines)
+        lines.append(line)
+    raise ValueError(f"{path} has no end to its filter section")
+
+
+def parse_times(output):
+    """Returns the user + system CPU seconds of bash's children from the `times` builtin."""
+    lines = [l for l in output.strip().splitlines() if re.match(r"^\d+m[\d.]+s \d+m[\d.]+s$", l)]
+    seconds = 0.0
+    for minutes, secs in re.findall(r"(\d+)m([\d.]+)s", lines[-1]):
+        seconds += int(minutes) * 60 + float(secs)
+    return seconds
+
+
+def run_once(args, filters, count):
+    settings, generated = generator(args, count)
+    config = PIPELINE.replace("__GENERATOR__", settings).replace("__FILTERS__", filters)
+    command = ["docker", "run", "--rm", "--cpus", str(args.cpus), "-e", "CONFIG", "--entrypoint", "bash", args.image,
+               "-c", 'logstash --pipeline.workers 1 --log.level error --config.string "$CONFIG" > /dev/null; times']
+    started = time.monotonic()
+    result = subprocess.run(command, env={**os.environ, "CONFIG": config}, text=True, stdout=subprocess.PIPE, check=True)
+    return time.monotonic() - started, parse_times(result.stdout), generated
+
+
+def measure(args, path):
+    filters = read_filters(path)
+    small, large = [], []
+    for _ in range(args.repeat):
+        small.append(run_once(args, filters, args.events))
+        large.append(run_once(args, filters, args.events * 5))
+    events = large[0][2] - small[0][2]
+    wall = statistics.median(l[0] for l in large) - statistics.median(s[0] for s in small)
+    cpu = statistics.median(l[1] for l in large) - statistics.median(s[1] for s in small)
+    cpu_us = cpu / events * 1e6
+    return {
+        "filters": os.path.relpath(path, HERE),
+        "events": events,
+        "events_per_second": round(events / wall, 1),
+        "cpu_microseconds_per_event": round(cpu_us, 2),
+        "events_per_vcpu_second": round(1e6 / cpu_us, 1),
+        # vCPU the filters (plus the generator and pipeline overhead they share) need at the target rate
+        "vcpu_at_rate": round(args.rate * cpu_us / 1e6, 3)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("filters", nargs="+", help="Files of filter plugins to compare; the first is the baseline")
+    parser.add_argument("--events", type=int, default=100000, help="N; each snippet runs N and 5N events")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each size, the median is used")
+    parser.add_argument("--rate", type=float, default=10000, help="Events per second to express the CPU cost at")
+    parser.add_argument("--cpus", type=float, default=1)
+    parser.add_argument("--corpus", help="File of events, one per line, to replay instead of the winlogbeat event")
+    parser.add_argument("--type", help="Event type for the generator to set, e.g. syslog for pipelines that check [type]")
+    parser.add_argument("--image", default=f"telemetry-bench/logstash-out:{os.environ.get('IMAGE_TAG', 'local')}")
+    args = parser.parse_args()
+
+    results = [measure(args, path) for path in args.filters]
+    baseline = results[0]
+    for result in results[1:]:
+        saved = baseline["cpu_microseconds_per_event"] - result["cpu_microseconds_per_event"]
+        result["cpu_microseconds_saved_per_event"] = round(saved, 2)
+        result["vcpu_saved_at_rate"] = round(baseline["vcpu_at_rate"] - result["vcpu_at_rate"], 3)
+        result["cpu_saved_percent"] = round(100 * saved / baseline["cpu_microseconds_per_event"], 1)
+
+    print(f"{'filters':<48}{'eps':>12}{'us/event':>10}{'eps/vCPU':>12}{'vCPU @ ' + str(int(args.rate)):>14}")
+    for r in results:
+        print(f"{r['filters']:<48}{r['events_per_second']:>12}{r['cpu_microseconds_per_event']:>10}{r['events_per_vcpu_second']:>12}{r['vcpu_at_rate']:>14}")
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
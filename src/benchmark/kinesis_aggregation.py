@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""Estimate Kinesis throughput and shard count with and without aggregation.
+
+Models the logstash-in Kinesis output for a given event rate: one record per event,
+KPL aggregation, and KPL aggregation with per-event compression (kinesis_pack.rb).
+Events are either generated (syslog or winlogbeat shaped) or read from a json_lines
+file, e.g. an object downloaded from the S3 archive.
+
+    python3 kinesis_aggregation.py --eps 10000 --source beats
+    python3 kinesis_aggregation.py --eps 10000 --events sample.json --json
+
+zstd results are included when the `zstandard` package is installed, for comparison
+only; logstash-in currently supports gzip.
+"""
+import argparse
+import base64
+import gzip
+import json
+import math
+import random
+import time
+import uuid
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Kinesis per-shard write limits
+SHARD_RECORDS_PER_SECOND = 1000
+SHARD_BYTES_PER_SECOND = 1024 * 1024
+# KPL aggregated record framing: magic number + protobuf message + MD5 checksum
+KPL_MAGIC = b"\xf3\x89\x9a\xc2"
+KPL_CHECKSUM_BYTES = 16
+# Extra fields Logstash adds to the envelope event created by kinesis_pack.rb
+ENVELOPE_TEMPLATE = '{"@packed":{"codec":"%s","data":"%s"},"@version":"1","@timestamp":"2020-01-01T00:00:00.000Z"}'
+
+
+def varint_size(value):
+    size = 1
+    while value >= 0x80:
+        value >>= 7
+        size += 1
+    return size
+
+
+def field_size(length):
+    """Size of a length-delimited protobuf field with a one byte tag."""
+    return 1 + varint_size(length) + length
+
+
+def syslog_event(rng, i):
+    host = f"fw{rng.randint(1, 20):02d}.example.com"
+    message = (f"<134>Jan {rng.randint(1, 28):2d} 10:{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d} {host} "
+               f"filterlog[{rng.randint(1000, 9999)}]: 5,,,1000000103,igb0,match,block,in,4,0x0,,64,{i},0,none,6,tcp,60,"
+               f"10.0.{rng.randint(0, 255)}.{rng.randint(1, 254)},10.1.{rng.randint(0, 255)}.{rng.randint(1, 254)},"
+               f"{rng.randint(1024, 65535)},{rng.choice([22, 80, 443, 3389])},0,S")
+    return {
+        "message": message,
+        "@version": "1",
+        "@timestamp": "2020-01-01T10:00:00.000Z",
+        "host": f"10.0.0.{rng.randint(1, 254)}",
+        "port": rng.randint(1024, 65535),
+        "type": "syslog",
+        "tags": ["syslog"]
+    }
+
+
+def beats_event(rng, i):
+    host = f"WKS{rng.randint(1, 5000):05d}"
+    event_id = rng.choice([4624, 4625, 4634, 4672, 4688, 1, 3, 11])
+    return {
+        "@timestamp": "2020-01-01T10:00:00.000Z",
+        "@version": "1",
+        "type": "wineventlog",
+        "tags": ["beats", "beats_input_codec_plain_applied"],
+        "message": f"An account was successfully logged on.\n\nSubject:\n\tSecurity ID:\t\tS-1-5-18\n\tAccount Name:\t\t{host}$\n\t"
+                   f"Account Domain:\t\tEXAMPLE\n\tLogon ID:\t\t0x3E7\n\nLogon Type:\t\t\t{rng.randint(2, 11)}\n\nNew Logon:\n\t"
+                   f"Security ID:\t\tS-1-5-21-{rng.randint(10**9, 10**10)}-{i}\n\tAccount Name:\t\tuser{rng.randint(1, 900)}\n\t"
+                   f"Logon GUID:\t\t{{{uuid.UUID(int=rng.getrandbits(128))}}}\n\nProcess Information:\n\tProcess ID:\t\t0x{rng.randint(256, 65535):x}\n\t"
+                   f"Process Name:\t\tC:\\Windows\\System32\\svchost.exe",
+        "agent": {"hostname": host, "type": "winlogbeat", "version": "7.6.2", "id": str(uuid.UUID(int=rng.getrandbits(128)))},
+        "ecs": {"version": "1.4.0"},
+        "host": {"name": host, "hostname": host, "architecture": "x86_64",
+                 "os": {"platform": "windows", "version": "10.0", "family": "windows", "build": "17763.1098"}},
+        "log": {"level": "information"},
+        "event": {"kind": "event", "code": event_id, "provider": "Microsoft-Windows-Security-Auditing",
+                  "action": "Logon", "created": "2020-01-01T10:00:00.500Z", "outcome": "success"},
+        "winlog": {"channel": "Security", "event_id": event_id, "record_id": 1000000 + i,
+                   "computer_name": f"{host}.example.com", "provider_name": "Microsoft-Windows-Security-Auditing",
+                   "process": {"pid": 640, "thread": {"id": rng.randint(100, 9000)}},
+                   "event_data": {"LogonType": str(rng.randint(2, 11)), "TargetUserName": f"user{rng.randint(1, 900)}",
+                                  "TargetDomainName": "EXAMPLE", "IpAddress": f"10.2.{rng.randint(0, 255)}.{rng.randint(1, 254)}",
+                                  "AuthenticationPackageName": "Kerberos", "LogonProcessName": "Kerberos"}},
+        "original_metadata": {"beat": "winlogbeat", "type": "_doc", "version": "7.6.2"}
+    }
+
+
+def load_events(args):
+    if args.events:
+        with open(args.events) as f:
+            return [json.loads(line) for line in f if line.strip()][:args.sample]
+    rng = random.Random(args.seed)
+    generators = {"syslog": [syslog_event], "beats": [beats_event], "mixed": [syslog_event, beats_event]}[args.source]
+    return [rng.choice(generators)(rng, i) for i in range(args.sample)]
+
+
+def compressors():
+    result = {"gzip": lambda data: gzip.compress(data, compresslevel=6)}
+    if zstandard is not None:
+        cctx = zstandard.ZstdCompressor(level=3)
+        result["zstd"] = cctx.compress
+    return result
+
+
+def pack(payload, codec, compress, min_bytes):
+    """Returns the Kinesis user record produced by kinesis_pack.rb for a serialised event."""
+    if compress is None or len(payload) < min_bytes:
+        return payload
+    data = base64.b64encode(compress(payload)).decode()
+    return (ENVELOPE_TEMPLATE % (codec, data)).encode()
+
+
+def aggregate(records, keys, max_size, max_count):
+    """Packs user records into KPL aggregated records, returning the size of each Kinesis record sent."""
+    sizes = []
+    body = 0
+    count = 0
+    for data, key in zip(records, keys):
+        # Each user record adds its partition key to the key table and a Record message
+        entry = field_size(len(key)) + field_size(1 + varint_size(count) + field_size(len(data)))
+        framed = len(KPL_MAGIC) + body + entry + KPL_CHECKSUM_BYTES
+        if count and (framed > max_size or count >= max_count):
+            sizes.append(len(KPL_MAGIC) + body + KPL_CHECKSUM_BYTES + len(keys[0]))
+            body = 0
+            count = 0
+            entry = field_size(len(key)) + field_size(1 + varint_size(0) + field_size(len(data)))
+        body += entry
+        count += 1
+    if count:
+        sizes.append(len(KPL_MAGIC) + body + KPL_CHECKSUM_BYTES + len(keys[0]))
+    return sizes
+
+
+def shards_needed(records_per_second, bytes_per_second):
+    return max(1, math.ceil(records_per_second / SHARD_RECORDS_PER_SECOND), math.ceil(bytes_per_second / SHARD_BYTES_PER_SECOND))
+
+
+def scenario(name, user_records, keys, eps, aggregated, args, cpu_seconds=0.0):
+    user_bytes = sum(len(r) for r in user_records) / len(user_records)
+    if not aggregated:
+        record_bytes = user_bytes + sum(len(k) for k in keys) / len(keys)
+        records_per_event = 1.0
+    else:
+        # KPL only aggregates records bound for the same shard within record_max_buffered_time,
+        # so at low per-shard rates records are sent before they fill up. Iterate to a stable shard count.
+        shards = 1
+        for _ in range(10):
+            per_window = max(1, int(eps / shards * args.max_buffered_time_ms / 1000))
+            sizes = aggregate(user_records, keys, args.max_size, min(args.max_count, per_window))
+            records_per_event = len(sizes) / len(user_records)
+            record_bytes = sum(sizes) / len(sizes)
+            needed = shards_needed(eps * records_per_event, eps * records_per_event * record_bytes)
+            if needed == shards:
+                break
+            shards = needed
+    records_per_second = eps * records_per_event
+    bytes_per_second = records_per_second * record_bytes
+    return {
+        "scenario": name,
+        "avg_event_bytes": round(user_bytes, 1),
+        "events_per_record": round(1 / records_per_event, 1),
+        "records_per_second": round(records_per_second, 1),
+        "bytes_per_second": round(bytes_per_second),
+        "shards_by_records": math.ceil(records_per_second / SHARD_RECORDS_PER_SECOND),
+        "shards_by_bytes": math.ceil(bytes_per_second / SHARD_BYTES_PER_SECOND),
+        "shards_needed": shards_needed(records_per_second, bytes_per_second),
+        "compress_us_per_event": round(cpu_seconds / len(user_records) * 1e6, 2)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--eps", type=float, default=10000, help="Sustained events per second across all inbound services")
+    parser.add_argument("--source", choices=["syslog", "beats", "mixed"], default="mixed", help="Shape of generated events")
+    parser.add_argument("--events", help="json_lines file of sample events to use instead of generated ones")
+    parser.add_argument("--sample", type=int, default=20000, help="Number of events to model")
+    parser.add_argument("--max-size", type=int, default=51200, help="queue.aggregation.max_size_bytes")
+    parser.add_argument("--max-count", type=int, default=4294967295, help="queue.aggregation.max_count")
+    parser.add_argument("--max-buffered-time-ms", type=int, default=100, help="queue.aggregation.max_buffered_time_ms")
+    parser.add_argument("--compression-min-bytes", type=int, default=1024, help="queue.aggregation.compression_min_bytes")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="Write results as JSON")
+    args = parser.parse_args()
+
+    events = load_events(args)
+    payloads = [json.dumps(e, separators=(",", ":")).encode() for e in events]
+    # randomized_partition_key => true gives every user record its own random key
+    keys = [uuid.uuid4().hex.encode() for _ in payloads]
+
+    results = [
+        scenario("per-event", payloads, keys, args.eps, False, args),
+        scenario("aggregated", payloads, keys, args.eps, True, args)
+    ]
+    for codec, compress in compressors().items():
+        start = time.process_time()
+        packed = [pack(p, codec, compress, args.compression_min_bytes) for p in payloads]
+        cpu_seconds = time.process_time() - start
+        results.append(scenario(f"aggregated+{codec}", packed, keys, args.eps, True, args, cpu_seconds))
+
+    if args.json:
+        print(json.dumps({"eps": args.eps, "events": len(events), "results": results}, indent=2))
+        return
+
+    columns = ["scenario", "avg_event_bytes", "events_per_record", "records_per_second", "bytes_per_second",
+               "shards_by_records", "shards_by_bytes", "shards_needed", "compress_us_per_event"]
+    widths = [max(len(c), *(len(str(r[c])) for r in results)) for c in columns]
+    print(f"{len(events)} events modelled at {args.eps:g} events/sec")
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for r in results:
+        print("  ".join(str(r[c]).ljust(w) for c, w in zip(columns, widths)))
+
+
+if __name__ == "__main__":
+    main()
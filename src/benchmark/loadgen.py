@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""Load generator for the inbound Logstash services.
+
+Sends syslog (RFC3164 or RFC5424, over TCP or UDP), beats (Lumberjack v2) or
+Azure Event Hubs shaped JSON batches at a fixed rate, and reports what it managed
+to send. Every event carries `bench_ts=<epoch ms>` and `bench_seq=<n>` so that
+run.py can measure end-to-end latency from the archived copies.
+
+    python3 loadgen.py syslog --host localhost --port 5514 --eps 2000 --duration 60
+    python3 loadgen.py syslog --udp --format rfc5424 --port 5516 --eps 500
+    python3 loadgen.py beats --port 5044 --eps 5000 --connections 4
+    python3 loadgen.py azure --port 5600 --eps 1000 --records-per-batch 50
+"""
+import argparse
+import json
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def rfc3164(rng, seq):
+    t = datetime.now()
+    host = f"fw{rng.randint(1, 20):02d}"
+    return (f"<134>{MONTHS[t.month - 1]} {t.day:2d} {t:%H:%M:%S} {host} filterlog[{rng.randint(1000, 9999)}]: "
+            f"5,,,1000000103,igb0,match,block,in,4,0x0,,64,{seq},0,none,6,tcp,60,10.0.{rng.randint(0, 255)}.{rng.randint(1, 254)},"
+            f"10.1.{rng.randint(0, 255)}.{rng.randint(1, 254)},{rng.randint(1024, 65535)},443,0,S bench_seq={seq} bench_ts={now_ms()}")
+
+
+def rfc5424(rng, seq):
+    t = datetime.now(timezone.utc)
+    host = f"app{rng.randint(1, 50):02d}.example.com"
+    return (f"<165>1 {t:%Y-%m-%dT%H:%M:%S}.{t.microsecond // 1000:03d}Z {host} sshd {rng.randint(1000, 9999)} ID47 "
+            f"[exampleSDID@32473 iut=\"3\" eventSource=\"Application\"] Accepted publickey for user{rng.randint(1, 900)} "
+            f"from 10.2.{rng.randint(0, 255)}.{rng.randint(1, 254)} port {rng.randint(1024, 65535)} ssh2 bench_seq={seq} bench_ts={now_ms()}")
+
+
+def beat_event(rng, seq):
+    host = f"WKS{rng.randint(1, 5000):05d}"
+    event_id = rng.choice([4624, 4625, 4634, 4672, 4688])
+    return {
+        "@timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
+        "@metadata": {"beat": "winlogbeat", "type": "_doc", "version": "7.6.2"},
+        "message": f"An account was successfully logged on. bench_seq={seq} bench_ts={now_ms()}",
+        "agent": {"hostname": host, "type": "winlogbeat", "version": "7.6.2"},
+        "host": {"name": host},
+        "event": {"code": event_id, "provider": "Microsoft-Windows-Security-Auditing", "action": "Logon"},
+        "winlog": {"channel": "Security", "event_id": event_id, "record_id": seq, "computer_name": f"{host}.example.com",
+                   "event_data": {"LogonType": str(rng.randint(2, 11)), "TargetUserName": f"user{rng.randint(1, 900)}",
+                                  "IpAddress": f"10.2.{rng.randint(0, 255)}.{rng.randint(1, 254)}"}}
+    }
+
+
+def azure_batch(rng, seq, records):
+    return {"records": [{
+        "time": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
+        "tenantId": "00000000-0000-0000-0000-000000000000",
+        "operationName": "Sign-in activity",
+        "category": "SignInLogs",
+        "resultType": rng.choice(["0", "50126"]),
+        "callerIpAddress": f"203.0.113.{rng.randint(1, 254)}",
+        "identity": f"user{rng.randint(1, 900)}@example.com",
+        "benchSeq": seq + i,
+        "benchTs": f"bench_ts={now_ms()}"
+    } for i in range(records)]}
+
+
+class Pacer(object):
+    """Spreads `eps` events per second evenly, in small bursts so that sleeping stays cheap."""
+    def __init__(self, eps, burst_seconds=0.01):
+        self.eps = eps
+        self.burst = max(1, int(eps * burst_seconds))
+        self.start = time.monotonic()
+        self.sent = 0
+
+    def next_burst(self):
+        due = self.start + self.sent / self.eps
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self.sent += self.burst
+        return self.burst
+
+
+class LumberjackClient(object):
+    """Minimal Lumberjack v2 (beats protocol) client: compressed JSON frames, acked per window."""
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port))
+        self.seq = 0
+
+    def send(self, events):
+        frames = []
+        for event in events:
+            self.seq += 1
+            payload = json.dumps(event, separators=(",", ":")).encode()
+            frames.append(b"2J" + struct.pack(">II", self.seq, len(payload)) + payload)
+        compressed = zlib.compress(b"".join(frames))
+        self.sock.sendall(b"2W" + struct.pack(">I", len(events)) + b"2C" + struct.pack(">I", len(compressed)) + compressed)
+        # The server acks the last sequence number of the window once the events are queued
+        acked = 0
+        while acked < self.seq:
+            header = self.recv_exact(6)
+            if header[:2] != b"2A":
+                raise IOError(f"Unexpected lumberjack frame {header[:2]!r}")
+            acked = struct.unpack(">I", header[2:])[0]
+
+    def recv_exact(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise IOError("Connection closed by server")
+            data += chunk
+        return data
+
+
+def run_connection(args, index, counters):
+    rng = random.Random(args.seed + index)
+    pacer = Pacer(args.eps / args.connections)
+    deadline = time.monotonic() + args.duration
+    seq = index * 10 ** 9
+
+    if args.source == "beats":
+        client = LumberjackClient(args.host, args.port)
+        while time.monotonic() < deadline:
+            count = pacer.next_burst()
+            client.send([beat_event(rng, seq + i) for i in range(count)])
+            seq += count
+            counters[index] += count
+        return
+
+    if args.source == "syslog" and args.udp:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        address = (args.host, args.port)
+    else:
+        sock = socket.create_connection((args.host, args.port))
+    formatter = rfc5424 if args.format == "rfc5424" else rfc3164
+    owed = 0
+
+    while time.monotonic() < deadline:
+        count = pacer.next_burst()
+        if args.source == "azure":
+            # Each line is one Event Hubs message holding a batch of records, sent once a whole batch is due
+            owed += count
+            lines = []
+            while owed >= args.records_per_batch:
+                owed -= args.records_per_batch
+                lines.append(json.dumps(azure_batch(rng, seq, args.records_per_batch), separators=(",", ":")))
+                seq += args.records_per_batch
+            if lines:
+                sock.sendall(("\n".join(lines) + "\n").encode())
+            counters[index] += len(lines) * args.records_per_batch
+        elif args.udp:
+            for i in range(count):
+                sock.sendto(formatter(rng, seq + i).encode(), address)
+            seq += count
+            counters[index] += count
+        else:
+            sock.sendall(("\n".join(formatter(rng, seq + i) for i in range(count)) + "\n").encode())
+            seq += count
+            counters[index] += count
+    sock.close()
+
+
+def generate(args):
+    """Runs the load and returns a summary of what was sent."""
+    counters = [0] * args.connections
+    threads = [threading.Thread(target=run_connection, args=(args, i, counters), daemon=True) for i in range(args.connections)]
+    start = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - start
+    return {
+        "source": args.source,
+        "format": args.format if args.source == "syslog" else None,
+        "transport": "udp" if args.udp else "tcp",
+        "target_eps": args.eps,
+        "connections": args.connections,
+        "events_sent": sum(counters),
+        "duration_seconds": round(elapsed, 2),
+        "sent_eps": round(sum(counters) / elapsed, 1)
+    }
+
+
+def parser():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("source", choices=["syslog", "beats", "azure"])
+    p.add_argument("--host", default="localhost")
+    p.add_argument("--port", type=int, required=True)
+    p.add_argument("--eps", type=float, default=1000, help="Target events per second across all connections")
+    p.add_argument("--duration", type=float, default=60, help="Seconds to send for")
+    p.add_argument("--connections", type=int, default=1)
+    p.add_argument("--format", choices=["rfc3164", "rfc5424"], default="rfc3164", help="Syslog message format")
+    p.add_argument("--udp", action="store_true", help="Send syslog over UDP")
+    p.add_argument("--records-per-batch", type=int, default=50, help="Records in each Azure Event Hubs message")
+    p.add_argument("--seed", type=int, default=1)
+    return p
+
+
+if __name__ == "__main__":
+    json.dump(generate(parser().parse_args()), sys.stdout, indent=2)
+    print()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""A local stand-in for a Splunk HTTP Event Collector (HEC), to test the splunk_hec output against.
+
+Accepts batches of HEC events, gzip compressed or not, on /services/collector/event, and counts the
+requests, events and connections it sees (so keep-alive reuse shows as far fewer connections than
+requests). Slowness and failures can be injected to watch the output batch up, retry and spill:
+
+    python3 mock_hec.py --port 8088 --token bench
+    python3 mock_hec.py --latency-ms 2000 --fail-rate 0.2 --fail-status 503 --out events.json
+
+`run.py run --source beats --splunk` runs it in docker compose (as `mock-hec`) and points the processor
+at it; --hec-latency-ms and --hec-fail-rate are passed through. GET /stats returns the counts as
+JSON, and they are printed every --report-seconds.
+"""
+import argparse
+import gzip
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EVENT_PATH = "/services/collector/event"
+HEALTH_PATH = "/services/collector/health"
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {"connections": 0, "requests": 0, "compressed_requests": 0, "failures": 0, "events": 0, "bytes": 0, "compressed_bytes": 0}
+
+    def add(self, **changes):
+        with self.lock:
+            for name, change in changes.items():
+                self.counts[name] += change
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+def split_events(body):
+    """Returns the JSON objects in a HEC batch, which are concatenated with optional whitespace between them."""
+    decoder = json.JSONDecoder()
+    text = body.decode("utf-8")
+    events = []
+    position = 0
+    while True:
+        while position < len(text) and text[position].isspace():
+            position += 1
+        if position == len(text):
+            return events
+        event, position = decoder.raw_decode(text, position)
+        events.append(event)
+
+
+def handler(args, stats, out):
+    class HecHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            stats.add(connections=1)
+
+        def log_message(self, format, *log_args):
+            pass
+
+        def reply(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self.reply(200, stats.snapshot())
+            elif self.path.startswith(HEALTH_PATH):
+                self.reply(200, {"text": "HEC is healthy", "code": 17})
+            else:
+                self.reply(404, {"text": "The requested URL was not found on this server.", "code": 404})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if not self.path.startswith(EVENT_PATH):
+                self.reply(404, {"text": "The requested URL was not found on this server.", "code": 404})
+                return
+            if args.token and self.headers.get("Authorization") != f"Splunk {args.token}":
+                self.reply(403, {"text": "Invalid token", "code": 4})
+                return
+            if args.latency_ms:
+                time.sleep(args.latency_ms / 1000)
+            if random.random() < args.fail_rate:
+                stats.add(requests=1, failures=1)
+                self.reply(args.fail_status, {"text": "Server is busy", "code": 9})
+                return
+
+            compressed = self.headers.get("Content-Encoding") == "gzip"
+            try:
+                events = split_events(gzip.decompress(body) if compressed else body)
+            except (OSError, ValueError):
+                stats.add(requests=1, failures=1)
+                self.reply(400, {"text": "Invalid data format", "code": 6})
+                return
+            if not events or any("event" not in e for e in events):
+                stats.add(requests=1, failures=1)
+                self.reply(400, {"text": "Event field is required", "code": 12})
+                return
+            stats.add(requests=1, compressed_requests=int(compressed), events=len(events),
+                      bytes=sum(len(json.dumps(e)) for e in events), compressed_bytes=len(body) if compressed else 0)
+            if out:
+                with out["lock"]:
+                    for e in events:
+                        out["file"].write(json.dumps(e) + "\n")
+                    out["file"].flush()
+            self.reply(200, {"text": "Success", "code": 0})
+
+    return HecHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8088)
+    parser.add_argument("--token", default="bench", help="Token to require; empty accepts any")
+    parser.add_argument("--latency-ms", type=int, default=0, help="Delay before answering each request")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Share of requests to fail with --fail-status")
+    parser.add_argument("--fail-status", type=int, default=503)
+    parser.add_argument("--out", help="Append the events received to this file as JSON lines")
+    parser.add_argument("--report-seconds", type=int, default=10)
+    args = parser.parse_args()
+
+    stats = Stats()
+    out = {"file": open(args.out, "a"), "lock": threading.Lock()} if args.out else None
+    server = ThreadingHTTPServer(("0.0.0.0", args.port), handler(args, stats, out))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Listening on {args.port}", file=sys.stderr)
+    try:
+        while True:
+            time.sleep(args.report_seconds)
+            print(json.dumps(stats.snapshot()), file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        if out:
+            out["file"].close()
+        print(json.dumps(stats.snapshot()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""Compares how evenly each Kinesis partitioning strategy spreads a host distribution over the shards.
+
+Replays a recorded distribution of load per host, e.g. the bytes or events per `name=` partition of
+a day of the beats archive, saved as CSV with `host` and `bytes` (or `events`, sized with --event-bytes)
+columns. Without a recording it generates hosts whose rates follow a Zipf distribution:
+
+    python3 partition_skew.py --recording hosts.csv --seconds 86400 --shards 4 8
+    python3 partition_skew.py --hosts 5000 --zipf 1.2 --eps 4000 --shards 4 8 16
+
+Keys are hashed onto shards the way Kinesis does (MD5 over an evenly split hash key space), and
+salting follows src/docker/logstash-in/scripts/partition_key.rb: a host over the hot key threshold is
+spread over --salt-buckets keys. The report uses the same skew measure as the shard skew Lambda.
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda", "shard_skew"))
+
+from skew import SHARD_BYTES_PER_SECOND, SkewConfig, measure, shard_for_key
+
+
+def read_recording(path, seconds, event_bytes):
+    """Returns bytes per second for each host in a CSV recording."""
+    rates = {}
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            size = float(row["bytes"]) if row.get("bytes") else float(row["events"]) * event_bytes
+            rates[row["host"]] = rates.get(row["host"], 0.0) + size / seconds
+    return rates
+
+
+def zipf_hosts(hosts, exponent, eps, event_bytes, seed):
+    """Returns bytes per second for `hosts` hosts whose rates fall off with rank like a Zipf distribution."""
+    weights = [1 / (rank ** exponent) for rank in range(1, hosts + 1)]
+    total = sum(weights)
+    rng = random.Random(seed)
+    names = [f"WKS{n:05d}" for n in range(hosts)]
+    rng.shuffle(names)
+    return {name: eps * event_bytes * w / total for name, w in zip(names, weights)}
+
+
+def simulate(rates, shard_count, strategy, salt_buckets, hot_key_bytes_per_second):
+    """Returns bytes per second per shard, and the number of salted hosts."""
+    load = [0.0] * shard_count
+    salted = 0
+    if strategy == "random":
+        # A new key for every event spreads the bytes evenly
+        total = sum(rates.values())
+        return [total / shard_count] * shard_count, 0
+    for host, rate in rates.items():
+        if strategy == "salted" and rate > hot_key_bytes_per_second and salt_buckets > 1:
+            salted += 1
+            for n in range(salt_buckets):
+                load[shard_for_key(f"{host}#{n}", shard_count)] += rate / salt_buckets
+        else:
+            load[shard_for_key(host, shard_count)] += rate
+    return load, salted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recording", help="CSV with host and bytes (or events) columns")
+    parser.add_argument("--seconds", type=float, default=3600, help="Seconds the recording covers")
+    parser.add_argument("--hosts", type=int, default=5000, help="Hosts to generate without a recording")
+    parser.add_argument("--zipf", type=float, default=1.2, help="Zipf exponent for generated hosts")
+    parser.add_argument("--eps", type=float, default=4000, help="Events per second across generated hosts")
+    parser.add_argument("--event-bytes", type=float, default=600, help="Bytes per event, for event counts")
+    parser.add_argument("--shards", type=int, nargs="+", default=[4, 8])
+    parser.add_argument("--salt-buckets", type=int, default=8)
+    parser.add_argument("--hot-key-threshold-percent", type=float, default=25, help="Share of a shard's write limit that makes a host hot")
+    parser.add_argument("--skew-threshold", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.recording:
+        rates = read_recording(args.recording, args.seconds, args.event_bytes)
+    else:
+        rates = zipf_hosts(args.hosts, args.zipf, args.eps, args.event_bytes, args.seed)
+    hot_key_bytes_per_second = SHARD_BYTES_PER_SECOND * args.hot_key_threshold_percent / 100
+    config = SkewConfig(skew_threshold=args.skew_threshold, min_utilization_percent=0)
+
+    results = []
+    for shard_count in args.shards:
+        for strategy in ("random", "host", "salted"):
+            load, salted = simulate(rates, shard_count, strategy, args.salt_buckets, hot_key_bytes_per_second)
+            report = measure({f"shard-{n:03d}": rate for n, rate in enumerate(load)}, config)
+            results.append({
+                "shards": shard_count,
+                "strategy": strategy,
+                "skew": round(report.skew, 3),
+                "max_shard_utilization_percent": round(report.max_utilization_percent, 1),
+                "hot_shards": len(report.hot_shards),
+                # Shards over their write limit will throttle, whatever the skew
+                "throttled_shards": sum(1 for s in report.shards if s.utilization_percent > 100),
+                "salted_hosts": salted
+            })
+
+    json.dump({
+        "hosts": len(rates),
+        "mib_per_second": round(sum(rates.values()) / 2 ** 20, 2),
+        "busiest_host_percent_of_shard": round(max(rates.values()) / SHARD_BYTES_PER_SECOND * 100, 1),
+        "results": results
+    }, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""Compares how evenly syslog load lands on Logstash tasks with and without the syslog relay.
+
+Runs everything in-process: fake Logstash receivers that can each process a fixed number of
+messages per second, and senders with long-lived TCP connections at skewed rates (by default
+one chatty firewall and a few quiet devices).
+
+    connection   each sender is pinned to one receiver, like an NLB balancing connections
+    relay        senders connect to the relay in src/docker/syslog-relay, which dispatches messages
+
+    python3 relay_skew.py --receivers 3 --receiver-eps 4000 --senders 6000,300,300,300 --duration 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "docker", "syslog-relay"))
+
+import loadgen
+from relay import Relay, RelayConfig
+
+
+class FakeLogstash(object):
+    """Accepts newline delimited messages and takes 1/capacity seconds of 'CPU' for each."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.processed = 0
+        self.busy_seconds = 0.0
+        self.busy_until = 0.0
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, host="127.0.0.1", port=0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                count = data.count(b"\n")
+                cost = count / self.capacity
+                now = time.monotonic()
+                self.busy_until = max(self.busy_until, now) + cost
+                self.busy_seconds += cost
+                self.processed += count
+                # Not reading while busy is what pushes back on the sender
+                if self.busy_until > now:
+                    await asyncio.sleep(self.busy_until - now)
+        except asyncio.CancelledError:
+            # The scenario is over; whatever is still buffered was never processed
+            pass
+        writer.close()
+
+
+async def send(port, eps, duration, seed):
+    rng = random.Random(seed)
+    _, writer = await asyncio.open_connection("127.0.0.1", port)
+    pacer = loadgen.Pacer(eps)
+    deadline = time.monotonic() + duration
+    seq = seed * 10 ** 9
+    sent = 0
+    while time.monotonic() < deadline:
+        due = pacer.start + pacer.sent / pacer.eps
+        if due > time.monotonic():
+            await asyncio.sleep(due - time.monotonic())
+        count = pacer.burst
+        pacer.sent += count
+        writer.write("".join(loadgen.rfc3164(rng, seq + i) + "\n" for i in range(count)).encode())
+        await writer.drain()
+        seq += count
+        sent += count
+    writer.close()
+    return sent
+
+
+async def scenario(name, args, dispatch=None):
+    receivers = [FakeLogstash(args.receiver_eps) for _ in range(args.receivers)]
+    ports = [await r.start() for r in receivers]
+    relay = None
+    if dispatch:
+        relay = Relay(RelayConfig(ports=[0], listen_host="127.0.0.1", backend_port=0, backends=[("127.0.0.1", p) for p in ports], dispatch=dispatch))
+        await relay.start()
+        relay_port = relay.servers[0].sockets[0].getsockname()[1]
+        # Let the relay connect to every receiver first
+        while not all(b.connected for b in relay.backends.values()):
+            await asyncio.sleep(0.05)
+        targets = [relay_port] * len(args.senders)
+    else:
+        targets = [ports[i % len(ports)] for i in range(len(args.senders))]
+
+    started = time.monotonic()
+    sent = await asyncio.gather(*(send(port, eps, args.duration, i + 1) for i, (port, eps) in enumerate(zip(targets, args.senders))))
+    elapsed = time.monotonic() - started
+
+    utilisation = [min(1.0, r.busy_seconds / elapsed) * 100 for r in receivers]
+    result = {
+        "scenario": name,
+        "sent_eps": round(sum(sent) / elapsed, 1),
+        "processed_eps": round(sum(r.processed for r in receivers) / elapsed, 1),
+        "receiver_utilisation_percent": [round(u, 1) for u in utilisation],
+        # 1.0 is perfectly even; higher means one task is working harder than the rest
+        "skew": round(max(utilisation) / statistics.mean(utilisation), 2) if statistics.mean(utilisation) else None
+    }
+    if relay:
+        await relay.close()
+    for r in receivers:
+        r.server.close()
+    return result
+
+
+async def main(args):
+    results = [await scenario("connection", args)]
+    for dispatch in args.dispatch:
+        results.append(await scenario(f"relay-{dispatch}", args, dispatch))
+    return results
+
+
+def parse_rates(value):
+    return [float(v) for v in value.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--receivers", type=int, default=3, help="Number of fake Logstash tasks")
+    parser.add_argument("--receiver-eps", type=float, default=4000, help="Messages per second each task can process")
+    parser.add_argument("--senders", type=parse_rates, default=[6000, 300, 300, 300], help="Comma separated events per second for each sender")
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--dispatch", nargs="+", default=["least_loaded", "round_robin"])
+    args = parser.parse_args()
+
+    results = asyncio.run(main(args))
+    print(f"{'scenario':<24}{'sent eps':>12}{'processed eps':>15}{'skew':>8}  utilisation %")
+    for r in results:
+        print(f"{r['scenario']:<24}{r['sent_eps']:>12}{r['processed_eps']:>15}{str(r['skew']):>8}  {r['receiver_utilisation_percent']}")
+    json.dump(results, sys.stdout, indent=2)
+    print()
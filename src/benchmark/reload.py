@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""Checks that config bundles reach a running processor without dropping events.
+
+Runs sustained beats load through beats-in and the processor, and while it runs publishes four
+config bundles to the processor's config_sync pipeline (see
+src/docker/logstash-out/plugins/logstash/inputs/config_sync.rb), `--step` seconds apart:
+
+    v1  tags every beats event config_v1             applied
+    v2  leaves a brace open in 30-beats.conf         rejected by `logstash --config.test_and_exit`
+    v3  matches a grok pattern that doesn't exist  fails to reload, so rolled back to v1
+    v4  tags every beats event config_v4             applied
+
+Each bundle is the benchmark's copy of the image pipelines with that one change to 30-beats.conf.
+The result has the outcome of each bundle and how long it took, and every event sent is counted
+in S3 afterwards, so `dropped_events` should be 0:
+
+    python3 reload.py --eps 2000 --step 60
+    python3 reload.py --eps 5000 --processor-cpus 2 --heap 2g --build
+"""
+import argparse
+import gzip
+import io
+import json
+import os
+import sys
+import tarfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import loadgen
+from run import (BUCKETS, RESULTS, WORK, Sampler, aws_clients, compose, create_resources, image_ids, pipelines_running,
+                 prepare, summarise_container, wait_for)
+
+CONFIG_BUCKET = "bench-config"
+BUNDLE_KEY = "processor/config.tar.gz"
+BEATS_CONF = "30-beats.conf"
+
+TAG_FILTER = """
+filter {
+    mutate {
+        add_tag => [ "%s" ]
+    }
+}
+"""
+BROKEN_FILTER = """
+filter {
+    mutate {
+        add_tag => [ "config_v2" ]
+"""
+MISSING_PATTERN_FILTER = """
+filter {
+    grok {
+        match => { "message" => "%{BENCH_NO_SUCH_PATTERN:bench_field}" }
+        tag_on_failure => []
+    }
+}
+"""
+# (version, what it appends to 30-beats.conf, the outcome config_sync should report)
+VERSIONS = [
+    ("v1", TAG_FILTER % "config_v1", "applied"),
+    ("v2", BROKEN_FILTER, "rejected"),
+    ("v3", MISSING_PATTERN_FILTER, "rolled_back"),
+    ("v4", TAG_FILTER % "config_v4", "applied")
+]
+
+
+def bundle(extra):
+    """A bundle of the processor's pipelines, with extra appended to 30-beats.conf."""
+    pipelines = os.path.join(WORK, "logstash-out", "pipeline")
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w:gz") as tar:
+        for name in sorted(os.listdir(pipelines)):
+            if name.startswith("05-"):
+                continue
+            with open(os.path.join(pipelines, name)) as f:
+                conf = f.read()
+            if name == BEATS_CONF:
+                conf += extra
+            content = conf.encode()
+            info = tarfile.TarInfo(f"pipelines/{name}")
+            info.size = len(content)
+            info.mtime = time.time()
+            tar.addfile(info, io.BytesIO(content))
+    return data.getvalue()
+
+
+def sync_events():
+    """The events the processor's config_sync pipeline has written to its log so far."""
+    logs = compose("logs", "--no-color", "--no-log-prefix", "processor", capture=True).stdout
+    events = []
+    for line in logs.splitlines():
+        if not line.startswith('{"'):
+            continue
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+        if "config_sync" in event:
+            events.append(event["config_sync"])
+    return events
+
+
+def publish(s3, version, extra, timeout):
+    """Publishes one bundle and waits for config_sync to apply, reject or roll it back."""
+    etag = s3.put_object(Bucket=CONFIG_BUCKET, Key=BUNDLE_KEY, Body=bundle(extra))["ETag"]
+    published = time.time()
+    outcome = {}
+    wait_for(f"config_sync to take {version}",
+             lambda: outcome.update(next((e for e in sync_events() if e.get("etag") == etag), {})) or outcome,
+             timeout=timeout, required=False)
+    return {
+        "version": version,
+        "published": published,
+        "result": outcome.get("result"),
+        "seconds": round(time.time() - published, 1) if outcome else None,
+        "pipelines": outcome.get("pipelines"),
+        "error": outcome.get("error")
+    }
+
+
+def read_tags(s3):
+    """Counts the benchmark events archived to S3, and those with each config_v* tag."""
+    delivered = 0
+    tags = {}
+    for bucket in BUCKETS:
+        for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket):
+            for obj in page.get("Contents", []):
+                body = s3.get_object(Bucket=bucket, Key=obj["Key"])["Body"].read()
+                for line in gzip.decompress(body).splitlines():
+                    event = json.loads(line)
+                    if event.get("bench", {}).get("latency_ms") is None:
+                        continue
+                    delivered += 1
+                    for tag in event.get("tags", []):
+                        if tag.startswith("config_v"):
+                            tags[tag] = tags.get(tag, 0) + 1
+    return delivered, tags
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--eps", type=float, default=2000, help="Target beats events per second")
+    parser.add_argument("--step", type=float, default=60, help="Seconds between bundles")
+    parser.add_argument("--warmup", type=float, default=30, help="Seconds of load before the first bundle")
+    parser.add_argument("--connections", type=int, default=1)
+    parser.add_argument("--processor-cpus", type=float, default=1)
+    parser.add_argument("--heap", default="1g", help="Logstash -Xms/-Xmx")
+    parser.add_argument("--interval", type=int, default=5, help="Seconds between config_sync's checks for a new bundle")
+    parser.add_argument("--sample-interval", type=float, default=5)
+    parser.add_argument("--drain-timeout", type=float, default=300)
+    parser.add_argument("--name", help="Result name, defaults to reload-<eps>")
+    parser.add_argument("--build", action="store_true", help="Rebuild the images before running")
+    parser.add_argument("--keep", action="store_true", help="Leave the containers running afterwards")
+    args = parser.parse_args()
+
+    service = "beats-in"
+    prepare({
+        "CONFIG_SYNC_BUCKET": CONFIG_BUCKET,
+        "CONFIG_SYNC_KEY": BUNDLE_KEY,
+        "CONFIG_SYNC_INTERVAL_SECONDS": str(args.interval),
+        "CONFIG_RELOAD_AUTOMATIC": "true"
+    })
+    # The container's logstash user writes the bundles over the processor's copy of the pipelines
+    pipelines = os.path.join(WORK, "logstash-out", "pipeline")
+    os.chmod(pipelines, 0o777)
+    for name in os.listdir(pipelines):
+        os.chmod(os.path.join(pipelines, name), 0o666)
+    os.environ.update({
+        "PROCESSOR_CPUS": str(args.processor_cpus),
+        "LS_HEAP": args.heap,
+        "PIPELINE_MOUNT_MODE": "rw"
+    })
+    # Enough load to cover the warmup, every bundle and the time the last one takes
+    duration = args.warmup + args.step * len(VERSIONS)
+
+    compose("down", "-v", "--remove-orphans")
+    try:
+        compose("up", "-d", "localstack", "minio")
+        kinesis, s3 = aws_clients()
+        create_resources(kinesis, s3, 1)
+        s3.create_bucket(Bucket=CONFIG_BUCKET)
+        compose("up", "-d", *([] if args.build else ["--no-build"]), service, "processor")
+        wait_for(service, lambda: pipelines_running(service, 1))
+        # The parent, beats, syslog, azure, fallback and config_sync pipelines
+        wait_for("processor", lambda: pipelines_running("processor", 6))
+
+        sampler = Sampler([service, "processor"], args.sample_interval)
+        sampler.start()
+        load_args = loadgen.parser().parse_args(["beats", "--port", "5044", "--eps", str(args.eps),
+                                                 "--duration", str(duration), "--connections", str(args.connections)])
+        sent = {}
+        load = threading.Thread(target=lambda: sent.update(loadgen.generate(load_args)), daemon=True)
+        started = time.time()
+        load.start()
+
+        bundles = []
+        for index, (version, extra, _expected) in enumerate(VERSIONS):
+            time.sleep(max(0, started + args.warmup + args.step * index - time.time()))
+            bundles.append(publish(s3, version, extra, args.step))
+            print(json.dumps({k: v for k, v in bundles[-1].items() if k != "published"}), file=sys.stderr)
+        load.join()
+        finished = time.time()
+
+        drained = wait_for("processor to drain", lambda: sampler.samples["processor"][-1]["events_in"] >= sampler.samples[service][-1]["events_out"]
+                           and sampler.samples["processor"][-1]["time"] > finished, timeout=args.drain_timeout, required=False)
+        sampler.stop()
+        compose("stop", "-t", "120", "processor")
+        delivered, tags = read_tags(s3)
+    finally:
+        if not args.keep:
+            compose("down", "-v", "--remove-orphans")
+
+    for entry in bundles:
+        entry["published_after_seconds"] = round(entry.pop("published") - started, 1)
+    result = {
+        "name": args.name or f"reload-{int(args.eps)}",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "images": image_ids(),
+        "config": {
+            "target_eps": args.eps, "step_seconds": args.step, "warmup_seconds": args.warmup, "connections": args.connections,
+            "processor_cpus": args.processor_cpus, "heap": args.heap, "interval_seconds": args.interval
+        },
+        "load": sent,
+        "bundles": bundles,
+        "bundles_as_expected": all(entry["result"] == expected for entry, (_v, _e, expected) in zip(bundles, VERSIONS)),
+        "drained": drained,
+        "delivered_events": delivered,
+        "dropped_events": sent["events_sent"] - delivered,
+        "tagged_events": tags,
+        "containers": {s: summarise_container(sampler.samples[s], started, finished) for s in (service, "processor")}
+    }
+
+    os.makedirs(RESULTS, exist_ok=True)
+    path = os.path.join(RESULTS, f"{result['name']}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps(result, indent=2))
+    print(f"Wrote {path}", file=sys.stderr)
+    if not result["bundles_as_expected"] or result["dropped_events"] > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""Seeds a local minio with an archive of Logstash objects and replays it into a localstack Kinesis stream.
+
+Writes `--files` gzip json_lines objects of winlogbeat events for each of `--hosts` hosts in each
+of `--hours` hours, laid out like the beats s3 output, then runs the replayer in src/docker/replay
+against them once for each of `--workers`, and reads the stream back to check every event arrived.
+
+    docker compose up -d localstack minio
+    python3 replay.py --hosts 50 --hours 2 --files 10 --events 200 --workers 1 4 16 --shards 4
+
+Without --max-mib-per-second the rate limit is the shards' full write capacity, so the results show
+what the workers can reach; with it, how closely the limiter holds replay to a share of the stream.
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "docker", "replay"))
+
+import boto3
+import loadgen
+from botocore.config import Config
+from replayer import ReplayConfig, run
+
+MINIO = "http://localhost:9000"
+LOCALSTACK = "http://localhost:4566"
+BUCKET = "bench-replay"
+STREAM = "bench-replay"
+
+
+def seed(client, args, now):
+    rng = random.Random(1)
+    seq = 0
+    size = 0
+    for hour_offset in range(1, args.hours + 1):
+        hour = (now - timedelta(hours=hour_offset)).replace(minute=0, second=0, microsecond=0)
+        for host in range(args.hosts):
+            prefix = (f"beat=winlogbeat/version=7.6.2/name=WKS{host:05d}/log_name=Security/"
+                      f"year={hour:%Y}/month={hour:%m}/day={hour:%d}/hour={hour:%H}/")
+            for part in range(args.files):
+                lines = []
+                for i in range(args.events):
+                    event = loadgen.beat_event(rng, seq)
+                    event.pop("@metadata")
+                    lines.append(json.dumps(event))
+                    seq += 1
+                body = gzip.compress(("\n".join(lines) + "\n").encode())
+                client.put_object(Bucket=BUCKET, Key=f"{prefix}ls.s3.{part:05d}.txt.gz", Body=body)
+                size += len(body)
+    return seq, size
+
+
+def reset_stream(kinesis, shards):
+    try:
+        kinesis.delete_stream(StreamName=STREAM, EnforceConsumerDeletion=True)
+        kinesis.get_waiter("stream_not_exists").wait(StreamName=STREAM)
+    except kinesis.exceptions.ResourceNotFoundException:
+        pass
+    kinesis.create_stream(StreamName=STREAM, ShardCount=shards)
+    kinesis.get_waiter("stream_exists").wait(StreamName=STREAM)
+
+
+def count_records(kinesis):
+    """Reads every shard from the start, and returns the records and how many were restored and tagged for the processor."""
+    records = restored = 0
+    for shard in kinesis.list_shards(StreamName=STREAM)["Shards"]:
+        iterator = kinesis.get_shard_iterator(StreamName=STREAM, ShardId=shard["ShardId"], ShardIteratorType="TRIM_HORIZON")["ShardIterator"]
+        while iterator:
+            page = kinesis.get_records(ShardIterator=iterator, Limit=10000)
+            for record in page["Records"]:
+                event = json.loads(record["Data"])
+                records += 1
+                if event.get("original_metadata", {}).get("beat") == "winlogbeat" and "replayed" in event.get("tags", []):
+                    restored += 1
+            if not page["Records"] and page.get("MillisBehindLatest", 0) == 0:
+                break
+            iterator = page.get("NextShardIterator")
+    return records, restored
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hosts", type=int, default=50)
+    parser.add_argument("--hours", type=int, default=2)
+    parser.add_argument("--files", type=int, default=10, help="Objects per host per hour")
+    parser.add_argument("--events", type=int, default=200, help="Events per object")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--max-mib-per-second", type=float, help="Replay rate limit; defaults to the shards' write capacity")
+    parser.add_argument("--s3-endpoint", default=MINIO)
+    parser.add_argument("--kinesis-endpoint", default=LOCALSTACK)
+    args = parser.parse_args()
+
+    os.environ.update({"AWS_ACCESS_KEY_ID": "bench", "AWS_SECRET_ACCESS_KEY": "benchbench", "AWS_DEFAULT_REGION": "us-east-1"})
+    s3 = boto3.client("s3", endpoint_url=args.s3_endpoint, config=Config(s3={"addressing_style": "path"}))
+    kinesis = boto3.client("kinesis", endpoint_url=args.kinesis_endpoint)
+    try:
+        s3.create_bucket(Bucket=BUCKET)
+    except s3.exceptions.BucketAlreadyOwnedByYou:
+        pass
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=BUCKET):
+        keys = [{"Key": item["Key"]} for item in page.get("Contents", [])]
+        if keys:
+            s3.delete_objects(Bucket=BUCKET, Delete={"Objects": keys, "Quiet": True})
+
+    now = datetime.now(timezone.utc)
+    events, bytes_in = seed(s3, args, now)
+    print(f"Seeded {args.hosts * args.hours * args.files} objects, {bytes_in / 2 ** 20:.1f} MiB, {events} events", file=sys.stderr)
+
+    # The shards' write capacity, or the share of it in --max-mib-per-second
+    share = min(1.0, args.max_mib_per_second / args.shards) if args.max_mib_per_second else 1.0
+    max_bytes = args.shards * 2 ** 20 * share
+    max_records = args.shards * 1000 * share
+    results = []
+    for workers in args.workers:
+        reset_stream(kinesis, args.shards)
+        config = ReplayConfig(buckets=[BUCKET], stream_name=STREAM, workers=workers, max_bytes_per_second=max_bytes, max_records_per_second=max_records,
+                              s3_endpoint=args.s3_endpoint, kinesis_endpoint=args.kinesis_endpoint)
+        started = time.monotonic()
+        totals = run(config)
+        elapsed = time.monotonic() - started
+        records, restored = count_records(kinesis)
+        results.append({
+            "workers": workers,
+            "events_per_second": round(totals["records"] / elapsed, 1),
+            "mib_per_second": round(totals["bytes"] / elapsed / 2 ** 20, 2),
+            "limit_mib_per_second": round(max_bytes / 2 ** 20, 2),
+            "throttled": totals["throttled"],
+            "seconds": round(elapsed, 1),
+            "events_in": events,
+            "records_out": records,
+            "complete": records == events and restored == events and totals["failed"] == 0
+        })
+        print(json.dumps(results[-1]), file=sys.stderr)
+
+    json.dump({"events": events, "mib_in": round(bytes_in / 2 ** 20, 1), "shards": args.shards, "results": results}, sys.stdout, indent=2)
+    print()
+    if not all(r["complete"] for r in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,479 @@
+#!/usr/bin/env python3
+"""End-to-end throughput and latency benchmark for the logstash-in and logstash-out images.
+
+Brings up docker-compose.yml (localstack for Kinesis/DynamoDB, minio for S3, the real images),
+drives one inbound service with loadgen.py and writes a JSON result with sustained EPS,
+end-to-end latency percentiles and CPU/heap per container.
+
+    python3 run.py run --source syslog --eps 2000 --duration 120
+    python3 run.py run --source beats --eps 5000 --env PIPELINE_BEATS_WORKERS=2 --name beats-2-workers
+    python3 run.py compare results/baseline.json results/beats-2-workers.json --tolerance 10
+
+Requires docker with the compose plugin and boto3 (see requirements.txt).
+"""
+import argparse
+import gzip
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+import loadgen
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DOCKER = os.path.join(HERE, "..", "docker")
+WORK = os.path.join(HERE, ".work")
+RESULTS = os.path.join(HERE, "results")
+COMPOSE = os.environ.get("COMPOSE_CMD", "docker compose").split() + ["-p", "telemetry-bench", "-f", os.path.join(HERE, "docker-compose.yml")]
+
+STREAM_NAME = "bench-queue"
+BUCKETS = ["bench-beats", "bench-catchall", "bench-azuread"]
+LOCALSTACK = "http://localhost:4566"
+MINIO = "http://localhost:9000"
+MOCK_HEC = "http://localhost:8088"
+
+# Inbound service, loadgen source and port for each scenario
+SOURCES = {
+    "syslog": ("syslog-in", "syslog", 5514, False),
+    "syslog-udp": ("syslog-udp-in", "syslog", 5516, True),
+    "beats": ("beats-in", "beats", 5044, False),
+    "azure": ("azure-in", "azure", 5600, False)
+}
+
+# Stands in for the Event Hubs input, so the rest of 40-azure_event_hubs.conf runs unchanged
+AZURE_BENCH_INPUT = """input {
+    tcp {
+        port => 5600
+        tags => ["azure_event_hubs"]
+        type => azure_event_hubs
+    }
+}
+"""
+
+# With --splunk, tags every beats event for the splunk_hec output, ahead of 30-beats.conf's own filters
+SPLUNK_BENCH_FILTER = """filter {
+    mutate {
+        add_tag => [ "splunk" ]
+    }
+"""
+
+# Appended to each outbound child pipeline; measures how long an event took from loadgen to its S3 output
+LATENCY_FILTER = """
+filter {
+    ruby {
+        code => '
+            value = event.get("message") || event.get("[event_data][benchTs]")
+            if value.is_a?(String) && (m = value.match(/bench_ts=(\\d{13})/))
+                event.set("[bench][latency_ms]", (Time.now.to_f * 1000).to_i - m[1].to_i)
+            end
+        '
+    }
+}
+"""
+
+
+def compose(*args, check=True, capture=False):
+    return subprocess.run(COMPOSE + list(args), check=check, text=True,
+                          stdout=subprocess.PIPE if capture else None)
+
+
+def strip_pipeline(pipelines_yml, pipeline_id):
+    """Removes a pipeline entry from pipelines.yml."""
+    return re.sub(r"- pipeline\.id: {0}\n(?:  .*\n?)*\n?".format(re.escape(pipeline_id)), "", pipelines_yml)
+
+
+def uncomment_samples(text, pattern):
+    """Uncomments the sample lines (`# ...`) that match pattern."""
+    return re.sub(pattern, lambda m: re.sub(r"(?m)^(\s*)# ?", r"\1", m.group(0)), text)
+
+
+def prepare(overrides, splunk=False):
+    """Copies the image pipelines into .work with the AWS endpoints pointed at localstack and minio.
+
+    Only connection settings are changed, so the filters being measured are the ones that ship.
+    With `splunk`, every beats event is also sent to the mock HEC endpoint.
+    """
+    shutil.rmtree(WORK, ignore_errors=True)
+
+    # Inbound
+    src = os.path.join(DOCKER, "logstash-in")
+    dst = os.path.join(WORK, "logstash-in", "pipeline")
+    os.makedirs(dst)
+    for name in os.listdir(os.path.join(src, "pipelines")):
+        with open(os.path.join(src, "pipelines", name)) as f:
+            conf = f.read()
+        if name.startswith("40-azure"):
+            conf = AZURE_BENCH_INPUT + conf[conf.index("\nfilter"):]
+        conf = conf.replace(
+            'kinesis_endpoint => "${KINESIS_ENDPOINT}"',
+            'kinesis_endpoint => "${KINESIS_ENDPOINT}"\n        kinesis_port => 4566\n        verify_certificate => false\n        metrics_level => "none"')
+        conf = re.sub(r'(\n(\s*)bucket => .*\n)',
+                      r'\1\2endpoint => "http://minio:9000"\n\2additional_settings => { "force_path_style" => true }\n', conf)
+        with open(os.path.join(dst, name), "w") as f:
+            f.write(conf)
+    with open(os.path.join(src, "config", "pipelines.yml")) as f:
+        pipelines_yml = f.read()
+    # run.py reads the same node stats as the healthcheck pipelines from the API, so leave them out
+    with open(os.path.join(WORK, "logstash-in", "pipelines.yml"), "w") as f:
+        f.write(strip_pipeline(pipelines_yml, "healthcheck"))
+
+    # Outbound, with the syslog and Azure sample pipelines switched on
+    src = os.path.join(DOCKER, "logstash-out")
+    dst = os.path.join(WORK, "logstash-out", "pipeline")
+    os.makedirs(dst)
+    for name in os.listdir(os.path.join(src, "pipelines")):
+        with open(os.path.join(src, "pipelines", name)) as f:
+            conf = f.read()
+        conf = conf.replace(
+            'kinesis_endpoint => "${KINESIS_ENDPOINT}"',
+            'kinesis_endpoint => "${KINESIS_ENDPOINT}"\n            dynamo_db_endpoint => "http://localstack:4566"')
+        conf = re.sub(r'(\n(\s*)bucket => .*\n)',
+                      r'\1\2endpoint => "http://minio:9000"\n\2additional_settings => { "force_path_style" => true }\n', conf)
+        if name == "00-parent.conf":
+            conf = uncomment_samples(conf, r"(?m)^\s*# \} else if .*\n(?:^\s*#.*send_to.*\n)")
+        elif not name.startswith("05-"):
+            conf += LATENCY_FILTER
+        if splunk and name == "30-beats.conf":
+            conf = conf.replace("filter {\n", SPLUNK_BENCH_FILTER, 1)
+        with open(os.path.join(dst, name), "w") as f:
+            f.write(conf)
+    with open(os.path.join(src, "config", "pipelines.yml")) as f:
+        pipelines_yml = f.read()
+    pipelines_yml = uncomment_samples(pipelines_yml, r"(?m)^# - pipeline\.id: .*\n(?:^#   .*\n)*")
+    with open(os.path.join(WORK, "logstash-out", "pipelines.yml"), "w") as f:
+        f.write(strip_pipeline(pipelines_yml, "healthcheck"))
+
+    with open(os.path.join(WORK, "overrides.env"), "w") as f:
+        f.write("".join(f"{key}={value}\n" for key, value in overrides.items()))
+
+
+def aws_clients():
+    import boto3
+    credentials = {"region_name": "us-east-1", "aws_access_key_id": "bench", "aws_secret_access_key": "benchbench"}
+    return (boto3.client("kinesis", endpoint_url=LOCALSTACK, **credentials),
+            boto3.client("s3", endpoint_url=MINIO, **credentials))
+
+
+def wait_for(description, check, timeout=300, required=True):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if check():
+                return True
+        except Exception:
+            pass
+        time.sleep(2)
+    if required:
+        raise Exception(f"Timed out waiting for {description}")
+    return False
+
+
+def create_resources(kinesis, s3, shards):
+    wait_for("localstack", lambda: kinesis.list_streams() is not None)
+    wait_for("minio", lambda: s3.list_buckets() is not None)
+    kinesis.create_stream(StreamName=STREAM_NAME, ShardCount=shards)
+    wait_for("stream", lambda: kinesis.describe_stream_summary(StreamName=STREAM_NAME)["StreamDescriptionSummary"]["StreamStatus"] == "ACTIVE")
+    for bucket in BUCKETS:
+        s3.create_bucket(Bucket=bucket)
+
+
+def hec_stats():
+    from urllib.request import urlopen
+    with urlopen(f"{MOCK_HEC}/stats", timeout=10) as response:
+        return json.load(response)
+
+
+def container_id(service):
+    return compose("ps", "-q", service, capture=True).stdout.strip()
+
+
+def node_stats(service):
+    """Returns Logstash's _node/stats from inside the container, or None if the API is not up yet."""
+    result = subprocess.run(["docker", "exec", container_id(service), "curl", "-s", "localhost:9600/_node/stats/jvm,events,pipelines"],
+                            text=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if result.returncode != 0 or not result.stdout:
+        return None
+    return json.loads(result.stdout)
+
+
+def pipelines_running(service, count):
+    stats = node_stats(service)
+    return stats is not None and len(stats.get("pipelines", {})) >= count
+
+
+def pipeline_events(node):
+    """Returns events in and out of a container, ignoring the hops between its own pipelines.
+
+    For logstash-in that is the ingress pipeline. For logstash-out it is what the parent pipeline read
+    from Kinesis, and what the child pipelines passed to their outputs (after Azure batches are split).
+    """
+    pipelines = node["pipelines"]
+    if "logstash-ingress" in pipelines:
+        events = pipelines["logstash-ingress"]["events"]
+        return {"events_in": events["in"], "events_out": events["out"]}
+    return {
+        "events_in": pipelines["parent"]["events"]["in"],
+        "events_out": sum(p["events"]["out"] for i, p in pipelines.items() if i != "parent")
+    }
+
+
+def parse_size(value):
+    units = {"B": 1, "KB": 1e3, "MB": 1e6, "GB": 1e9, "KIB": 1024, "MIB": 1024 ** 2, "GIB": 1024 ** 3}
+    match = re.match(r"([\d.]+)\s*([A-Za-z]+)", value)
+    return float(match.group(1)) * units.get(match.group(2).upper(), 1) if match else 0.0
+
+
+class Sampler(threading.Thread):
+    """Samples docker stats and Logstash node stats for the services under test."""
+    def __init__(self, services, interval):
+        super().__init__(daemon=True)
+        self.services = services
+        self.interval = interval
+        self.samples = {service: [] for service in services}
+        self.stopped = threading.Event()
+
+    def run(self):
+        ids = {container_id(service): service for service in self.services}
+        while not self.stopped.is_set():
+            started = time.time()
+            stats = subprocess.run(["docker", "stats", "--no-stream", "--format", "{{json .}}"] + list(ids),
+                                   text=True, stdout=subprocess.PIPE).stdout
+            docker = {}
+            for line in stats.splitlines():
+                row = json.loads(line)
+                service = next((s for i, s in ids.items() if i.startswith(row["ID"])), None)
+                if service:
+                    docker[service] = row
+            for service in self.services:
+                node = node_stats(service)
+                if node is None or service not in docker:
+                    continue
+                self.samples[service].append({
+                    "time": started,
+                    "cpu_percent": float(docker[service]["CPUPerc"].rstrip("%")),
+                    "memory_bytes": parse_size(docker[service]["MemUsage"].split("/")[0]),
+                    "heap_used_bytes": node["jvm"]["mem"]["heap_used_in_bytes"],
+                    "heap_max_bytes": node["jvm"]["mem"]["heap_max_in_bytes"],
+                    **pipeline_events(node)
+                })
+            self.stopped.wait(max(0, self.interval - (time.time() - started)))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def summarise_container(samples, window_start, window_end):
+    window = [s for s in samples if window_start <= s["time"] <= window_end]
+    if len(window) < 2:
+        return {"samples": len(window)}
+    elapsed = window[-1]["time"] - window[0]["time"]
+    return {
+        "samples": len(window),
+        "events_in_per_second": round((window[-1]["events_in"] - window[0]["events_in"]) / elapsed, 1),
+        "events_out_per_second": round((window[-1]["events_out"] - window[0]["events_out"]) / elapsed, 1),
+        "cpu_percent_mean": round(statistics.mean(s["cpu_percent"] for s in window), 1),
+        "cpu_percent_max": round(max(s["cpu_percent"] for s in window), 1),
+        "memory_bytes_max": int(max(s["memory_bytes"] for s in window)),
+        "heap_used_bytes_mean": int(statistics.mean(s["heap_used_bytes"] for s in window)),
+        "heap_used_bytes_max": max(s["heap_used_bytes"] for s in window),
+        "heap_max_bytes": window[-1]["heap_max_bytes"]
+    }
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def read_delivered(s3):
+    """Returns the latency of every benchmark event archived to S3."""
+    latencies = []
+    for bucket in BUCKETS:
+        for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket):
+            for obj in page.get("Contents", []):
+                body = s3.get_object(Bucket=bucket, Key=obj["Key"])["Body"].read()
+                for line in gzip.decompress(body).splitlines():
+                    latency = json.loads(line).get("bench", {}).get("latency_ms")
+                    if latency is not None:
+                        latencies.append(latency)
+    return latencies
+
+
+def image_ids():
+    ids = {}
+    for image in ("logstash-in", "logstash-out"):
+        result = subprocess.run(["docker", "image", "inspect", "--format", "{{.Id}}", f"telemetry-bench/{image}:{os.environ.get('IMAGE_TAG', 'local')}"],
+                                text=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        ids[image] = result.stdout.strip() or None
+    return ids
+
+
+def run(args):
+    service, source, port, udp = SOURCES[args.source]
+    overrides = dict(item.split("=", 1) for item in args.env)
+    if args.splunk:
+        overrides.setdefault("SPLUNK_HEC_URL", "http://mock-hec:8088")
+        overrides.setdefault("SPLUNK_HEC_TOKEN_SECRET", "bench")
+    prepare(overrides, args.splunk)
+    os.environ.update({
+        "INBOUND_CPUS": str(args.inbound_cpus),
+        "PROCESSOR_CPUS": str(args.processor_cpus),
+        "LS_HEAP": args.heap,
+        "HEC_LATENCY_MS": str(args.hec_latency_ms),
+        "HEC_FAIL_RATE": str(args.hec_fail_rate)
+    })
+
+    compose("down", "-v", "--remove-orphans")
+    try:
+        compose("up", "-d", "localstack", "minio", *(["mock-hec"] if args.splunk else []))
+        kinesis, s3 = aws_clients()
+        create_resources(kinesis, s3, args.shards)
+        compose("up", "-d", *([] if args.build else ["--no-build"]), service, "processor")
+        # logstash-in runs the ingress pipeline; logstash-out the parent, beats, syslog, azure and fallback pipelines
+        wait_for(service, lambda: pipelines_running(service, 1))
+        wait_for("processor", lambda: pipelines_running("processor", 5))
+
+        sampler = Sampler([service, "processor"], args.sample_interval)
+        sampler.start()
+        load_args = loadgen.parser().parse_args([source, "--port", str(port), "--eps", str(args.eps),
+                                                 "--duration", str(args.warmup + args.duration),
+                                                 "--connections", str(args.connections), "--format", args.format]
+                                                + (["--udp"] if udp else []))
+        started = time.time()
+        sent = loadgen.generate(load_args)
+        finished = time.time()
+
+        # Let the processor catch up before stopping it; stopping flushes the S3 outputs' pending files
+        drained = wait_for("processor to drain", lambda: sampler.samples["processor"][-1]["events_in"] >= sampler.samples[service][-1]["events_out"]
+                           and sampler.samples["processor"][-1]["time"] > finished, timeout=args.drain_timeout, required=False)
+        sampler.stop()
+        compose("stop", "-t", "120", "processor")
+        latencies = read_delivered(s3)
+        splunk = hec_stats() if args.splunk else None
+    finally:
+        if not args.keep:
+            compose("down", "-v", "--remove-orphans")
+
+    window = (started + args.warmup, finished)
+    containers = {s: summarise_container(sampler.samples[s], *window) for s in (service, "processor")}
+    result = {
+        "name": args.name or f"{args.source}-{int(args.eps)}",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "images": image_ids(),
+        "config": {
+            "source": args.source, "format": args.format, "target_eps": args.eps, "connections": args.connections,
+            "duration_seconds": args.duration, "warmup_seconds": args.warmup, "shards": args.shards,
+            "inbound_cpus": args.inbound_cpus, "processor_cpus": args.processor_cpus, "heap": args.heap,
+            "splunk": args.splunk, "env": overrides
+        },
+        "load": sent,
+        # What the whole chain kept up with: the processor's output rate once warmed up
+        "sustained_eps": containers["processor"].get("events_out_per_second"),
+        "drained": drained,
+        "delivered_events": len(latencies),
+        "delivered_ratio": round(len(latencies) / sent["events_sent"], 4) if sent["events_sent"] else None,
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies) if latencies else None
+        },
+        "containers": containers
+    }
+    if splunk:
+        # What the mock HEC endpoint received; with keep-alive, connections stay close to the output's max_in_flight
+        result["splunk"] = splunk
+
+    os.makedirs(RESULTS, exist_ok=True)
+    path = os.path.join(RESULTS, f"{result['name']}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps(result, indent=2))
+    print(f"Wrote {path}", file=sys.stderr)
+
+
+def compare(args):
+    """Prints the change in the headline numbers and fails if the candidate regressed beyond the tolerance."""
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    # (label, getter, higher is better)
+    metrics = [
+        ("sustained_eps", lambda r: r["sustained_eps"], True),
+        ("delivered_ratio", lambda r: r["delivered_ratio"], True),
+        ("latency_p50_ms", lambda r: r["latency_ms"]["p50"], False),
+        ("latency_p99_ms", lambda r: r["latency_ms"]["p99"], False)
+    ]
+    for role in sorted(set(baseline["containers"]) & set(candidate["containers"])):
+        metrics.append((f"{role}_cpu_percent_mean", lambda r, role=role: r["containers"][role].get("cpu_percent_mean"), False))
+        metrics.append((f"{role}_heap_used_bytes_max", lambda r, role=role: r["containers"][role].get("heap_used_bytes_max"), False))
+
+    regressions = []
+    print(f"{'metric':<36}{'baseline':>16}{'candidate':>16}{'change':>10}")
+    for label, get, higher_is_better in metrics:
+        old, new = get(baseline), get(candidate)
+        if old is None or new is None or old == 0:
+            print(f"{label:<36}{str(old):>16}{str(new):>16}{'n/a':>10}")
+            continue
+        change = (new - old) / old * 100
+        print(f"{label:<36}{old:>16}{new:>16}{change:>9.1f}%")
+        worse = -change if higher_is_better else change
+        if label in args.gate and worse > args.tolerance:
+            regressions.append(label)
+
+    if regressions:
+        print(f"Regressed by more than {args.tolerance}%: {', '.join(regressions)}", file=sys.stderr)
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("run", help="Run one benchmark scenario")
+    p.add_argument("--source", choices=sorted(SOURCES), default="syslog")
+    p.add_argument("--format", choices=["rfc3164", "rfc5424"], default="rfc3164", help="Syslog message format")
+    p.add_argument("--eps", type=float, default=1000, help="Target events per second")
+    p.add_argument("--duration", type=float, default=120, help="Measured seconds, after the warmup")
+    p.add_argument("--warmup", type=float, default=30, help="Seconds of load before measuring, while the JIT warms up")
+    p.add_argument("--connections", type=int, default=1)
+    p.add_argument("--shards", type=int, default=1)
+    p.add_argument("--inbound-cpus", type=float, default=1, help="CPU limit for the inbound container, like a Fargate task's vCPUs")
+    p.add_argument("--processor-cpus", type=float, default=1)
+    p.add_argument("--heap", default="1g", help="Logstash -Xms/-Xmx")
+    p.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                   help="Extra environment for the Logstash containers, e.g. PIPELINE_BEATS_WORKERS=2 or KINESIS_AGGREGATION_ENABLED=true")
+    p.add_argument("--splunk", action="store_true", help="Also send every beats event to a mock Splunk HEC endpoint (mock_hec.py)")
+    p.add_argument("--hec-latency-ms", type=int, default=0, help="With --splunk, how long the mock endpoint takes to answer")
+    p.add_argument("--hec-fail-rate", type=float, default=0.0, help="With --splunk, the share of requests the mock endpoint fails")
+    p.add_argument("--sample-interval", type=float, default=5)
+    p.add_argument("--drain-timeout", type=float, default=300)
+    p.add_argument("--name", help="Result name, defaults to <source>-<eps>")
+    p.add_argument("--build", action="store_true", help="Rebuild the images before running")
+    p.add_argument("--keep", action="store_true", help="Leave the containers running afterwards")
+    p.set_defaults(func=run)
+
+    p = commands.add_parser("compare", help="Compare two results")
+    p.add_argument("baseline")
+    p.add_argument("candidate")
+    p.add_argument("--tolerance", type=float, default=10, help="Allowed regression in percent")
+    p.add_argument("--gate", nargs="+", default=["sustained_eps", "latency_p99_ms"], help="Metrics that fail the comparison when they regress")
+    p.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""Measures how long a new Logstash container takes to be ready and to accept its first event.
+
+Builds the images once for each of `--modes` (the Dockerfiles' STARTUP_MODE build argument, see
+src/docker/*/scripts/optimise_startup.sh), then starts one service `--runs` times for each and
+records the seconds from `docker compose up` until:
+
+    ready         scripts/ready.sh passes, as the ECS container health check would
+    first_event   the service accepted an event: a syslog line counted in, a beats window acked,
+                  or a Kinesis record read by the processor's parent pipeline
+
+    python3 startup.py --service syslog-in --modes standard optimised --runs 5
+    python3 startup.py --service processor --cpus 2 --heap 2g
+
+The medians are what a service's `readiness` start and grace periods in cdk.context.json need to
+cover, with some headroom.
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import loadgen
+from run import (RESULTS, STREAM_NAME, aws_clients, compose, container_id, create_resources, node_stats, percentile,
+                 pipeline_events, prepare)
+
+# The port a probe event is sent to, for each service
+SERVICES = {
+    "syslog-in": 5514,
+    "beats-in": 5044,
+    "processor": None
+}
+STATE_TABLE = "bench-state"
+POLL_SECONDS = 0.5
+
+
+def ready(service):
+    return subprocess.run(["docker", "exec", container_id(service), "/usr/share/logstash/scripts/ready.sh"],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+
+def events_in(service):
+    stats = node_stats(service)
+    if stats is None or not stats.get("pipelines"):
+        return 0
+    try:
+        return pipeline_events(stats)["events_in"]
+    except KeyError:
+        # The pipeline that counts events in hasn't started yet
+        return 0
+
+
+def send_probe(service, kinesis, rng, seq):
+    """Sends one event to the service; returns True once it has been accepted."""
+    if service == "syslog-in":
+        with socket.create_connection(("localhost", SERVICES[service]), timeout=2) as sock:
+            sock.sendall((loadgen.rfc3164(rng, seq) + "\n").encode())
+        return events_in(service) > 0
+    if service == "beats-in":
+        # Only acked once the events are in the pipeline's queue
+        client = loadgen.LumberjackClient("localhost", SERVICES[service])
+        client.sock.settimeout(2)
+        try:
+            client.send([loadgen.beat_event(rng, seq)])
+        finally:
+            client.sock.close()
+        return True
+    # The KCL starts reading at the latest record, so keep writing until the processor reads one
+    kinesis.put_record(StreamName=STREAM_NAME, PartitionKey=str(seq), Data=json.dumps({"message": f"startup probe {seq}", "type": "syslog"}))
+    return events_in(service) > 0
+
+
+def reset_state(dynamodb):
+    """Deletes the KCL lease table, so a new processor doesn't wait for the last one's leases to expire."""
+    try:
+        dynamodb.delete_table(TableName=STATE_TABLE)
+        dynamodb.get_waiter("table_not_exists").wait(TableName=STATE_TABLE)
+    except dynamodb.exceptions.ResourceNotFoundException:
+        pass
+
+
+def measure(service, kinesis, timeout):
+    rng = random.Random(1)
+    seq = 0
+    timings = {"ready": None, "first_event": None}
+    started = time.monotonic()
+    compose("up", "-d", "--no-build", service)
+    while time.monotonic() - started < timeout and None in timings.values():
+        elapsed = round(time.monotonic() - started, 1)
+        if timings["ready"] is None and ready(service):
+            timings["ready"] = elapsed
+        if timings["first_event"] is None:
+            seq += 1
+            try:
+                if send_probe(service, kinesis, rng, seq):
+                    timings["first_event"] = round(time.monotonic() - started, 1)
+            except OSError:
+                # Refused, or closed by the port mapping before Logstash listens
+                pass
+        time.sleep(POLL_SECONDS)
+    compose("rm", "-s", "-f", service)
+    return timings
+
+
+def summarise(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    return {"median": statistics.median(values), "p90": percentile(values, 90), "max": max(values)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--service", choices=sorted(SERVICES), default="syslog-in")
+    parser.add_argument("--modes", nargs="+", choices=["standard", "optimised"], default=["standard", "optimised"])
+    parser.add_argument("--runs", type=int, default=5, help="Cold starts measured for each mode")
+    parser.add_argument("--cpus", type=float, default=1, help="CPU limit for the container, like a Fargate task's vCPUs")
+    parser.add_argument("--heap", default="1g", help="Logstash -Xms/-Xmx")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds to wait for each start")
+    parser.add_argument("--no-build", dest="build", action="store_false", help="Use images already built for each mode")
+    parser.add_argument("--name", help="Result name, defaults to startup-<service>")
+    args = parser.parse_args()
+
+    prepare({})
+    os.environ.update({
+        "INBOUND_CPUS": str(args.cpus),
+        "PROCESSOR_CPUS": str(args.cpus),
+        "LS_HEAP": args.heap
+    })
+    compose("down", "-v", "--remove-orphans")
+    results = {}
+    try:
+        compose("up", "-d", "localstack", "minio")
+        kinesis, s3 = aws_clients()
+        create_resources(kinesis, s3, 1)
+        dynamodb = None
+        if args.service == "processor":
+            import boto3
+            dynamodb = boto3.client("dynamodb", endpoint_url="http://localhost:4566", region_name="us-east-1",
+                                    aws_access_key_id="bench", aws_secret_access_key="benchbench")
+
+        for mode in args.modes:
+            os.environ.update({"STARTUP_MODE": mode, "IMAGE_TAG": f"local-{mode}"})
+            if args.build:
+                compose("build", args.service)
+            runs = []
+            for index in range(args.runs):
+                if dynamodb is not None:
+                    reset_state(dynamodb)
+                runs.append(measure(args.service, kinesis, args.timeout))
+                print(json.dumps({"mode": mode, "run": index + 1, **runs[-1]}), file=sys.stderr)
+            results[mode] = {
+                "runs": runs,
+                "ready_seconds": summarise([r["ready"] for r in runs]),
+                "first_event_seconds": summarise([r["first_event"] for r in runs])
+            }
+    finally:
+        compose("down", "-v", "--remove-orphans")
+
+    result = {
+        "name": args.name or f"startup-{args.service}",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": {"service": args.service, "runs": args.runs, "cpus": args.cpus, "heap": args.heap},
+        "modes": results
+    }
+    os.makedirs(RESULTS, exist_ok=True)
+    path = os.path.join(RESULTS, f"{result['name']}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps(result, indent=2))
+    print(f"Wrote {path}", file=sys.stderr)
+    if any(r["first_event_seconds"] is None for r in results.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
 import json
 from aws_cdk import core
+from tools.capacity import check_context
 from tools.context import get_context
+from stacks.compaction.stack import CompactionStack
 from stacks.ecr import ECRStack
 from stacks.inbound.stack import LogstashInStack
 from stacks.outbound.stack import LogstashOutStack
 from stacks.queue.stack import LogstashQueueStack
+from stacks.replay.stack import ReplayStack
 
 app = core.App()
 ctx = get_context(app.node)
@@ -26,12 +29,24 @@ logstash_in_ecr = ECRStack(
     env = env_core
 )
 
+# The syslog relay has its own image, only needed when a relay service is configured
+relay_ecr = None
+if getattr(ctx.inbound.services, "relay", None) is not None:
+    relay_ecr = ECRStack(
+        scope = app,
+        id = f"{ctx.stage}-telemetry-syslog-relay-ecr",
+        description = "Telemetry: ECR for the syslog relay",
+        env = env_core
+    )
+
 logstash_in = LogstashInStack(
     scope = app,
     id = f"{ctx.stage}-telemetry-logstash-in",
     ctx = ctx,
     ecr_repository = logstash_in_ecr.ecr_repository,
-    kinesis_stream = logstash_queue.kinesis_stream,
+    kinesis_streams = logstash_queue.kinesis_streams,
+    staging_bucket = logstash_queue.staging_bucket,
+    relay_ecr_repository = relay_ecr.ecr_repository if relay_ecr else None,
     description = "Telemetry: Logstash for inbound pipeline",
     env = env_core
 )
@@ -48,10 +63,57 @@ logstash_out = LogstashOutStack(
     id = f"{ctx.stage}-telemetry-logstash-out",
     ctx = ctx,
     ecr_repository = logstash_out_ecr.ecr_repository,
-    kinesis_stream = logstash_queue.kinesis_stream,
-    state_table = logstash_queue.state_table,
+    kinesis_streams = logstash_queue.kinesis_streams,
+    state_tables = logstash_queue.state_tables,
+    max_shard_counts = logstash_queue.max_shard_counts,
+    staging_bucket = logstash_queue.staging_bucket,
     description = "Telemetry: Logstash for outbound pipeline",
     env = env_core
 )
 
+# Compaction of the S3 archive is optional, and has its own image
+if getattr(ctx, "compaction", None) is not None:
+    compactor_ecr = ECRStack(
+        scope = app,
+        id = f"{ctx.stage}-telemetry-compactor-ecr",
+        description = "Telemetry: ECR for the S3 archive compactor",
+        env = env_core
+    )
+
+    compaction = CompactionStack(
+        scope = app,
+        id = f"{ctx.stage}-telemetry-compaction",
+        ctx = ctx,
+        ecr_repository = compactor_ecr.ecr_repository,
+        description = "Telemetry: Scheduled compaction of the S3 archive",
+        env = env_core
+    )
+
+# Replay of the S3 archive into the queue is optional, and has its own image
+if getattr(ctx, "replay", None) is not None:
+    replay_ecr = ECRStack(
+        scope = app,
+        id = f"{ctx.stage}-telemetry-replay-ecr",
+        description = "Telemetry: ECR for the S3 archive replayer",
+        env = env_core
+    )
+
+    replay = ReplayStack(
+        scope = app,
+        id = f"{ctx.stage}-telemetry-replay",
+        ctx = ctx,
+        ecr_repository = replay_ecr.ecr_repository,
+        kinesis_streams = logstash_queue.kinesis_streams,
+        description = "Telemetry: On-demand replay of the S3 archive into the queue",
+        env = env_core
+    )
+
+# Report where the expected load, from the services' capacity nodes, won't fit the context
+stacks = {"queue": logstash_queue, "inbound": logstash_in, "outbound": logstash_out}
+for finding in check_context(ctx):
+    if finding.level == "error":
+        stacks[finding.scope].node.add_error(finding.message)
+    else:
+        stacks[finding.scope].node.add_warning(finding.message)
+
 app.synth()
\ No newline at end of file
@@ -0,0 +1,160 @@
+from aws_cdk import (
+    core,
+    aws_ec2 as ec2,
+    aws_ecs as ecs,
+    aws_ecr as ecr,
+    aws_events as events,
+    aws_events_targets as events_targets,
+    aws_iam as iam,
+    aws_logs as cwl,
+    )
+from tools.streams import get_processors
+
+
+class CompactionStack(core.Stack):
+
+    def __init__(self, scope: core.Construct, id: str, ctx: object, ecr_repository: ecr.Repository, **kwargs) -> None:
+        super().__init__(scope, id, **kwargs)
+        self.ecr_repository = ecr_repository
+        service_name = "compactor"
+        ctx_compaction = ctx.compaction
+
+        self.vpc = ec2.Vpc.from_vpc_attributes(
+            self, "VPC",
+            **ctx.vpc_props.dict()
+        )
+
+        # CloudWatch Logs Group
+        self.log_group = cwl.LogGroup(
+            scope = self,
+            id = "logs"
+        )
+
+        # The compactor only runs on a schedule, so its cluster has no services
+        self.cluster = ecs.Cluster(
+            self,
+            vpc = self.vpc,
+            id = f"{id}_cluster"
+        )
+
+        # Create a role for ECS to interact with AWS APIs with standard permissions
+        self.ecs_exec_role = iam.Role(
+            scope = self,
+            id = "ecs_compactor-exec_role",
+            assumed_by = iam.ServicePrincipal("ecs-tasks.amazonaws.com"),
+            managed_policies = ([
+                iam.ManagedPolicy.from_aws_managed_policy_name(
+                    "service-role/AmazonECSTaskExecutionRolePolicy")
+            ])
+        )
+        # Grant ECS permissions to log to our log group
+        self.log_group.grant_write(self.ecs_exec_role)
+
+        # Create a task role to grant permissions for the compactor to read and write the archive
+        ecs_task_role = iam.Role(
+            scope = self,
+            id = f"{service_name}_task_role",
+            assumed_by = iam.ServicePrincipal("ecs-tasks.amazonaws.com")
+        )
+        buckets = self.__get_buckets(ctx, ctx_compaction)
+        bucket_resources = []
+        for bucket in buckets:
+            bucket_resources.append('arn:aws:s3:::{0}'.format(bucket))
+            bucket_resources.append('arn:aws:s3:::{0}/*'.format(bucket))
+        actions = [
+            "s3:GetObject",
+            "s3:PutObject",
+            "s3:ListBucket",
+            "s3:ListMultipartUploadParts",
+            "s3:AbortMultipartUpload",
+            # Removes the compactor's own files when a partition fails part way through, and sources when delete_sources is set
+            "s3:DeleteObject"
+            ]
+        ecs_task_role.add_to_policy(
+            iam.PolicyStatement(
+                actions = actions,
+                effect = iam.Effect.ALLOW,
+                resources = bucket_resources
+            ))
+
+        # Task Definition
+        task_definition = ecs.FargateTaskDefinition(
+            scope = self,
+            id = f"{service_name}_task_definition",
+            cpu = ctx_compaction.size.cpu,
+            memory_limit_mib = ctx_compaction.size.ram,
+            execution_role = self.ecs_exec_role,
+            task_role = ecs_task_role,
+        )
+
+        log_driver = ecs.LogDriver.aws_logs(
+            log_group = self.log_group,
+            stream_prefix = service_name)
+
+        # Container Definition
+        container = ecs.ContainerDefinition(
+            scope = self,
+            id = f"{service_name}_container_definition",
+            task_definition = task_definition,
+            image = ecs.ContainerImage.from_ecr_repository(self.ecr_repository, "latest"),
+            logging = log_driver,
+            environment = self.__get_container_environment(ctx, ctx_compaction, buckets)
+        )
+
+        security_group = ec2.SecurityGroup(
+            scope = self,
+            id = f"{service_name}_sg",
+            vpc = self.vpc
+        )
+
+        # Run one task on the schedule; it compacts every closed hour it finds, so a missed run is caught up by the next
+        schedule = events.Rule(
+            scope = self,
+            id = f"{service_name}_schedule",
+            schedule = events.Schedule.expression(getattr(ctx_compaction, "schedule", "cron(20 * * * ? *)"))
+        )
+        schedule.add_target(
+            events_targets.EcsTask(
+                cluster = self.cluster,
+                task_definition = task_definition,
+                task_count = 1,
+                security_group = security_group,
+                subnet_selection = ec2.SubnetSelection(subnet_type = ec2.SubnetType.PRIVATE)
+            ))
+
+    # Method to choose the buckets to compact; by default every archive bucket the processors write to
+    def __get_buckets(self, ctx, ctx_compaction):
+        buckets = getattr(ctx_compaction, "buckets", None)
+        if buckets:
+            return buckets
+        buckets = []
+        for processor in get_processors(ctx).values():
+            for k, v in getattr(processor.ctx_srv, "variables", {}).items():
+                if k.endswith("_log_bucket") and v not in buckets:
+                    buckets.append(v)
+        return buckets
+
+    def __get_container_environment(self, ctx, ctx_compaction, buckets):
+        ram = ctx_compaction.size.ram
+        # Each worker holds about one row group of input, several times over once it is parsed and converted
+        row_group_mb = getattr(ctx_compaction, "row_group_mb", 64)
+        default_workers = max(1, min(ctx_compaction.size.cpu // 1024 * 2, ram // (row_group_mb * 6)))
+        container_environment = {
+            "ENV_STAGE": ctx.stage,
+            "AWS_REGION": ctx.aws_region,
+            "COMPACT_BUCKETS": ",".join(buckets),
+            "COMPACT_FORMAT": getattr(ctx_compaction, "format", "parquet"),
+            "COMPACT_COLUMNS": ",".join(getattr(ctx_compaction, "columns", [])),
+            "COMPACT_OUTPUT_PREFIX": getattr(ctx_compaction, "output_prefix", "compacted/"),
+            "COMPACT_WORKERS": str(getattr(ctx_compaction, "workers", default_workers)),
+            "COMPACT_GRACE_MINUTES": str(getattr(ctx_compaction, "grace_minutes", 15)),
+            "COMPACT_LOOKBACK_HOURS": str(getattr(ctx_compaction, "lookback_hours", 48)),
+            "COMPACT_TARGET_FILE_MB": str(getattr(ctx_compaction, "target_file_mb", 256)),
+            "COMPACT_ROW_GROUP_MB": str(row_group_mb),
+            "COMPACT_DELETE_SOURCES": str(getattr(ctx_compaction, "delete_sources", False)).lower(),
+            "COMPACT_METRICS_NAMESPACE": f"Telemetry/{ctx.stage}"
+            }
+        if hasattr(ctx_compaction, "variables"):
+            for k, v in ctx_compaction.variables.items():
+                container_environment[k.upper()] = v
+        return container_environment
@@ -10,16 +10,30 @@ from aws_cdk import (
     aws_servicediscovery as awssd,
     aws_route53 as r53,
     aws_route53_targets as r53_targets,
+    aws_s3 as s3,
     aws_secretsmanager as sm,
     aws_kinesis as ks
     )
+from tools.capacity import jvm_memory, native_mib
+from tools.claim_check import get_claim_check
+from tools.config_sync import bundle_key, get_config_sync
+from tools.pipelines import get_pipeline_vars, INBOUND_PIPELINES
+from tools.placement import place_services, DEFAULT_GROUP
+from tools.readiness import get_readiness
+from tools.streams import service_stream
 
 
 class LogstashInStack(core.Stack):
 
-    def __init__(self, scope: core.Construct, id: str, ctx: object, ecr_repository: ecr.Repository, kinesis_stream: ks.Stream, **kwargs) -> None:
+    def __init__(self, scope: core.Construct, id: str, ctx: object, ecr_repository: ecr.Repository, kinesis_streams: dict, staging_bucket: s3.Bucket = None, relay_ecr_repository: ecr.Repository = None, **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
         self.ecr_repository = ecr_repository
+        self.relay_ecr_repository = relay_ecr_repository
+        self.cloudmap_namespace = None
+        # Cloud Map services by name, for relay services to send to
+        self.cloudmap_services = {}
+        # Created by the first service with a config_sync node
+        self.config_bucket = None
 
         self.vpc = ec2.Vpc.from_vpc_attributes(
             self, "VPC",
@@ -32,20 +46,18 @@ class LogstashInStack(core.Stack):
             id = "logs"
         )
 
-        self.kinesis_stream = kinesis_stream
+        # Streams by name; each service writes to the one it names, or to the single stream (see tools/streams.py)
+        self.kinesis_streams = kinesis_streams
+        # Where events too large for a Kinesis record are staged, with queue.claim_check (see tools/claim_check.py)
+        self.staging_bucket = staging_bucket
+
+        # Which load balancer and cluster each service goes on; fails the synth on a port conflict
+        self.placement = place_services(ctx)
+        self.clusters = {}
+        self.load_balancers = {}
 
         # Create a new ECS cluster for our services
-        self.cluster = ecs.Cluster(
-            self,
-            vpc = self.vpc,
-            id = f"{id}_cluster"
-        )
-        cluster_name_output = core.CfnOutput(
-            scope=self,
-            id="cluster-name-out",
-            value=self.cluster.cluster_name,
-            export_name=f"{id}-cluster-name"
-        )
+        self.cluster = self.__get_cluster(DEFAULT_GROUP)
 
         # Create a role for ECS to interact with AWS APIs with standard permissions
         self.ecs_exec_role = iam.Role(
@@ -70,13 +82,7 @@ class LogstashInStack(core.Stack):
 
 
         # Load Balancer for Listening Services
-        self.load_balancer = elb2.NetworkLoadBalancer(
-            scope = self,
-            id = f"{id}-nlb",
-            vpc = self.vpc,
-            internet_facing = False,
-            cross_zone_enabled = True
-        )
+        self.load_balancer = self.__get_load_balancer(DEFAULT_GROUP)
 
         # Create listener services
         service_names = []
@@ -92,6 +98,11 @@ class LogstashInStack(core.Stack):
             self.__create_pull_service(service_name[0], ctx)
             service_names.append(service_name[0])
 
+        # Relays send to cloudmap services, so are created after them
+        for service_name in getattr(ctx.inbound.services, "relay", []):
+            self.__create_relay_service(service_name[0], ctx)
+            service_names.append(service_name[0])
+
         service_names_output = core.CfnOutput(
             scope=self,
             id="service-names-out",
@@ -99,11 +110,70 @@ class LogstashInStack(core.Stack):
             export_name=f"{id}-service-names"
         )
 
+    # Method to create an ECS cluster for a placement group the first time a service is placed in it
+    def __get_cluster(self, group: str):
+        if group not in self.clusters:
+            # The default group keeps the IDs and export from before services could be placed
+            prefix = "" if group == DEFAULT_GROUP else f"{group}-"
+            cluster = ecs.Cluster(
+                self,
+                vpc = self.vpc,
+                id = f"{self.stack_name}_cluster" if group == DEFAULT_GROUP else f"{self.stack_name}_{group}_cluster"
+            )
+            core.CfnOutput(
+                scope = self,
+                id = f"{prefix}cluster-name-out",
+                value = cluster.cluster_name,
+                export_name = f"{self.stack_name}-{prefix}cluster-name"
+            )
+            self.clusters[group] = cluster
+        return self.clusters[group]
+
+    # Method to create a network load balancer for a placement group the first time a service is placed on it
+    def __get_load_balancer(self, group: str):
+        if group not in self.load_balancers:
+            prefix = "" if group == DEFAULT_GROUP else f"{group}-"
+            load_balancer = elb2.NetworkLoadBalancer(
+                scope = self,
+                id = f"{self.stack_name}-{prefix}nlb",
+                vpc = self.vpc,
+                internet_facing = False,
+                cross_zone_enabled = True
+            )
+            # Senders need to know which load balancer their service is on
+            core.CfnOutput(
+                scope = self,
+                id = f"{prefix}nlb-dns-name-out",
+                value = load_balancer.load_balancer_dns_name,
+                export_name = f"{self.stack_name}-{prefix}nlb-dns-name"
+            )
+            self.load_balancers[group] = load_balancer
+        return self.load_balancers[group]
+
+    # Method to create the versioned bucket that services' config bundles are published to, the first time a service syncs from it
+    def __get_config_bucket(self) -> s3.Bucket:
+        if self.config_bucket is None:
+            self.config_bucket = s3.Bucket(
+                scope = self,
+                id = "config_bucket",
+                versioned = True,
+                encryption = s3.BucketEncryption.S3_MANAGED,
+                block_public_access = s3.BlockPublicAccess.BLOCK_ALL,
+                removal_policy = core.RemovalPolicy.RETAIN
+            )
+            core.CfnOutput(
+                scope = self,
+                id = "config-bucket-out",
+                value = self.config_bucket.bucket_name,
+                export_name = f"{self.stack_name}-config-bucket"
+            )
+        return self.config_bucket
+
     # Method to create a new Fargate service behind an existing load balancer
     def __create_nlb_service(self, service_name: str, ctx: object):
         ctx_srv = getattr(ctx.inbound.services.nlb, service_name)
 
-        ecs_task_role = self.__create_default_task_role(service_name)
+        ecs_task_role = self.__create_default_task_role(service_name, ctx_srv, self.__get_stream(service_name, ctx, ctx_srv))
 
         log_driver = ecs.LogDriver.aws_logs(
             log_group = self.log_group,
@@ -138,11 +208,11 @@ class LogstashInStack(core.Stack):
             scope = self,
             id = f"{service_name}_service",
             task_definition = task_definition,
-            cluster = self.cluster,
+            cluster = self.__get_cluster(self.placement.clusters[service_name]),
             desired_count = getattr(ctx_srv, "desired_count", ctx.default_desired_count),
             service_name = service_name,
             security_group = security_group,
-            health_check_grace_period = core.Duration.minutes(10)
+            health_check_grace_period = self.__get_grace_period(service_name, ctx_srv)
         )
 
         # map ports on the container
@@ -155,7 +225,7 @@ class LogstashInStack(core.Stack):
                 )
             )
             # add a listener to network load balancer
-            listener = self.load_balancer.add_listener(
+            listener = self.__get_load_balancer(self.placement.load_balancers[service_name]).add_listener(
                 id = f"{service_name}_{port}",
                 port = port
             )
@@ -191,7 +261,7 @@ class LogstashInStack(core.Stack):
     def __create_cloudmap_service(self, service_name: str, ctx: object):
         ctx_srv = getattr(ctx.inbound.services.cloudmap, service_name)
 
-        ecs_task_role = self.__create_default_task_role(service_name)
+        ecs_task_role = self.__create_default_task_role(service_name, ctx_srv, self.__get_stream(service_name, ctx, ctx_srv))
 
         log_driver = ecs.LogDriver.aws_logs(
             log_group = self.log_group,
@@ -226,7 +296,7 @@ class LogstashInStack(core.Stack):
             scope = self,
             id = f"{service_name}_service",
             task_definition = task_definition,
-            cluster = self.cluster,
+            cluster = self.__get_cluster(self.placement.clusters[service_name]),
             desired_count = getattr(ctx_srv, "desired_count", ctx.default_desired_count),
             service_name = service_name,
             security_group = security_group
@@ -270,22 +340,130 @@ class LogstashInStack(core.Stack):
             scale_out_cooldown = core.Duration.seconds(ctx_srv.scaling.scale_out_cooldown_seconds)
         )
 
-        cloudmap = awssd.PublicDnsNamespace.from_public_dns_namespace_attributes(
+        cloudmap_service = service.enable_cloud_map(
+            cloud_map_namespace = self.__get_cloudmap_namespace(ctx),
+            dns_record_type = awssd.DnsRecordType("A"),
+            dns_ttl = core.Duration.seconds(15)
+        )
+        self.cloudmap_services[service_name] = (cloudmap_service, security_group)
+
+    # Method to import the existing Cloud Map namespace once, however many services register in it
+    def __get_cloudmap_namespace(self, ctx: object):
+        if self.cloudmap_namespace is None:
+            self.cloudmap_namespace = awssd.PublicDnsNamespace.from_public_dns_namespace_attributes(
+                scope = self,
+                id = "cloudmap_namespace",
+                **ctx.inbound.namespace_props.dict()
+            )
+        return self.cloudmap_namespace
+
+    # Method to create a syslog relay behind the load balancer, which spreads messages across the tasks of a cloudmap service
+    def __create_relay_service(self, service_name: str, ctx: object):
+        ctx_srv = getattr(ctx.inbound.services.relay, service_name)
+        if ctx_srv.backend not in self.cloudmap_services:
+            raise Exception(f"Relay service '{service_name}' sends to '{ctx_srv.backend}', which must be a cloudmap service")
+        if self.relay_ecr_repository is None:
+            raise Exception(f"Relay service '{service_name}' needs a relay ECR repository")
+        backend_service, backend_security_group = self.cloudmap_services[ctx_srv.backend]
+        backend_port = getattr(ctx_srv, "backend_port", ctx_srv.ports[0])
+
+        log_driver = ecs.LogDriver.aws_logs(
+            log_group = self.log_group,
+            stream_prefix = service_name)
+
+        # The relay makes no AWS API calls, so uses the default task role
+        task_definition = ecs.FargateTaskDefinition(
             scope = self,
-            id = f"cloudmap_namespace",
-            **ctx.inbound.namespace_props.dict()
+            id = f"{service_name}_task_definition",
+            cpu = ctx_srv.size.cpu,
+            memory_limit_mib = ctx_srv.size.ram,
+            execution_role = self.ecs_exec_role
         )
 
-        service.enable_cloud_map(
-            cloud_map_namespace = cloudmap,
-            dns_record_type = awssd.DnsRecordType("A"),
-            dns_ttl = core.Duration.seconds(15)
+        container_environment = {
+            "RELAY_PORTS": ",".join(str(port) for port in ctx_srv.ports),
+            "RELAY_BACKEND_PORT": str(backend_port),
+            "RELAY_BACKEND_DNS_NAME": f"{backend_service.service_name}.{ctx.inbound.namespace_props.namespace_name}",
+            "RELAY_DISPATCH": getattr(ctx_srv, "dispatch", "least_loaded"),
+            "RELAY_CONNECTION_BUFFER": str(getattr(ctx_srv, "connection_buffer", 1000)),
+            "RELAY_BACKEND_BUFFER": str(getattr(ctx_srv, "backend_buffer", 5000))
+            }
+        if hasattr(ctx_srv, "variables"):
+            for k, v in ctx_srv.variables.items():
+                container_environment[k.upper()] = v
+        container = ecs.ContainerDefinition(
+            scope = self,
+            id = f"{service_name}_container_definition",
+            task_definition = task_definition,
+            image = ecs.ContainerImage.from_ecr_repository(self.relay_ecr_repository, "latest"),
+            logging = log_driver,
+            environment = container_environment
+        )
+        security_group = ec2.SecurityGroup(
+            scope = self,
+            id = f"{service_name}_sg",
+            vpc = self.vpc
+        )
+        service = ecs.FargateService(
+            scope = self,
+            id = f"{service_name}_service",
+            task_definition = task_definition,
+            cluster = self.__get_cluster(self.placement.clusters[service_name]),
+            desired_count = getattr(ctx_srv, "desired_count", ctx.default_desired_count),
+            service_name = service_name,
+            security_group = security_group,
+            health_check_grace_period = core.Duration.minutes(2)
+        )
+        backend_security_group.add_ingress_rule(
+            security_group,
+            ec2.Port.tcp(backend_port), f"Syslog from relay {service_name}"
+        )
+
+        for port in ctx_srv.ports:
+            container.add_port_mappings(
+                ecs.PortMapping(
+                    container_port = port,
+                    host_port = port,
+                    protocol = ecs.Protocol.TCP
+                )
+            )
+            listener = self.__get_load_balancer(self.placement.load_balancers[service_name]).add_listener(
+                id = f"{service_name}_{port}",
+                port = port
+            )
+
+            security_group.add_ingress_rule(
+                ec2.Peer.ipv4(ctx.ingress_cidr),
+                ec2.Port.tcp(port), f"Syslog ingress for {service_name}"
+                )
+
+            target = (service).load_balancer_target(
+                container_name = container.container_name,
+                container_port = port
+            )
+
+            listener.add_targets(
+                id = f"{service_name}_{port}_tg",
+                port = port,
+                targets = [target]
+            )
+
+        scaling = service.auto_scale_task_count(
+            max_capacity = ctx_srv.scaling.max_capacity,
+            min_capacity = ctx_srv.scaling.min_capacity
+        )
+
+        scaling.scale_on_cpu_utilization(
+            id = "cpu_scaling",
+            target_utilization_percent = ctx_srv.scaling.target_utilization_percent,
+            scale_in_cooldown = core.Duration.seconds(ctx_srv.scaling.scale_in_cooldown_seconds),
+            scale_out_cooldown = core.Duration.seconds(ctx_srv.scaling.scale_out_cooldown_seconds)
         )
 
     def __create_pull_service(self, service_name: str, ctx: object):
         ctx_srv = getattr(ctx.inbound.services.pull, service_name)
 
-        ecs_task_role = self.__create_default_task_role(service_name)
+        ecs_task_role = self.__create_default_task_role(service_name, ctx_srv, self.__get_stream(service_name, ctx, ctx_srv))
 
         log_driver = ecs.LogDriver.aws_logs(
             log_group = self.log_group,
@@ -320,7 +498,7 @@ class LogstashInStack(core.Stack):
             scope = self,
             id = f"{service_name}_service",
             task_definition = task_definition,
-            cluster = self.cluster,
+            cluster = self.__get_cluster(self.placement.clusters[service_name]),
             desired_count = getattr(ctx_srv, "desired_count", ctx.default_desired_count),
             service_name = service_name,
             security_group = security_group
@@ -345,13 +523,72 @@ class LogstashInStack(core.Stack):
             "ENV_STAGE": ctx.stage,
             "SERVICE_NAME": service_name,
             "DEBUG_OUTPUT": ctx.debug_output,
-            "LS_JAVA_OPTS": "-Xms256m -Xmx{0}m".format(ctx_srv.size.ram - 256),
+            # The kinesis output's KPL daemon, and any config_sync config test, run outside the JVM
+            "LS_JAVA_OPTS": jvm_memory(ctx_srv.size.ram, native_mib("inbound", service_name, ctx_srv)).options(),
             "KINESIS_ENDPOINT": ctx.queue.kinesis_endpoint,
-            "KINESIS_STREAM_NAME": self.kinesis_stream.stream_name,
+            "KINESIS_STREAM_NAME": self.__get_stream(service_name, ctx, ctx_srv).stream_name,
             "AWS_REGION": ctx.aws_region
             }
         container_secrets = {}
 
+        # Size Logstash pipeline workers and batches for the task
+        container_environment.update(get_pipeline_vars(ctx_srv, INBOUND_PIPELINES))
+
+        # Pack many events into each Kinesis record, optionally compressing them first
+        aggregation = getattr(ctx.queue, "aggregation", None)
+        if getattr(aggregation, "enabled", False):
+            container_environment.update({
+                "KINESIS_AGGREGATION_ENABLED": "true",
+                "KINESIS_AGGREGATION_MAX_COUNT": str(getattr(aggregation, "max_count", 4294967295)),
+                "KINESIS_AGGREGATION_MAX_SIZE": str(getattr(aggregation, "max_size_bytes", 51200)),
+                "KINESIS_RECORD_MAX_BUFFERED_TIME": str(getattr(aggregation, "max_buffered_time_ms", 100)),
+                "KINESIS_COMPRESSION": getattr(aggregation, "compression", "none"),
+                "KINESIS_COMPRESSION_MIN_BYTES": str(getattr(aggregation, "compression_min_bytes", 0))
+                })
+
+        # Stage events too large for a Kinesis record in S3, and split Azure batches that would be
+        claim_check = get_claim_check(ctx)
+        if claim_check is not None:
+            container_environment.update({
+                "CLAIM_CHECK_ENABLED": "true",
+                "CLAIM_CHECK_BUCKET": self.staging_bucket.bucket_name,
+                "CLAIM_CHECK_PREFIX": service_name,
+                "CLAIM_CHECK_MAX_BYTES": str(claim_check.max_record_bytes),
+                "AZURE_CHUNK_BYTES": str(claim_check.azure_chunk_bytes)
+                })
+
+        # Choose how events are spread over the shards; random unless the service keeps each source on one shard
+        partitioning = getattr(ctx_srv, "partitioning", None)
+        if partitioning is not None:
+            strategy = getattr(partitioning, "strategy", "random")
+            if strategy not in ("random", "host", "field"):
+                raise Exception(f"Unknown partitioning.strategy '{strategy}' for {service_name}; expected random, host or field")
+            # A key is salted once it uses this share of a shard's 1 MiB/sec write limit through one task
+            hot_key_percent = getattr(partitioning, "hot_key_threshold_percent", 25)
+            container_environment.update({
+                "KINESIS_PARTITIONING": strategy,
+                "KINESIS_PARTITION_FIELDS": ",".join(getattr(partitioning, "fields", [])),
+                "KINESIS_PARTITION_SALT_BUCKETS": str(getattr(partitioning, "salt_buckets", 8)),
+                "KINESIS_PARTITION_HOT_KEY_BYTES_PER_SECOND": str(int(1024 * 1024 * hot_key_percent / 100))
+                })
+
+        # Restore each syslog sender's address from the relays that send to this service
+        relays = getattr(ctx.inbound.services, "relay", [])
+        if any(getattr(relays, relay_name[0]).backend == service_name for relay_name in relays):
+            container_environment["SYSLOG_RELAYED"] = "true"
+
+        # Pick up pipeline config bundles published to S3 while running (see tools/config_sync.py)
+        config_sync = get_config_sync(service_name, ctx_srv)
+        if config_sync is not None:
+            container_environment.update({
+                "CONFIG_SYNC_BUCKET": self.__get_config_bucket().bucket_name,
+                "CONFIG_SYNC_KEY": bundle_key(service_name),
+                "CONFIG_SYNC_INTERVAL_SECONDS": str(config_sync.interval_seconds),
+                "CONFIG_SYNC_VERIFY_SECONDS": str(config_sync.verify_seconds),
+                "CONFIG_SYNC_VALIDATE_HEAP": config_sync.validate_heap,
+                "CONFIG_RELOAD_AUTOMATIC": "true"
+                })
+
         # Get and populate service-specific variables and secrets from context
         if hasattr(ctx_srv, "variables"):
             for k, v in ctx_srv.variables.items():
@@ -372,9 +609,30 @@ class LogstashInStack(core.Stack):
         if container_secrets:
             container_vars["secrets"] = container_secrets
 
+        # Only count the task as started once its pipelines are running
+        readiness = get_readiness(service_name, ctx_srv)
+        if readiness is not None:
+            container_vars["health_check"] = ecs.HealthCheck(
+                command = readiness.command(),
+                interval = core.Duration.seconds(readiness.interval_seconds),
+                timeout = core.Duration.seconds(readiness.timeout_seconds),
+                retries = readiness.retries,
+                start_period = core.Duration.seconds(readiness.start_period_seconds)
+            )
+
         return container_vars
 
-    def __create_default_task_role(self, service_name):
+    # Method to give new tasks time to start their pipelines before load balancer health checks count
+    def __get_grace_period(self, service_name: str, ctx_srv: object) -> core.Duration:
+        readiness = get_readiness(service_name, ctx_srv)
+        if readiness is None:
+            return core.Duration.minutes(10)
+        return core.Duration.seconds(readiness.grace_period_seconds)
+
+    def __get_stream(self, service_name: str, ctx: object, ctx_srv: object) -> ks.Stream:
+        return self.kinesis_streams[service_stream(ctx, service_name, ctx_srv)]
+
+    def __create_default_task_role(self, service_name: str, ctx_srv: object, kinesis_stream: ks.Stream):
         ecs_task_role = iam.Role(
             scope = self,
             id = f"{service_name}_task_role",
@@ -386,6 +644,12 @@ class LogstashInStack(core.Stack):
                 effect = iam.Effect.ALLOW,
                 resources = ["*"]
             ))
-        self.kinesis_stream.grant_write(ecs_task_role)
+        kinesis_stream.grant_write(ecs_task_role)
+        # Add permissions to read the service's config bundle
+        if get_config_sync(service_name, ctx_srv) is not None:
+            self.__get_config_bucket().grant_read(ecs_task_role, bundle_key(service_name))
+        # Add permissions to stage oversized events under the service's prefix
+        if self.staging_bucket is not None:
+            self.staging_bucket.grant_put(ecs_task_role, f"{service_name}/*")
 
         return ecs_task_role
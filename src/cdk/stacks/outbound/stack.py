@@ -1,26 +1,37 @@
 import os
 from aws_cdk import (
     core, 
+    aws_applicationautoscaling as appscaling,
+    aws_cloudwatch as cw,
     aws_dynamodb as ddb,
     aws_ec2 as ec2, 
     aws_ecs as ecs,
     aws_ecr as ecr,
     aws_iam as iam,
     aws_logs as cwl,
+    aws_s3 as s3,
     aws_secretsmanager as sm,
     aws_kinesis as ks,
     )
+from tools.capacity import DEFAULT_DEDUP_MEMORY_MIB, jvm_memory, native_mib
+from tools.claim_check import get_claim_check
+from tools.config_sync import bundle_key, get_config_sync
+from tools.pipelines import get_pipeline_vars, OUTBOUND_PIPELINES
+from tools.readiness import get_readiness
+from tools.streams import get_processors
 
 
 class LogstashOutStack(core.Stack):
 
-    def __init__(self, scope: core.Construct, id: str, ctx: object, ecr_repository: ecr.Repository, kinesis_stream: ks.Stream, state_table: ddb.Table, **kwargs) -> None:
+    def __init__(self, scope: core.Construct, id: str, ctx: object, ecr_repository: ecr.Repository, kinesis_streams: dict, state_tables: dict, max_shard_counts: dict = None, staging_bucket: s3.Bucket = None, **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
         self.ecr_repository = ecr_repository
-        self.kinesis_stream = kinesis_stream
-        self.state_table = state_table
-        service_name = "processor"
-        ctx_srv = getattr(ctx.outbound.services.pull, service_name)
+        # One processor service for each stream in the queue (see tools/streams.py)
+        processors = get_processors(ctx)
+        # Created by the first service with a config_sync node
+        self.config_bucket = None
+        # Where inbound services stage events too large for a Kinesis record, with queue.claim_check (see tools/claim_check.py)
+        self.staging_bucket = staging_bucket
 
         self.vpc = ec2.Vpc.from_vpc_attributes(
             self, "VPC",
@@ -49,7 +60,7 @@ class LogstashOutStack(core.Stack):
         service_names_output = core.CfnOutput(
             scope=self,
             id="service-names-out",
-            value=service_name,
+            value=",".join(processor.name for processor in processors.values()),
             export_name=f"{id}-service-names"
         )
         
@@ -74,6 +85,31 @@ class LogstashOutStack(core.Stack):
         # Grant ECS permissions to log to our log group
         self.log_group.grant_write(self.ecs_exec_role)
 
+        for stream, processor in processors.items():
+            max_shard_count = (max_shard_counts or {}).get(stream)
+            self.__create_processor_service(processor.name, ctx, processor.ctx_srv, kinesis_streams[stream], state_tables[stream], max_shard_count)
+
+    # Method to create the versioned bucket that services' config bundles are published to, the first time a service syncs from it
+    def __get_config_bucket(self) -> s3.Bucket:
+        if self.config_bucket is None:
+            self.config_bucket = s3.Bucket(
+                scope = self,
+                id = "config_bucket",
+                versioned = True,
+                encryption = s3.BucketEncryption.S3_MANAGED,
+                block_public_access = s3.BlockPublicAccess.BLOCK_ALL,
+                removal_policy = core.RemovalPolicy.RETAIN
+            )
+            core.CfnOutput(
+                scope = self,
+                id = "config-bucket-out",
+                value = self.config_bucket.bucket_name,
+                export_name = f"{self.stack_name}-config-bucket"
+            )
+        return self.config_bucket
+
+    # Method to create a processor service that reads one stream, with its own task role, size and scaling
+    def __create_processor_service(self, service_name: str, ctx: object, ctx_srv: object, kinesis_stream: ks.Stream, state_table: ddb.Table, max_shard_count: int):
         # Create a task role to grant permissions for Logstash to interact with AWS APIs
         ecs_task_role = iam.Role(
             scope = self,
@@ -88,34 +124,42 @@ class LogstashOutStack(core.Stack):
                 resources = ["*"]
             ))
         # Add permissions for Logstash to interact with our Kinesis queue
-        self.kinesis_stream.grant_read(ecs_task_role)
+        kinesis_stream.grant_read(ecs_task_role)
         # Remove this when next version of kinesis module is released
         # https://github.com/aws/aws-cdk/pull/6141
         ecs_task_role.add_to_policy(
             iam.PolicyStatement(
                 actions = ["kinesis:ListShards"],
                 effect = iam.Effect.ALLOW,
-                resources = [self.kinesis_stream.stream_arn]
+                resources = [kinesis_stream.stream_arn]
             ))
         # Add permissions for Logstash to store Kinesis Consumer Library (KCL) state tracking in DynamoDB
         state_table.grant_full_access(ecs_task_role)
         # Add permissions for Logstash to upload logs to S3 for archive
         bucket_resources = []
-        for k, v in ctx_srv.variables.items():
+        for k, v in getattr(ctx_srv, "variables", {}).items():
             if k.endswith("_log_bucket"):
                 bucket_resources.append('arn:aws:s3:::{0}'.format(v))
                 bucket_resources.append('arn:aws:s3:::{0}/*'.format(v))
-        ecs_task_role.add_to_policy(
-            iam.PolicyStatement(
-                actions=[
-                    "s3:PutObject",
-                    "s3:ListMultipartUploadParts",
-                    "s3:ListBucket",
-                    "s3:AbortMultipartUpload"
-                    ],
-                effect=iam.Effect.ALLOW,
-                resources=bucket_resources
-            ))
+        if bucket_resources:
+            ecs_task_role.add_to_policy(
+                iam.PolicyStatement(
+                    actions=[
+                        "s3:PutObject",
+                        "s3:ListMultipartUploadParts",
+                        "s3:ListBucket",
+                        "s3:AbortMultipartUpload"
+                        ],
+                    effect=iam.Effect.ALLOW,
+                    resources=bucket_resources
+                ))
+
+        # Add permissions to read the service's config bundle
+        if get_config_sync(service_name, ctx_srv) is not None:
+            self.__get_config_bucket().grant_read(ecs_task_role, bundle_key(service_name))
+        # Add permissions to fetch the events that references in the stream point at
+        if self.staging_bucket is not None:
+            self.staging_bucket.grant_read(ecs_task_role)
 
         # Task Definition
         task_definition = ecs.FargateTaskDefinition(
@@ -132,7 +176,7 @@ class LogstashOutStack(core.Stack):
             stream_prefix = service_name)
         
         # Container Definition
-        container_vars = self.__get_container_vars(service_name, ctx, ctx_srv)
+        container_vars = self.__get_container_vars(service_name, ctx, ctx_srv, kinesis_stream, state_table)
         container = ecs.ContainerDefinition(
             scope = self,
             id = f"{service_name}_container_definition",
@@ -159,8 +203,13 @@ class LogstashOutStack(core.Stack):
             security_group = security_group
         )
 
+        # KCL leases are per shard, so tasks beyond the shard count would sit idle
+        max_capacity = ctx_srv.scaling.max_capacity
+        if max_shard_count is not None:
+            max_capacity = min(max_capacity, max_shard_count)
+
         scaling = service.auto_scale_task_count(
-            max_capacity = ctx_srv.scaling.max_capacity,
+            max_capacity = max_capacity,
             min_capacity = ctx_srv.scaling.min_capacity
         )
 
@@ -171,21 +220,127 @@ class LogstashOutStack(core.Stack):
             scale_out_cooldown = core.Duration.seconds(ctx_srv.scaling.scale_out_cooldown_seconds),
         )
 
-    def __get_container_vars(self, service_name, ctx, ctx_srv):
+        if hasattr(ctx_srv.scaling, "lag"):
+            self.__scale_on_lag(scaling, kinesis_stream, ctx_srv.scaling.lag)
+
+    # Method to scale the processor on how far behind the Kinesis stream it is, as it's often I/O bound rather than CPU bound
+    def __scale_on_lag(self, scaling: object, kinesis_stream: ks.Stream, ctx_lag: object):
+        cooldown = core.Duration.seconds(getattr(ctx_lag, "cooldown_seconds", 300))
+
+        # Step scaling on the age of the oldest record read from the stream. Like the backlog policy below, it
+        # only adds tasks: a step policy scales in alone whenever its alarm fires, so it would fight the CPU
+        # policy in the steady state, and removing tasks is left to the CPU policy
+        iterator_age = cw.Metric(
+            namespace = "AWS/Kinesis",
+            metric_name = "GetRecords.IteratorAgeMilliseconds",
+            dimensions = {"StreamName": kinesis_stream.stream_name},
+            statistic = "Maximum",
+            period = core.Duration.minutes(1)
+        )
+        iterator_age_steps = [
+            appscaling.ScalingInterval(
+                upper = min(step.seconds for step in ctx_lag.iterator_age_steps) * 1000,
+                change = 0
+            )
+        ]
+        for step in ctx_lag.iterator_age_steps:
+            iterator_age_steps.append(
+                appscaling.ScalingInterval(
+                    lower = step.seconds * 1000,
+                    change = step.change
+                )
+            )
+        scaling.scale_on_metric(
+            id = "iterator_age_scaling",
+            metric = iterator_age,
+            scaling_steps = iterator_age_steps,
+            adjustment_type = appscaling.AdjustmentType.CHANGE_IN_CAPACITY,
+            cooldown = cooldown
+        )
+
+        # Step scaling on records arriving faster than they are read, which catches a growing backlog before the iterator age does
+        if hasattr(ctx_lag, "backlog_records_per_minute"):
+            def kinesis_sum(metric_name):
+                return cw.Metric(
+                    namespace = "AWS/Kinesis",
+                    metric_name = metric_name,
+                    dimensions = {"StreamName": kinesis_stream.stream_name},
+                    statistic = "Sum",
+                    period = core.Duration.minutes(1)
+                )
+            backlog_growth = cw.MathExpression(
+                expression = "incoming - processed",
+                using_metrics = {
+                    "incoming": kinesis_sum("IncomingRecords"),
+                    "processed": kinesis_sum("GetRecords.Records")
+                },
+                label = "Backlog growth (records/minute)",
+                period = core.Duration.minutes(1)
+            )
+            scaling.scale_on_metric(
+                id = "backlog_scaling",
+                metric = backlog_growth,
+                scaling_steps = [
+                    appscaling.ScalingInterval(upper = 0, change = 0),
+                    appscaling.ScalingInterval(lower = ctx_lag.backlog_records_per_minute, change = 1)
+                ],
+                adjustment_type = appscaling.AdjustmentType.CHANGE_IN_CAPACITY,
+                cooldown = cooldown
+            )
+
+    def __get_container_vars(self, service_name, ctx, ctx_srv, kinesis_stream, state_table):
         # Prepare container defaults
         container_vars = {}
         container_environment = {
             "ENV_STAGE": ctx.stage,
             "SERVICE_NAME": service_name,
             "DEBUG_OUTPUT": ctx.debug_output,
-            "LS_JAVA_OPTS": "-Xms256m -Xmx{0}m".format(ctx_srv.size.ram - 256),
+            # Any config_sync config test runs outside the JVM
+            "LS_JAVA_OPTS": jvm_memory(ctx_srv.size.ram, native_mib("outbound", service_name, ctx_srv)).options(),
             "KINESIS_ENDPOINT": ctx.queue.kinesis_endpoint,
-            "KINESIS_STREAM_NAME": self.kinesis_stream.stream_name,
+            "KINESIS_STREAM_NAME": kinesis_stream.stream_name,
             "AWS_REGION": ctx.aws_region,
-            "DYNAMODB_STATE_TABLE_NAME": self.state_table.table_name
+            "DYNAMODB_STATE_TABLE_NAME": state_table.table_name
             }
         container_secrets = {}
 
+        # Size Logstash pipeline workers and batches for the task
+        container_environment.update(get_pipeline_vars(ctx_srv, OUTBOUND_PIPELINES))
+
+        # Drop events the task has already seen, within a memory budget on its heap
+        dedup = getattr(ctx_srv, "dedup", None)
+        if dedup is not None:
+            mode = getattr(dedup, "mode", "cache")
+            if mode not in ("cache", "bloom"):
+                raise Exception(f"Unknown dedup.mode '{mode}' for {service_name}; expected cache or bloom")
+            action = getattr(dedup, "action", "drop")
+            if action not in ("drop", "tag"):
+                raise Exception(f"Unknown dedup.action '{action}' for {service_name}; expected drop or tag")
+            container_environment.update({
+                "DEDUP_ENABLED": "true",
+                "DEDUP_MODE": mode,
+                "DEDUP_ACTION": action,
+                "DEDUP_MEMORY_MIB": str(getattr(dedup, "memory_mib", DEFAULT_DEDUP_MEMORY_MIB)),
+                "DEDUP_TTL_SECONDS": str(getattr(dedup, "ttl_seconds", 600)),
+                "DEDUP_FIELDS": ",".join(getattr(dedup, "fields", []))
+                })
+
+        # Fetch the events that inbound services staged in S3 in place of their references
+        if get_claim_check(ctx) is not None:
+            container_environment["CLAIM_CHECK_BUCKET"] = self.staging_bucket.bucket_name
+
+        # Pick up pipeline config bundles published to S3 while running (see tools/config_sync.py)
+        config_sync = get_config_sync(service_name, ctx_srv)
+        if config_sync is not None:
+            container_environment.update({
+                "CONFIG_SYNC_BUCKET": self.__get_config_bucket().bucket_name,
+                "CONFIG_SYNC_KEY": bundle_key(service_name),
+                "CONFIG_SYNC_INTERVAL_SECONDS": str(config_sync.interval_seconds),
+                "CONFIG_SYNC_VERIFY_SECONDS": str(config_sync.verify_seconds),
+                "CONFIG_SYNC_VALIDATE_HEAP": config_sync.validate_heap,
+                "CONFIG_RELOAD_AUTOMATIC": "true"
+                })
+
         # Get and populate service-specific variables and secrets from context
         if hasattr(ctx_srv, "variables"):
             for k, v in ctx_srv.variables.items():
@@ -194,7 +349,7 @@ class LogstashOutStack(core.Stack):
             for k, v in ctx_srv.secrets.items():
                 sm_secret = sm.Secret.from_secret_arn(
                     scope = self, 
-                    id = f"{k}-secret", 
+                    id = f"{service_name}-{k}-secret", 
                     secret_arn = v
                 )
                 ecs_secret = ecs.Secret.from_secrets_manager(sm_secret)                    
@@ -206,4 +361,15 @@ class LogstashOutStack(core.Stack):
         if container_secrets:
             container_vars["secrets"] = container_secrets
 
+        # Only count the task as started once its pipelines are running
+        readiness = get_readiness(service_name, ctx_srv)
+        if readiness is not None:
+            container_vars["health_check"] = ecs.HealthCheck(
+                command = readiness.command(),
+                interval = core.Duration.seconds(readiness.interval_seconds),
+                timeout = core.Duration.seconds(readiness.timeout_seconds),
+                retries = readiness.retries,
+                start_period = core.Duration.seconds(readiness.start_period_seconds)
+            )
+
         return container_vars
\ No newline at end of file
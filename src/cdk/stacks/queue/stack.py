@@ -1,25 +1,263 @@
 import os
 from aws_cdk import (
     core,
+    aws_cloudwatch as cw,
+    aws_cloudwatch_actions as cw_actions,
     aws_dynamodb as ddb,
-    aws_kinesis as ks
+    aws_events as events,
+    aws_events_targets as events_targets,
+    aws_iam as iam,
+    aws_kinesis as ks,
+    aws_lambda as lambda_,
+    aws_s3 as s3,
+    aws_sns as sns,
+    aws_sns_subscriptions as sns_subs
     )
+from tools.claim_check import get_claim_check
+from tools.streams import DEFAULT_STREAM, stream_context, stream_names
 
 class LogstashQueueStack(core.Stack):
 
     def __init__(self, scope: core.Construct, id: str, ctx: object, **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
 
-        # Kinesis Data Stream for telemetry buffer
-        self.kinesis_stream = ks.Stream(
+        # Kinesis Data Streams for telemetry buffer, one unless the queue is split by source group (see tools/streams.py),
+        # each with the DynamoDB table its processor's Kinesis Client Library (KCL) keeps its leases in
+        self.kinesis_streams = {}
+        self.state_tables = {}
+        # The most shards each stream can have, which limits how far its consumers can usefully scale out
+        self.max_shard_counts = {}
+        for stream in stream_names(ctx):
+            self.__create_stream(ctx, stream)
+
+        # The single stream, or None when the queue is split
+        self.kinesis_stream = self.kinesis_streams.get(DEFAULT_STREAM)
+        self.state_table = self.state_tables.get(DEFAULT_STREAM)
+        self.max_shard_count = self.max_shard_counts.get(DEFAULT_STREAM)
+
+        # Optional dedicated consumers for enhanced fan-out (SubscribeToShard), each with its own 2 MB/sec per shard
+        self.stream_consumers = {}
+        ctx_fan_out = getattr(ctx.queue, "enhanced_fan_out", None)
+        if ctx_fan_out is not None:
+            if self.kinesis_stream is None:
+                raise Exception("queue.enhanced_fan_out needs the single stream; it can't be used with queue.streams")
+            self.__create_stream_consumers(id, ctx_fan_out)
+
+        # Optional bucket that inbound services stage events too large for a Kinesis record in (see tools/claim_check.py)
+        self.staging_bucket = None
+        claim_check = get_claim_check(ctx)
+        if claim_check is not None:
+            self.__create_staging_bucket(id, claim_check)
+
+    # Method to create the bucket for oversized events, which expires them once every reference to them has left the stream
+    def __create_staging_bucket(self, id: str, claim_check: object):
+        self.staging_bucket = s3.Bucket(
+            scope = self,
+            id = "staging_bucket",
+            encryption = s3.BucketEncryption.S3_MANAGED,
+            block_public_access = s3.BlockPublicAccess.BLOCK_ALL,
+            lifecycle_rules = [s3.LifecycleRule(expiration = core.Duration.days(claim_check.retention_days))],
+            removal_policy = core.RemovalPolicy.RETAIN
+        )
+        core.CfnOutput(
+            scope = self,
+            id = "staging-bucket-out",
+            value = self.staging_bucket.bucket_name,
+            export_name = f"{id}-staging-bucket"
+        )
+
+    # Method to create a stream, its state table and its optional shard scaling and skew detection
+    def __create_stream(self, ctx: object, stream: str):
+        ctx_stream = stream_context(ctx, stream)
+        # The single stream keeps the IDs from before the queue could be split
+        suffix = "" if stream == DEFAULT_STREAM else f"_{stream}"
+        node_path = "queue" if stream == DEFAULT_STREAM else f"queue.streams.{stream}"
+
+        kinesis_stream = ks.Stream(
             scope = self,
-            id = "logstash_queue",
-            shard_count = ctx.queue.kinesis_shard_count
+            id = f"logstash_queue{suffix}",
+            shard_count = ctx_stream.kinesis_shard_count
         )
-        self.state_table = ddb.Table(
+        self.kinesis_streams[stream] = kinesis_stream
+        self.state_tables[stream] = ddb.Table(
             scope = self,
-            id = "logstash_state",
+            id = f"logstash_state{suffix}",
             partition_key = ddb.Attribute(name="leaseKey", type=ddb.AttributeType.STRING),
             billing_mode=ddb.BillingMode.PAY_PER_REQUEST,
             removal_policy=core.RemovalPolicy.DESTROY
         )
+
+        # Optional shard scaling, either Kinesis on-demand capacity or our own shard controller
+        ctx_scaling = getattr(ctx_stream, "scaling", None)
+        scaling_mode = getattr(ctx_scaling, "mode", "fixed")
+        self.max_shard_counts[stream] = ctx_stream.kinesis_shard_count
+        if scaling_mode == "on_demand":
+            self.max_shard_counts[stream] = None
+            cfn_stream = kinesis_stream.node.default_child
+            cfn_stream.add_property_override("StreamModeDetails.StreamMode", "ON_DEMAND")
+            cfn_stream.add_property_deletion_override("ShardCount")
+        elif scaling_mode == "auto":
+            self.max_shard_counts[stream] = ctx_scaling.max_shard_count
+            self.__create_shard_controller(kinesis_stream, suffix, ctx_scaling)
+        elif scaling_mode != "fixed":
+            raise Exception(f"Unknown {node_path}.scaling.mode '{scaling_mode}'; expected fixed, auto or on_demand")
+
+        # Optional report of how evenly writes are spread over the shards, for services that partition by source
+        ctx_skew = getattr(ctx.queue, "skew_detection", None)
+        if ctx_skew is not None:
+            self.__create_skew_detection(ctx, kinesis_stream, suffix, ctx_skew)
+
+    # Method to create a Lambda that publishes per-shard write skew from the stream's shard-level metrics
+    def __create_skew_detection(self, ctx: object, kinesis_stream: ks.Stream, suffix: str, ctx_skew: object):
+        evaluation_interval_minutes = getattr(ctx_skew, "evaluation_interval_minutes", 5)
+        detector = lambda_.Function(
+            scope = self,
+            id = f"shard_skew{suffix}",
+            runtime = lambda_.Runtime.PYTHON_3_8,
+            handler = "index.handler",
+            code = lambda_.Code.from_asset(os.path.join(os.path.dirname(__file__), "..", "..", "..", "lambda", "shard_skew")),
+            timeout = core.Duration.minutes(1),
+            environment = {
+                "STREAM_NAME": kinesis_stream.stream_name,
+                "METRICS_NAMESPACE": f"Telemetry/{ctx.stage}/Queue",
+                "PERIOD_MINUTES": str(evaluation_interval_minutes),
+                "SKEW_THRESHOLD": str(getattr(ctx_skew, "skew_threshold", 2)),
+                "MIN_UTILIZATION_PERCENT": str(getattr(ctx_skew, "min_utilization_percent", 25))
+            }
+        )
+        detector.add_to_role_policy(
+            iam.PolicyStatement(
+                actions = [
+                    "kinesis:DescribeStreamSummary",
+                    "kinesis:ListShards",
+                    # Shard-level IncomingBytes is off by default; the Lambda turns it on the first time it runs
+                    "kinesis:EnableEnhancedMonitoring"
+                    ],
+                effect = iam.Effect.ALLOW,
+                resources = [kinesis_stream.stream_arn]
+            ))
+        detector.add_to_role_policy(
+            iam.PolicyStatement(
+                actions = ["cloudwatch:GetMetricData"],
+                effect = iam.Effect.ALLOW,
+                resources = ["*"]
+            ))
+
+        schedule = events.Rule(
+            scope = self,
+            id = f"shard_skew_schedule{suffix}",
+            schedule = events.Schedule.rate(core.Duration.minutes(evaluation_interval_minutes))
+        )
+        schedule.add_target(events_targets.LambdaFunction(detector))
+
+    # Method to register a stream consumer per name, so readers other than the processor don't share its read throughput
+    def __create_stream_consumers(self, id: str, ctx_fan_out: object):
+        consumer_names = ctx_fan_out.consumers
+        if len(consumer_names) > 20:
+            raise Exception("queue.enhanced_fan_out.consumers can have at most 20 consumers, the Kinesis limit per stream")
+        for name in consumer_names:
+            consumer = ks.CfnStreamConsumer(
+                scope = self,
+                id = f"{name}_stream_consumer",
+                consumer_name = f"{id}-{name}",
+                stream_arn = self.kinesis_stream.stream_arn
+            )
+            self.stream_consumers[name] = consumer
+            core.CfnOutput(
+                scope = self,
+                id = f"{name}-consumer-arn-out",
+                value = consumer.attr_consumer_arn,
+                export_name = f"{id}-{name}-consumer-arn"
+            )
+
+    # Method to grant a role what it needs to read the stream through one of our consumers with SubscribeToShard
+    def grant_subscribe(self, grantee: iam.IGrantable, consumer_name: str):
+        consumer = self.stream_consumers[consumer_name]
+        grantee.grant_principal.add_to_policy(
+            iam.PolicyStatement(
+                actions = [
+                    "kinesis:DescribeStreamSummary",
+                    "kinesis:ListShards"
+                    ],
+                effect = iam.Effect.ALLOW,
+                resources = [self.kinesis_stream.stream_arn]
+            ))
+        grantee.grant_principal.add_to_policy(
+            iam.PolicyStatement(
+                actions = [
+                    "kinesis:DescribeStreamConsumer",
+                    "kinesis:SubscribeToShard"
+                    ],
+                effect = iam.Effect.ALLOW,
+                resources = [consumer.attr_consumer_arn]
+            ))
+
+    # Method to create a Lambda that reshards the stream based on its write metrics
+    def __create_shard_controller(self, kinesis_stream: ks.Stream, suffix: str, ctx_scaling: object):
+        controller = lambda_.Function(
+            scope = self,
+            id = f"shard_controller{suffix}",
+            runtime = lambda_.Runtime.PYTHON_3_8,
+            handler = "index.handler",
+            code = lambda_.Code.from_asset(os.path.join(os.path.dirname(__file__), "..", "..", "..", "lambda", "shard_controller")),
+            timeout = core.Duration.minutes(1),
+            # Only one resharding decision at a time
+            reserved_concurrent_executions = 1,
+            environment = {
+                "STREAM_NAME": kinesis_stream.stream_name,
+                "MIN_SHARD_COUNT": str(ctx_scaling.min_shard_count),
+                "MAX_SHARD_COUNT": str(ctx_scaling.max_shard_count),
+                "TARGET_UTILIZATION_PERCENT": str(getattr(ctx_scaling, "target_utilization_percent", 70)),
+                "SCALE_IN_UTILIZATION_PERCENT": str(getattr(ctx_scaling, "scale_in_utilization_percent", 30)),
+                "SCALE_OUT_COOLDOWN_SECONDS": str(getattr(ctx_scaling, "scale_out_cooldown_seconds", 300)),
+                "SCALE_IN_COOLDOWN_SECONDS": str(getattr(ctx_scaling, "scale_in_cooldown_seconds", 3600))
+            }
+        )
+        controller.add_to_role_policy(
+            iam.PolicyStatement(
+                actions = [
+                    "kinesis:DescribeStreamSummary",
+                    "kinesis:UpdateShardCount",
+                    "kinesis:ListTagsForStream",
+                    "kinesis:AddTagsToStream"
+                    ],
+                effect = iam.Effect.ALLOW,
+                resources = [kinesis_stream.stream_arn]
+            ))
+        controller.add_to_role_policy(
+            iam.PolicyStatement(
+                actions = ["cloudwatch:GetMetricData"],
+                effect = iam.Effect.ALLOW,
+                resources = ["*"]
+            ))
+
+        # Evaluate regularly, which is also how the stream scales back in
+        schedule = events.Rule(
+            scope = self,
+            id = f"shard_controller_schedule{suffix}",
+            schedule = events.Schedule.rate(core.Duration.minutes(getattr(ctx_scaling, "evaluation_interval_minutes", 5)))
+        )
+        schedule.add_target(events_targets.LambdaFunction(controller))
+
+        # Evaluate immediately when producers are being throttled
+        alarm_topic = sns.Topic(
+            scope = self,
+            id = f"shard_controller_topic{suffix}"
+        )
+        alarm_topic.add_subscription(sns_subs.LambdaSubscription(controller))
+        throttle_alarm = cw.Alarm(
+            scope = self,
+            id = f"write_throttle_alarm{suffix}",
+            metric = cw.Metric(
+                namespace = "AWS/Kinesis",
+                metric_name = "WriteProvisionedThroughputExceeded",
+                dimensions = {"StreamName": kinesis_stream.stream_name},
+                statistic = "Sum",
+                period = core.Duration.minutes(1)
+            ),
+            threshold = 0,
+            comparison_operator = cw.ComparisonOperator.GREATER_THAN_THRESHOLD,
+            evaluation_periods = 1,
+            treat_missing_data = cw.TreatMissingData.NOT_BREACHING
+        )
+        throttle_alarm.add_alarm_action(cw_actions.SnsAction(alarm_topic))
@@ -0,0 +1,175 @@
+from aws_cdk import (
+    core,
+    aws_ec2 as ec2,
+    aws_ecs as ecs,
+    aws_ecr as ecr,
+    aws_iam as iam,
+    aws_kinesis as ks,
+    aws_logs as cwl,
+    )
+from tools.streams import get_processors, service_stream, stream_context
+
+# Kinesis per-shard write limits
+SHARD_BYTES_PER_SECOND = 1024 * 1024
+SHARD_RECORDS_PER_SECOND = 1000
+CHECKPOINT_PREFIX = "_replay/"
+
+
+class ReplayStack(core.Stack):
+
+    def __init__(self, scope: core.Construct, id: str, ctx: object, ecr_repository: ecr.Repository, kinesis_streams: dict, **kwargs) -> None:
+        super().__init__(scope, id, **kwargs)
+        self.ecr_repository = ecr_repository
+        service_name = "replay"
+        ctx_replay = ctx.replay
+        # With the queue split by source group, replay.stream names the stream to replay into (see tools/streams.py)
+        stream = service_stream(ctx, service_name, ctx_replay)
+        kinesis_stream = kinesis_streams[stream]
+
+        self.vpc = ec2.Vpc.from_vpc_attributes(
+            self, "VPC",
+            **ctx.vpc_props.dict()
+        )
+
+        # CloudWatch Logs Group
+        self.log_group = cwl.LogGroup(
+            scope = self,
+            id = "logs"
+        )
+
+        # Replays are run on demand with `aws ecs run-task`, so the cluster has no services
+        self.cluster = ecs.Cluster(
+            self,
+            vpc = self.vpc,
+            id = f"{id}_cluster"
+        )
+
+        # Create a role for ECS to interact with AWS APIs with standard permissions
+        self.ecs_exec_role = iam.Role(
+            scope = self,
+            id = "ecs_replay-exec_role",
+            assumed_by = iam.ServicePrincipal("ecs-tasks.amazonaws.com"),
+            managed_policies = ([
+                iam.ManagedPolicy.from_aws_managed_policy_name(
+                    "service-role/AmazonECSTaskExecutionRolePolicy")
+            ])
+        )
+        # Grant ECS permissions to log to our log group
+        self.log_group.grant_write(self.ecs_exec_role)
+
+        # Create a task role to grant permissions for the replayer to read the archive and write to the queue
+        ecs_task_role = iam.Role(
+            scope = self,
+            id = f"{service_name}_task_role",
+            assumed_by = iam.ServicePrincipal("ecs-tasks.amazonaws.com")
+        )
+        buckets = self.__get_buckets(ctx, ctx_replay, stream)
+        bucket_resources = []
+        for bucket in buckets:
+            bucket_resources.append('arn:aws:s3:::{0}'.format(bucket))
+            bucket_resources.append('arn:aws:s3:::{0}/*'.format(bucket))
+        ecs_task_role.add_to_policy(
+            iam.PolicyStatement(
+                actions = ["s3:GetObject", "s3:ListBucket"],
+                effect = iam.Effect.ALLOW,
+                resources = bucket_resources
+            ))
+        # Checkpoints are kept in the first bucket, under a prefix the replayer and compactor skip
+        ecs_task_role.add_to_policy(
+            iam.PolicyStatement(
+                actions = ["s3:PutObject"],
+                effect = iam.Effect.ALLOW,
+                resources = ['arn:aws:s3:::{0}/{1}*'.format(buckets[0], CHECKPOINT_PREFIX)]
+            ))
+        kinesis_stream.grant_write(ecs_task_role)
+
+        # Task Definition
+        task_definition = ecs.FargateTaskDefinition(
+            scope = self,
+            id = f"{service_name}_task_definition",
+            cpu = ctx_replay.size.cpu,
+            memory_limit_mib = ctx_replay.size.ram,
+            execution_role = self.ecs_exec_role,
+            task_role = ecs_task_role,
+        )
+
+        log_driver = ecs.LogDriver.aws_logs(
+            log_group = self.log_group,
+            stream_prefix = service_name)
+
+        # Container Definition
+        ecs.ContainerDefinition(
+            scope = self,
+            id = f"{service_name}_container_definition",
+            task_definition = task_definition,
+            image = ecs.ContainerImage.from_ecr_repository(self.ecr_repository, "latest"),
+            logging = log_driver,
+            environment = self.__get_container_environment(ctx, ctx_replay, buckets, stream, kinesis_stream)
+        )
+
+        security_group = ec2.SecurityGroup(
+            scope = self,
+            id = f"{service_name}_sg",
+            vpc = self.vpc
+        )
+
+        # What `aws ecs run-task` needs to start a replay
+        core.CfnOutput(
+            scope = self,
+            id = "cluster-name-out",
+            value = self.cluster.cluster_name,
+            export_name = f"{id}-cluster-name"
+        )
+        core.CfnOutput(
+            scope = self,
+            id = "task-definition-out",
+            value = task_definition.task_definition_arn,
+            export_name = f"{id}-task-definition"
+        )
+        core.CfnOutput(
+            scope = self,
+            id = "security-group-out",
+            value = security_group.security_group_id,
+            export_name = f"{id}-security-group"
+        )
+
+    # Method to choose the buckets to replay from; by default every archive bucket the stream's processor writes to
+    def __get_buckets(self, ctx, ctx_replay, stream):
+        buckets = getattr(ctx_replay, "buckets", None)
+        if buckets:
+            return buckets
+        ctx_processor = get_processors(ctx)[stream].ctx_srv
+        return [v for k, v in ctx_processor.variables.items() if k.endswith("_log_bucket")]
+
+    # Method to limit replay to a share of the stream's write capacity, leaving the rest for live traffic
+    def __get_rate_limits(self, ctx, ctx_replay, stream):
+        ctx_stream = stream_context(ctx, stream)
+        ctx_scaling = getattr(ctx_stream, "scaling", None)
+        shards = ctx_stream.kinesis_shard_count
+        if getattr(ctx_scaling, "mode", "fixed") == "auto":
+            shards = ctx_scaling.min_shard_count
+        share = getattr(ctx_replay, "rate_limit_percent", 25) / 100
+        return (
+            getattr(ctx_replay, "max_bytes_per_second", int(shards * SHARD_BYTES_PER_SECOND * share)),
+            getattr(ctx_replay, "max_records_per_second", int(shards * SHARD_RECORDS_PER_SECOND * share))
+        )
+
+    def __get_container_environment(self, ctx, ctx_replay, buckets, stream, kinesis_stream):
+        max_bytes_per_second, max_records_per_second = self.__get_rate_limits(ctx, ctx_replay, stream)
+        container_environment = {
+            "ENV_STAGE": ctx.stage,
+            "AWS_REGION": ctx.aws_region,
+            "REPLAY_BUCKETS": ",".join(buckets),
+            "REPLAY_STREAM_NAME": kinesis_stream.stream_name,
+            "REPLAY_WORKERS": str(getattr(ctx_replay, "workers", 8)),
+            "REPLAY_MAX_BYTES_PER_SECOND": str(max_bytes_per_second),
+            "REPLAY_MAX_RECORDS_PER_SECOND": str(max_records_per_second),
+            "REPLAY_TAG": getattr(ctx_replay, "tag", "replayed"),
+            "REPLAY_EXCLUDE_PREFIXES": ",".join([getattr(getattr(ctx, "compaction", None), "output_prefix", "compacted/"), CHECKPOINT_PREFIX]),
+            "REPLAY_CHECKPOINT_PREFIX": f"s3://{buckets[0]}/{CHECKPOINT_PREFIX}",
+            "REPLAY_METRICS_NAMESPACE": f"Telemetry/{ctx.stage}"
+            }
+        if hasattr(ctx_replay, "variables"):
+            for k, v in ctx_replay.variables.items():
+                container_environment[k.upper()] = v
+        return container_environment
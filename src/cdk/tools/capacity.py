@@ -0,0 +1,353 @@
+"""Capacity planning for the Kinesis queue and the Logstash services, and JVM memory sizing for their tasks.
+
+Plans come from the expected load of each inbound service, set with a `capacity` node in cdk.context.json:
+
+    "capacity": {"eps": 2000, "peak_eps": 6000, "event_bytes": 800}
+
+With the queue split by source group (see tools/streams.py), each stream and its processor are
+planned from the services that write to it. `check_context` compares the merged context with the plan when the app is synthesised, and
+`python3 -m tools.capacity cdk.context.json stage_name`, run from src/cdk, prints the plan for a stage.
+"""
+import math
+from dataclasses import dataclass
+from typing import Dict, List
+
+from tools.config_sync import get_config_sync
+from tools.pipelines import DEFAULT_BATCH_SIZE, INBOUND_PIPELINES, OUTBOUND_PIPELINES
+from tools.streams import DEFAULT_STREAM, get_processors, service_stream, stream_context
+
+# Kinesis per-shard write limits
+SHARD_BYTES_PER_SECOND = 1024 * 1024
+SHARD_RECORDS_PER_SECOND = 1000
+# Starting points for the events one vCPU processes per second; measure your own with src/benchmark/run.py
+DEFAULT_EVENTS_PER_VCPU = {"inbound": 4000, "outbound": 2000}
+DEFAULT_TARGET_UTILIZATION_PERCENT = 70
+
+# Memory a task needs outside the JVM: the OS and ECS agent, and on inbound tasks the native KPL daemon
+OS_RESERVE_MIB = 256
+KPL_RESERVE_MIB = 384
+# Share of the JVM's memory for metaspace, code cache, thread stacks and GC structures, and its floor
+JVM_OVERHEAD_PERCENT = 15
+MIN_JVM_OVERHEAD_MIB = 256
+# Share of the rest for the heap; the remainder is direct memory for Netty and the AWS SDKs
+HEAP_PERCENT = 70
+MIN_HEAP_MIB = 512
+# Heap for Logstash itself, plus a multiple of the raw size of every event in flight in a pipeline batch
+BASE_HEAP_MIB = 384
+EVENT_HEAP_FACTOR = 10
+# The processor's dedup cache lives on the heap; it may take at most this share of it
+DEFAULT_DEDUP_MEMORY_MIB = 64
+MAX_DEDUP_HEAP_PERCENT = 50
+
+# Valid Fargate memory (MiB) for each CPU size
+FARGATE_MEMORY = {
+    256: [512, 1024, 2048],
+    512: list(range(1024, 4097, 1024)),
+    1024: list(range(2048, 8193, 1024)),
+    2048: list(range(4096, 16385, 1024)),
+    4096: list(range(8192, 30721, 1024))
+}
+
+
+@dataclass
+class JvmMemory:
+    heap_mib: int
+    direct_mib: int
+
+    def options(self) -> str:
+        return f"-Xms{self.heap_mib}m -Xmx{self.heap_mib}m -XX:MaxDirectMemorySize={self.direct_mib}m"
+
+
+@dataclass
+class ServicePlan:
+    name: str
+    direction: str
+    cpu: int
+    ram: int
+    min_capacity: int
+    max_capacity: int
+    jvm: JvmMemory
+
+
+@dataclass
+class QueuePlan:
+    stream: str
+    shards: int
+    peak_shards: int
+
+
+@dataclass
+class Finding:
+    level: str
+    # The stack the finding is reported on: queue, inbound or outbound
+    scope: str
+    message: str
+
+
+def round_down(mib: float, step: int = 64) -> int:
+    return int(mib // step * step)
+
+
+def jvm_memory(ram_mib: int, native_mib: int = 0) -> JvmMemory:
+    """Splits a task's RAM between the heap and direct memory, after the OS, native processes and the JVM's own overhead."""
+    available = ram_mib - OS_RESERVE_MIB - native_mib
+    usable = available - max(MIN_JVM_OVERHEAD_MIB, available * JVM_OVERHEAD_PERCENT / 100)
+    heap = max(256, round_down(usable * HEAP_PERCENT / 100))
+    direct = max(64, round_down(usable - heap))
+    return JvmMemory(heap, direct)
+
+
+def jvm_overcommit_mib(ram_mib: int, native_mib: int = 0) -> int:
+    """How far jvm_memory's floors for the heap, direct memory and JVM overhead take a task past its RAM, or 0 when they fit."""
+    jvm = jvm_memory(ram_mib, native_mib)
+    available = ram_mib - OS_RESERVE_MIB - native_mib
+    overhead = max(MIN_JVM_OVERHEAD_MIB, available * JVM_OVERHEAD_PERCENT / 100)
+    return max(0, math.ceil(OS_RESERVE_MIB + native_mib + overhead + jvm.heap_mib + jvm.direct_mib - ram_mib))
+
+
+def smallest_fitting_ram(cpu: int, native_mib: int) -> int:
+    """The least Fargate memory for `cpu` that holds the JVM's floors, or the most there is."""
+    for ram in FARGATE_MEMORY.get(cpu, []):
+        if jvm_overcommit_mib(ram, native_mib) == 0:
+            return ram
+    return max(FARGATE_MEMORY.get(cpu, [0]))
+
+
+def native_mib(direction: str, name: str, ctx_srv: object) -> int:
+    """Memory a task needs outside Logstash's JVM: the KPL daemon on inbound tasks, and config_sync's config test JVM."""
+    native = KPL_RESERVE_MIB if direction == "inbound" else 0
+    config_sync = get_config_sync(name, ctx_srv)
+    if config_sync is not None:
+        native += config_sync.validate_mib()
+    return native
+
+
+def dedup_mib(ctx_srv: object) -> int:
+    """Heap for a service's dedup cache, or 0 without one."""
+    ctx_dedup = getattr(ctx_srv, "dedup", None)
+    return 0 if ctx_dedup is None else getattr(ctx_dedup, "memory_mib", DEFAULT_DEDUP_MEMORY_MIB)
+
+
+def heap_needed_mib(ctx_srv: object, direction: str, event_bytes: float) -> int:
+    """Heap for the events that a service's pipelines can hold in flight at once, one batch per worker, and its dedup cache."""
+    pipelines = INBOUND_PIPELINES if direction == "inbound" else OUTBOUND_PIPELINES
+    vcpu = ctx_srv.size.cpu / 1024
+    ctx_pipelines = getattr(ctx_srv, "pipelines", None)
+    in_flight = 0
+    for pipeline_id, (workers_per_vcpu, min_workers) in pipelines.items():
+        ctx_pipeline = getattr(ctx_pipelines, pipeline_id, None)
+        workers = getattr(ctx_pipeline, "workers", max(min_workers, math.ceil(vcpu * workers_per_vcpu)))
+        in_flight += workers * getattr(ctx_pipeline, "batch_size", DEFAULT_BATCH_SIZE)
+    return math.ceil(BASE_HEAP_MIB + dedup_mib(ctx_srv) + in_flight * event_bytes * EVENT_HEAP_FACTOR / 2 ** 20)
+
+
+def shards_needed(eps: float, event_bytes: float, aggregated: bool, target_percent: float) -> int:
+    """Shards to keep writes under `target_percent` of the stream's limits; aggregation lifts the records limit."""
+    shards = eps * event_bytes / (SHARD_BYTES_PER_SECOND * target_percent / 100)
+    if not aggregated:
+        shards = max(shards, eps / (SHARD_RECORDS_PER_SECOND * target_percent / 100))
+    return max(1, math.ceil(shards))
+
+
+def tasks_needed(eps: float, cpu: int, events_per_vcpu: float, target_percent: float) -> int:
+    return max(1, math.ceil(eps / (cpu / 1024 * events_per_vcpu * target_percent / 100)))
+
+
+def smallest_ram(cpu: int, heap_mib: int, native: int) -> int:
+    """The least Fargate memory for `cpu` whose heap is at least `heap_mib`, or the most there is."""
+    for ram in FARGATE_MEMORY[cpu]:
+        if jvm_memory(ram, native).heap_mib >= heap_mib:
+            return ram
+    return FARGATE_MEMORY[cpu][-1]
+
+
+def inbound_services(ctx: object) -> Dict[str, object]:
+    """The Logstash inbound services; relay services run the syslog relay rather than Logstash."""
+    services = {}
+    for service_type in ("nlb", "cloudmap", "pull"):
+        for name, ctx_srv in (getattr(ctx.inbound.services, service_type, None) or {}).items():
+            services[name] = ctx_srv
+    return services
+
+
+def load(ctx_srv: object):
+    """Returns (eps, peak_eps, event_bytes) from a service's capacity node, or None without one."""
+    ctx_capacity = getattr(ctx_srv, "capacity", None)
+    if ctx_capacity is None:
+        return None
+    return ctx_capacity.eps, getattr(ctx_capacity, "peak_eps", ctx_capacity.eps), ctx_capacity.event_bytes
+
+
+def plan_service(name: str, direction: str, ctx_srv: object, eps: float, peak_eps: float, event_bytes: float) -> ServicePlan:
+    ctx_capacity = getattr(ctx_srv, "capacity", None)
+    events_per_vcpu = getattr(ctx_capacity, "events_per_vcpu", DEFAULT_EVENTS_PER_VCPU[direction])
+    target = getattr(getattr(ctx_srv, "scaling", None), "target_utilization_percent", DEFAULT_TARGET_UTILIZATION_PERCENT)
+    cpu = ctx_srv.size.cpu
+    native = native_mib(direction, name, ctx_srv)
+    ram = smallest_ram(cpu, max(MIN_HEAP_MIB, heap_needed_mib(ctx_srv, direction, event_bytes)), native)
+    return ServicePlan(
+        name = name,
+        direction = direction,
+        cpu = cpu,
+        ram = ram,
+        min_capacity = tasks_needed(eps, cpu, events_per_vcpu, target),
+        max_capacity = tasks_needed(peak_eps, cpu, events_per_vcpu, target),
+        jvm = jvm_memory(ram, native)
+    )
+
+
+def plan_context(ctx: object):
+    """Returns the shards of each stream with a known load, for the expected and peak load, and a plan for every service with a known load."""
+    aggregated = getattr(getattr(ctx.queue, "aggregation", None), "enabled", False)
+    plans = []
+    # Stream to [eps, peak_eps, bytes, peak_bytes] of the services writing to it
+    totals = {}
+    for name, ctx_srv in inbound_services(ctx).items():
+        service_load = load(ctx_srv)
+        if service_load is None:
+            continue
+        eps, peak_eps, event_bytes = service_load
+        plans.append(plan_service(name, "inbound", ctx_srv, eps, peak_eps, event_bytes))
+        total = totals.setdefault(service_stream(ctx, name, ctx_srv), [0, 0, 0, 0])
+        total[0] += eps
+        total[1] += peak_eps
+        total[2] += eps * event_bytes
+        total[3] += peak_eps * event_bytes
+
+    # Every event written to a stream goes through it to the stream's processor
+    queues = []
+    processors = get_processors(ctx)
+    for stream, (total_eps, total_peak_eps, total_bytes, total_peak_bytes) in totals.items():
+        event_bytes = total_bytes / total_eps if total_eps else 0
+        queues.append(QueuePlan(
+            stream = stream,
+            shards = shards_needed(total_eps, event_bytes, aggregated, DEFAULT_TARGET_UTILIZATION_PERCENT),
+            peak_shards = shards_needed(total_peak_eps, total_peak_bytes / total_peak_eps if total_peak_eps else 0, aggregated, DEFAULT_TARGET_UTILIZATION_PERCENT)
+        ))
+        processor = processors[stream]
+        plans.append(plan_service(processor.name, "outbound", processor.ctx_srv, total_eps, total_peak_eps, event_bytes))
+    return queues, plans
+
+
+def max_shard_count(ctx_stream: object):
+    """The most shards a stream can have, or None when Kinesis manages them; `ctx_stream` is the queue node or one of its streams."""
+    ctx_scaling = getattr(ctx_stream, "scaling", None)
+    mode = getattr(ctx_scaling, "mode", "fixed")
+    if mode == "on_demand":
+        return None
+    if mode == "auto":
+        return ctx_scaling.max_shard_count
+    return ctx_stream.kinesis_shard_count
+
+
+def queue_name(stream: str) -> str:
+    return "The queue" if stream == DEFAULT_STREAM else f"Stream '{stream}'"
+
+
+def check_context(ctx: object) -> List[Finding]:
+    """Compares the context with the plan; warnings where the load may not fit, errors where the tasks' memory can't work at all.
+
+    The load is an estimate, so a shortfall never stops a deploy; memory that can't hold Logstash does.
+    """
+    findings = []
+    processors = get_processors(ctx)
+    # The dedup cache is checked against the heap whether or not the load is known
+    for processor in processors.values():
+        heap = jvm_memory(processor.ctx_srv.size.ram, native_mib("outbound", processor.name, processor.ctx_srv)).heap_mib
+        if dedup_mib(processor.ctx_srv) > heap * MAX_DEDUP_HEAP_PERCENT / 100:
+            findings.append(Finding("error", "outbound",
+                f"{processor.name}'s dedup.memory_mib of {dedup_mib(processor.ctx_srv)} is more than {MAX_DEDUP_HEAP_PERCENT}% of its {heap} MiB heap"))
+
+    # Every Logstash task is checked against its RAM, whether or not the load is known
+    memory_errors = set()
+    services = {name: ("inbound", ctx_srv) for name, ctx_srv in inbound_services(ctx).items()}
+    services.update({processor.name: ("outbound", processor.ctx_srv) for processor in processors.values()})
+    for name, (direction, ctx_srv) in services.items():
+        native = native_mib(direction, name, ctx_srv)
+        overcommit = jvm_overcommit_mib(ctx_srv.size.ram, native)
+        if overcommit > 0:
+            findings.append(Finding("error", direction,
+                f"{name} has {ctx_srv.size.ram} MiB of RAM, {overcommit} MiB short of the smallest heap, direct memory and JVM overhead "
+                f"plus the {native + OS_RESERVE_MIB} MiB outside the JVM; use at least {smallest_fitting_ram(ctx_srv.size.cpu, native)} MiB"))
+            memory_errors.add(name)
+            continue
+
+        # A config test runs a second JVM in the task, whose memory comes out of Logstash's heap
+        config_sync = get_config_sync(name, ctx_srv)
+        if config_sync is None:
+            continue
+        heap = jvm_memory(ctx_srv.size.ram, native).heap_mib
+        # Only where the config test is what leaves the heap too small
+        if heap < MIN_HEAP_MIB <= jvm_memory(ctx_srv.size.ram, native - config_sync.validate_mib()).heap_mib:
+            findings.append(Finding("error", direction,
+                f"{name} has {ctx_srv.size.ram} MiB of RAM, which leaves a {heap} MiB heap next to config_sync's "
+                f"{config_sync.validate_mib()} MiB config test; add RAM or lower config_sync.validate_heap"))
+            memory_errors.add(name)
+
+    queues, plans = plan_context(ctx)
+    if not plans:
+        return findings
+
+    max_shards = {}
+    for queue in queues:
+        max_shards[queue.stream] = max_shard_count(stream_context(ctx, queue.stream))
+        if max_shards[queue.stream] is not None and queue.peak_shards > max_shards[queue.stream]:
+            findings.append(Finding("warning", "queue",
+                f"{queue_name(queue.stream)} can have {max_shards[queue.stream]} shards, but the expected peak load needs {queue.peak_shards}"))
+
+    services = inbound_services(ctx)
+    processor_streams = {}
+    for stream, processor in processors.items():
+        services[processor.name] = processor.ctx_srv
+        processor_streams[processor.name] = stream
+    for plan in plans:
+        ctx_srv = services[plan.name]
+        max_capacity = ctx_srv.scaling.max_capacity
+        # Processor tasks beyond the shard count sit idle, as the stack caps them
+        stream_shards = max_shards.get(processor_streams.get(plan.name)) if plan.direction == "outbound" else None
+        if stream_shards is not None:
+            max_capacity = min(max_capacity, stream_shards)
+        if plan.max_capacity > max_capacity:
+            findings.append(Finding("warning", plan.direction,
+                f"{plan.name} can scale to {max_capacity} tasks, but the expected peak load needs {plan.max_capacity} of {plan.cpu} CPU"))
+        if ctx_srv.scaling.min_capacity < plan.min_capacity:
+            findings.append(Finding("warning", plan.direction,
+                f"{plan.name} starts with {ctx_srv.scaling.min_capacity} tasks, but the expected load needs {plan.min_capacity}"))
+
+        # Memory that doesn't fit the task at all has its own finding
+        if plan.name in memory_errors:
+            continue
+        jvm = jvm_memory(ctx_srv.size.ram, native_mib(plan.direction, plan.name, ctx_srv))
+        if jvm.heap_mib < MIN_HEAP_MIB:
+            findings.append(Finding("error", plan.direction,
+                f"{plan.name} has {ctx_srv.size.ram} MiB of RAM, which leaves a {jvm.heap_mib} MiB heap; use at least {plan.ram} MiB"))
+        elif ctx_srv.size.ram < plan.ram:
+            findings.append(Finding("warning", plan.direction,
+                f"{plan.name} has {ctx_srv.size.ram} MiB of RAM, but its batches in flight need {plan.ram} MiB"))
+    return findings
+
+
+def print_plan(ctx: object):
+    queues, plans = plan_context(ctx)
+    if not plans:
+        print("No inbound service has a capacity node")
+    for queue in queues:
+        name = "queue" if queue.stream == DEFAULT_STREAM else f"stream {queue.stream}"
+        print(f"{name}: {queue.shards} shards for the expected load, {queue.peak_shards} for the peak")
+    for plan in plans:
+        print(f"{plan.name} ({plan.direction}): cpu {plan.cpu}, ram {plan.ram}, min_capacity {plan.min_capacity}, "
+              f"max_capacity {plan.max_capacity}, LS_JAVA_OPTS \"{plan.jvm.options()}\"")
+    for finding in check_context(ctx):
+        print(f"{finding.level.upper()}: {finding.message}")
+
+
+if __name__ == "__main__":
+    import json
+    import sys
+    from tools.context import AppContext, merge
+
+    if len(sys.argv) != 3:
+        sys.exit("usage: python3 -m tools.capacity cdk.context.json stage_name")
+    with open(sys.argv[1]) as f:
+        context = json.load(f)
+    print_plan(AppContext(merge(dict(context[sys.argv[2]]), dict(context.get("shared", {})))))
@@ -0,0 +1,51 @@
+"""Staging of events too large for a Kinesis record in S3, instead of losing them to Kinesis rejections.
+
+A `claim_check` node on the queue gives the queue stack a staging bucket. Inbound services write
+each event larger than `max_record_bytes` to it under `{service_name}/`, and send a small reference
+through Kinesis instead, which the processor's parent pipeline swaps back for the event:
+
+    "claim_check": {"max_record_bytes": 1000000, "retention_days": 7, "azure_chunk_bytes": 524288}
+
+Azure Event Hubs batches larger than `azure_chunk_bytes` are split into several messages first, so
+only single records that big are staged. See plugins/logstash/filters/claim_check.rb in either
+image for how events are staged and fetched.
+"""
+from dataclasses import dataclass
+from typing import Optional
+
+# A Kinesis record's data and partition key together
+KINESIS_MAX_RECORD_BYTES = 1024 * 1024
+# Room for the partition key (up to 256 bytes) and the KPL's aggregation framing
+RECORD_RESERVE_BYTES = 4096
+# The inbound image's default split size for Azure Event Hubs batches
+AZURE_CHUNK_BYTES = 512 * 1024
+
+
+@dataclass
+class ClaimCheck:
+    max_record_bytes: int
+    # How long staged events are kept; longer than the stream's retention, so every reference can be fetched
+    retention_days: int
+    azure_chunk_bytes: int
+
+
+def get_claim_check(ctx: object) -> Optional[ClaimCheck]:
+    """The queue's claim check settings, or None without a claim_check node; raises an Exception when they're out of range."""
+    ctx_claim = getattr(ctx.queue, "claim_check", None)
+    if ctx_claim is None:
+        return None
+    largest = KINESIS_MAX_RECORD_BYTES - RECORD_RESERVE_BYTES
+    max_record_bytes = getattr(ctx_claim, "max_record_bytes", 1000000)
+    retention_days = getattr(ctx_claim, "retention_days", 7)
+    azure_chunk_bytes = getattr(ctx_claim, "azure_chunk_bytes", AZURE_CHUNK_BYTES)
+    if not 1024 <= max_record_bytes <= largest:
+        raise Exception(f"queue.claim_check.max_record_bytes must be between 1024 and {largest}")
+    if retention_days < 2:
+        raise Exception("queue.claim_check.retention_days must be at least 2, so staged events outlive the stream's records")
+    if not 1024 <= azure_chunk_bytes <= max_record_bytes:
+        raise Exception("queue.claim_check.azure_chunk_bytes must be between 1024 and max_record_bytes")
+    return ClaimCheck(
+        max_record_bytes = max_record_bytes,
+        retention_days = retention_days,
+        azure_chunk_bytes = azure_chunk_bytes
+    )
@@ -0,0 +1,62 @@
+"""Pipeline config bundles that running Logstash tasks pick up from S3, without a new image or new tasks.
+
+A `config_sync` node on a service gives its stack a versioned config bucket, lets the service's
+tasks read `{service_name}/config.tar.gz` from it, and switches on the config_sync pipeline in the
+image, which validates each new bundle, applies it and rolls it back if a pipeline fails to reload:
+
+    "config_sync": {"interval_seconds": 30, "verify_seconds": 120}
+
+See plugins/logstash/inputs/config_sync.rb in either image for how a bundle is applied.
+"""
+import re
+from dataclasses import dataclass
+from typing import Optional
+
+BUNDLE_NAME = "config.tar.gz"
+# Memory the config test's JVM uses beyond its heap: metaspace, code cache, thread stacks and JRuby's own
+VALIDATE_OVERHEAD_MIB = 256
+
+
+@dataclass
+class ConfigSync:
+    interval_seconds: int
+    verify_seconds: int
+    # Heap for the Logstash config test each new bundle gets before it is applied
+    validate_heap: str
+
+    def validate_mib(self) -> int:
+        """Memory the config test's JVM can take while it runs, next to Logstash's own."""
+        return heap_mib(self.validate_heap) + VALIDATE_OVERHEAD_MIB
+
+
+def get_config_sync(name: str, ctx_srv: object) -> Optional[ConfigSync]:
+    """The service's config sync settings, or None without a config_sync node; raises an Exception when they're out of range."""
+    ctx_sync = getattr(ctx_srv, "config_sync", None)
+    if ctx_sync is None:
+        return None
+    interval = getattr(ctx_sync, "interval_seconds", 30)
+    verify = getattr(ctx_sync, "verify_seconds", 120)
+    if interval < 5:
+        raise Exception(f"config_sync.interval_seconds for {name} must be at least 5")
+    if verify < 10:
+        raise Exception(f"config_sync.verify_seconds for {name} must be at least 10")
+    validate_heap = getattr(ctx_sync, "validate_heap", "384m")
+    if heap_mib(validate_heap) is None:
+        raise Exception(f"config_sync.validate_heap for {name} must be a JVM heap size such as 384m or 1g")
+    return ConfigSync(
+        interval_seconds = interval,
+        verify_seconds = verify,
+        validate_heap = validate_heap
+    )
+
+
+def heap_mib(value: str) -> Optional[int]:
+    """MiB in a JVM size such as "384m" or "1g", or None when it isn't one."""
+    match = re.fullmatch(r"(\d+)([mMgG])", str(value))
+    if match is None:
+        return None
+    return int(match.group(1)) * (1024 if match.group(2) in "gG" else 1)
+
+
+def bundle_key(service_name: str) -> str:
+    return f"{service_name}/{BUNDLE_NAME}"
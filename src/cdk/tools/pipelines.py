@@ -0,0 +1,34 @@
+import math
+
+# Logstash pipelines whose settings are tuned per service, mapped to (workers per vCPU, minimum workers).
+# The healthcheck pipelines are left at one worker.
+INBOUND_PIPELINES = {
+    "logstash-ingress": (2, 4)
+}
+OUTBOUND_PIPELINES = {
+    "parent": (1, 1),
+    "beats": (1, 1),
+    "syslog": (1, 1),
+    "azure_event_hubs": (1, 1),
+    "fallback": (1, 1)
+}
+DEFAULT_BATCH_SIZE = 125
+DEFAULT_BATCH_DELAY = 50
+
+def get_pipeline_vars(ctx_srv, pipelines):
+    """Returns the environment variables that pipelines.yml reads its worker and batch settings from.
+
+    Workers default to a multiple of the task's vCPUs, so a bigger task runs more workers.
+    Anything set under the service's `pipelines` node in cdk.context.json wins.
+    """
+    vcpu = ctx_srv.size.cpu / 1024
+    ctx_pipelines = getattr(ctx_srv, "pipelines", None)
+    pipeline_vars = {}
+    for pipeline_id, (workers_per_vcpu, min_workers) in pipelines.items():
+        ctx_pipeline = getattr(ctx_pipelines, pipeline_id, None)
+        prefix = "PIPELINE_{0}".format(pipeline_id.upper().replace("-", "_"))
+        default_workers = max(min_workers, math.ceil(vcpu * workers_per_vcpu))
+        pipeline_vars[f"{prefix}_WORKERS"] = str(getattr(ctx_pipeline, "workers", default_workers))
+        pipeline_vars[f"{prefix}_BATCH_SIZE"] = str(getattr(ctx_pipeline, "batch_size", DEFAULT_BATCH_SIZE))
+        pipeline_vars[f"{prefix}_BATCH_DELAY"] = str(getattr(ctx_pipeline, "batch_delay", DEFAULT_BATCH_DELAY))
+    return pipeline_vars
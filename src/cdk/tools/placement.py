@@ -0,0 +1,107 @@
+"""Places the inbound services on network load balancers and ECS clusters.
+
+Services go on the `default` load balancer and cluster unless they name another with `load_balancer`
+or `cluster`; `"load_balancer": "dedicated"` gives a service a load balancer of its own. When the
+services left on the default load balancer need more listeners than one can have, or those left in
+the default cluster can scale to more tasks than `inbound.placement.max_tasks_per_cluster`, they
+overflow onto `default-2`, `default-3` and so on, in the order they are configured.
+"""
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+DEFAULT_GROUP = "default"
+DEDICATED = "dedicated"
+# Listeners per network load balancer, an AWS quota
+DEFAULT_MAX_LISTENERS_PER_NLB = 50
+
+
+@dataclass
+class Group:
+    name: str
+    services: List[str] = field(default_factory=list)
+    # Listener ports on a load balancer; tasks in a cluster
+    ports: Dict[int, str] = field(default_factory=dict)
+    tasks: int = 0
+
+
+@dataclass
+class Placement:
+    # Service name to load balancer group, for nlb and relay services
+    load_balancers: Dict[str, str]
+    # Service name to cluster group, for every service
+    clusters: Dict[str, str]
+
+
+def get_services(ctx: object, service_types: List[str]) -> Dict[str, object]:
+    services = {}
+    for service_type in service_types:
+        for name, ctx_srv in (getattr(ctx.inbound.services, service_type, None) or {}).items():
+            services[name] = ctx_srv
+    return services
+
+
+def overflow_name(n: int) -> str:
+    return DEFAULT_GROUP if n == 1 else f"{DEFAULT_GROUP}-{n}"
+
+
+def place_load_balancers(ctx: object, max_listeners: int) -> Dict[str, str]:
+    groups = {}
+    placement = {}
+    for name, ctx_srv in get_services(ctx, ["nlb", "relay"]).items():
+        ports = list(ctx_srv.ports)
+        duplicates = sorted(set(p for p in ports if ports.count(p) > 1))
+        if duplicates:
+            raise Exception(f"Service '{name}' lists port(s) {duplicates} more than once")
+        if len(ports) > max_listeners:
+            raise Exception(f"Service '{name}' has {len(ports)} ports, but a load balancer can have {max_listeners} listeners")
+
+        group_name = getattr(ctx_srv, "load_balancer", None)
+        if group_name == DEDICATED:
+            group_name = name
+        if group_name is None:
+            # Overflow onto the next default load balancer that has room
+            n = 1
+            while overflow_name(n) in groups and len(groups[overflow_name(n)].ports) + len(ports) > max_listeners:
+                n += 1
+            group_name = overflow_name(n)
+        group = groups.setdefault(group_name, Group(group_name))
+
+        for port in ports:
+            if port in group.ports:
+                raise Exception(
+                    f"Services '{group.ports[port]}' and '{name}' both listen on port {port} of load balancer '{group_name}'; "
+                    "change a port or give one of them another load_balancer")
+            group.ports[port] = name
+        if len(group.ports) > max_listeners:
+            raise Exception(f"Load balancer '{group_name}' needs {len(group.ports)} listeners, but can have {max_listeners}")
+        group.services.append(name)
+        placement[name] = group_name
+    return placement
+
+
+def place_clusters(ctx: object, max_tasks: int) -> Dict[str, str]:
+    groups = {}
+    placement = {}
+    for name, ctx_srv in get_services(ctx, ["nlb", "cloudmap", "pull", "relay"]).items():
+        tasks = ctx_srv.scaling.max_capacity
+        group_name = getattr(ctx_srv, "cluster", None)
+        if group_name is None:
+            # A service that can scale past the limit on its own gets an empty cluster
+            n = 1
+            while max_tasks is not None and overflow_name(n) in groups and groups[overflow_name(n)].tasks + tasks > max_tasks:
+                n += 1
+            group_name = overflow_name(n)
+        group = groups.setdefault(group_name, Group(group_name))
+        group.tasks += tasks
+        group.services.append(name)
+        placement[name] = group_name
+    return placement
+
+
+def place_services(ctx: object) -> Placement:
+    """Returns the load balancer and cluster of every inbound service; raises an Exception on a port conflict."""
+    ctx_placement = getattr(ctx.inbound, "placement", None)
+    return Placement(
+        load_balancers = place_load_balancers(ctx, getattr(ctx_placement, "max_listeners_per_nlb", DEFAULT_MAX_LISTENERS_PER_NLB)),
+        clusters = place_clusters(ctx, getattr(ctx_placement, "max_tasks_per_cluster", None))
+    )
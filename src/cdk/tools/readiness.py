@@ -0,0 +1,59 @@
+"""Container health checks that pass once Logstash's pipelines are running, not just its JVM.
+
+Without one, ECS counts a task as started as soon as its container is, and load balanced services
+wait out a 10 minute grace period before their target health checks count. A `readiness` node on a
+service runs scripts/ready.sh in the container instead, so a task is healthy once every pipeline
+has started (or those listed in `pipelines`), and the grace period can be cut to fit:
+
+    "readiness": {"start_period_seconds": 90, "grace_period_seconds": 120}
+
+src/benchmark/startup.py measures how long the images take to get there.
+"""
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+READY_SCRIPT = "/usr/share/logstash/scripts/ready.sh"
+# ECS container health check limits
+MAX_START_PERIOD_SECONDS = 300
+MIN_INTERVAL_SECONDS = 5
+MAX_INTERVAL_SECONDS = 300
+MAX_RETRIES = 10
+
+
+@dataclass
+class Readiness:
+    start_period_seconds: int
+    interval_seconds: int
+    timeout_seconds: int
+    retries: int
+    # How long a load balanced service ignores failing target health checks for a new task
+    grace_period_seconds: int
+    pipelines: List[str] = field(default_factory=list)
+
+    def command(self) -> List[str]:
+        return ["CMD-SHELL", " ".join([READY_SCRIPT] + self.pipelines)]
+
+
+def get_readiness(name: str, ctx_srv: object) -> Optional[Readiness]:
+    """The service's readiness check, or None without a readiness node; raises an Exception when it's outside ECS's limits."""
+    ctx_readiness = getattr(ctx_srv, "readiness", None)
+    if ctx_readiness is None:
+        return None
+    start_period = getattr(ctx_readiness, "start_period_seconds", 120)
+    interval = getattr(ctx_readiness, "interval_seconds", 10)
+    retries = getattr(ctx_readiness, "retries", 3)
+    if not 0 <= start_period <= MAX_START_PERIOD_SECONDS:
+        raise Exception(f"readiness.start_period_seconds for {name} must be between 0 and {MAX_START_PERIOD_SECONDS}")
+    if not MIN_INTERVAL_SECONDS <= interval <= MAX_INTERVAL_SECONDS:
+        raise Exception(f"readiness.interval_seconds for {name} must be between {MIN_INTERVAL_SECONDS} and {MAX_INTERVAL_SECONDS}")
+    if not 1 <= retries <= MAX_RETRIES:
+        raise Exception(f"readiness.retries for {name} must be between 1 and {MAX_RETRIES}")
+    return Readiness(
+        start_period_seconds = start_period,
+        interval_seconds = interval,
+        # ready.sh gives up on the stats API after 4 seconds
+        timeout_seconds = 5,
+        retries = retries,
+        grace_period_seconds = getattr(ctx_readiness, "grace_period_seconds", start_period + 30),
+        pipelines = list(getattr(ctx_readiness, "pipelines", []))
+    )
@@ -0,0 +1,69 @@
+"""Splits the queue into a Kinesis stream per source group, each read by its own processor service.
+
+By default there is one stream: every inbound service writes to it, and the outbound `processor`
+service reads it and hands each event to the pipeline for its type. A surge from one source then
+delays every other, and the processor can only scale as one. A `streams` node under `queue` gives
+each source group a stream of its own, with its own `kinesis_shard_count` and `scaling`:
+
+    "streams": {"beats": {"kinesis_shard_count": 4}, "syslog": {"kinesis_shard_count": 1}}
+
+Each inbound service then names the stream it writes to with `stream`, and each outbound `pull`
+service names the stream it reads, so every stream has a processor that is sized and scaled alone.
+"""
+from dataclasses import dataclass
+from typing import Dict, List
+
+DEFAULT_STREAM = "default"
+
+
+@dataclass
+class Processor:
+    name: str
+    stream: str
+    ctx_srv: object
+
+
+def stream_names(ctx: object) -> List[str]:
+    ctx_streams = getattr(ctx.queue, "streams", None)
+    if ctx_streams is None:
+        return [DEFAULT_STREAM]
+    names = [name for name, _ctx_stream in ctx_streams.items()]
+    if not names:
+        raise Exception("queue.streams needs at least one stream")
+    if DEFAULT_STREAM in names:
+        raise Exception(f"'{DEFAULT_STREAM}' is the name of the single stream; choose another name in queue.streams")
+    return names
+
+
+def stream_context(ctx: object, stream: str) -> object:
+    """The node with a stream's kinesis_shard_count and scaling; the queue node itself for the single stream."""
+    return ctx.queue if stream == DEFAULT_STREAM else getattr(ctx.queue.streams, stream)
+
+
+def service_stream(ctx: object, name: str, ctx_srv: object) -> str:
+    """The stream a service writes to or reads; raises an Exception when it doesn't name one of the queue's streams."""
+    stream = getattr(ctx_srv, "stream", None)
+    if getattr(ctx.queue, "streams", None) is None:
+        if stream is not None:
+            raise Exception(f"Service '{name}' names stream '{stream}', but the queue has no streams node")
+        return DEFAULT_STREAM
+    names = stream_names(ctx)
+    if stream not in names:
+        raise Exception(f"Service '{name}' needs a stream, one of {', '.join(names)}")
+    return stream
+
+
+def get_processors(ctx: object) -> Dict[str, Processor]:
+    """Returns the outbound service that reads each stream, by stream; raises an Exception unless every stream has exactly one."""
+    if getattr(ctx.queue, "streams", None) is None:
+        return {DEFAULT_STREAM: Processor("processor", DEFAULT_STREAM, ctx.outbound.services.pull.processor)}
+    processors = {}
+    for name, ctx_srv in ctx.outbound.services.pull.items():
+        stream = service_stream(ctx, name, ctx_srv)
+        if stream in processors:
+            raise Exception(f"Services '{processors[stream].name}' and '{name}' both read stream '{stream}'; each stream has one processor")
+        processors[stream] = Processor(name, stream, ctx_srv)
+    missing = [stream for stream in stream_names(ctx) if stream not in processors]
+    if missing:
+        raise Exception(f"No outbound service reads stream(s) {', '.join(missing)}")
+    return {stream: processors[stream] for stream in stream_names(ctx)}
@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+"""Compacts the small objects Logstash writes to the S3 archive into large files, an hour at a time.
+
+Logstash's s3 outputs upload a gzip json_lines object every few minutes for every partition
+(for beats, every host and log name), which leaves Athena and Spark opening millions of tiny
+objects. Run on a schedule, the compactor finds each closed hour partition (see partitions.py),
+streams its objects through a bounded buffer, and writes them under `output_prefix` with the
+same partition path as either:
+
+    parquet     zstd compressed Parquet, one row group per `row_group_mb` of input sorted by time, with
+                columns `timestamp`, any configured `columns` and `event` (the original JSON line)
+    json_zstd   the original JSON lines, zstd compressed
+
+Each compacted partition gets a `_manifest.json` listing the source objects and the files written,
+which is what marks it as done. Objects that arrive late for a compacted hour are compacted into
+extra files on the next run. Sources are only deleted when `delete_sources` is set, after the
+manifest is written.
+
+Partitions are compacted in parallel worker processes. Each worker holds about one row group of
+input at a time, and writes its files to `work_dir` before uploading them.
+
+Configured with environment variables, see CompactorConfig.from_env.
+"""
+import argparse
+import concurrent.futures
+import gzip
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+import boto3
+import pyarrow as pa
+import pyarrow.parquet as pq
+from botocore.config import Config
+
+from partitions import Partition, SourceObject, group_partitions
+
+log = logging.getLogger("compactor")
+
+FORMATS = ("parquet", "json_zstd")
+MANIFEST_NAME = "_manifest.json"
+
+
+@dataclass
+class CompactorConfig:
+    buckets: List[str]
+    output_prefix: str = "compacted/"
+    source_prefix: str = ""
+    format: str = "parquet"
+    columns: List[str] = field(default_factory=list)
+    workers: int = 1
+    grace_minutes: float = 15
+    lookback_hours: float = 48
+    target_file_mb: float = 256
+    row_group_mb: float = 64
+    delete_sources: bool = False
+    work_dir: str = None
+    s3_endpoint: str = None
+    metrics_namespace: str = None
+
+    @classmethod
+    def from_env(cls, env=os.environ):
+        """COMPACT_BUCKETS (comma separated) is required; the rest are optional COMPACT_* settings
+        named like the fields. COMPACT_COLUMNS lists dotted event fields to promote to Parquet columns."""
+        config = cls(
+            buckets = [b.strip() for b in env["COMPACT_BUCKETS"].split(",") if b.strip()],
+            output_prefix = env.get("COMPACT_OUTPUT_PREFIX", "compacted/"),
+            source_prefix = env.get("COMPACT_SOURCE_PREFIX", ""),
+            format = env.get("COMPACT_FORMAT", "parquet"),
+            columns = [c.strip() for c in env.get("COMPACT_COLUMNS", "").split(",") if c.strip()],
+            workers = int(env.get("COMPACT_WORKERS", os.cpu_count() or 1)),
+            grace_minutes = float(env.get("COMPACT_GRACE_MINUTES", 15)),
+            lookback_hours = float(env.get("COMPACT_LOOKBACK_HOURS", 48)),
+            target_file_mb = float(env.get("COMPACT_TARGET_FILE_MB", 256)),
+            row_group_mb = float(env.get("COMPACT_ROW_GROUP_MB", 64)),
+            delete_sources = env.get("COMPACT_DELETE_SOURCES", "false").lower() == "true",
+            work_dir = env.get("COMPACT_WORK_DIR") or None,
+            s3_endpoint = env.get("COMPACT_S3_ENDPOINT") or None,
+            metrics_namespace = env.get("COMPACT_METRICS_NAMESPACE") or None
+        )
+        if config.format not in FORMATS:
+            raise ValueError(f"Unknown COMPACT_FORMAT '{config.format}'; expected one of {', '.join(FORMATS)}")
+        if not config.buckets:
+            raise ValueError("Set COMPACT_BUCKETS")
+        if not config.output_prefix.endswith("/"):
+            raise ValueError("COMPACT_OUTPUT_PREFIX must end with /")
+        return config
+
+
+class PartWriter(object):
+    """Buffers lines into batches and writes them to local part files of about target_bytes.
+
+    `on_part(path, rows)` is called as each file is finished, so parts can be uploaded and removed
+    while the rest of the partition is still being read.
+    """
+    extension = None
+
+    def __init__(self, directory, target_bytes, batch_bytes, on_part):
+        self.directory = directory
+        self.target_bytes = target_bytes
+        self.batch_bytes = batch_bytes
+        self.on_part = on_part
+        self.batch = []
+        self.buffered = 0
+        self.path = None
+        self.rows = 0
+        self.count = 0
+
+    def add(self, line):
+        self.batch.append(line)
+        self.buffered += len(line)
+        if self.buffered >= self.batch_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        if self.path is None:
+            self.path = os.path.join(self.directory, f"part-{self.count:05d}.{self.extension}")
+            self.count += 1
+            self.rows = 0
+            self.open()
+        self.write(self.batch)
+        self.rows += len(self.batch)
+        self.batch = []
+        self.buffered = 0
+        if self.size() >= self.target_bytes:
+            self.finish_part()
+
+    def finish_part(self):
+        self.close_file()
+        self.on_part(self.path, self.rows)
+        self.path = None
+
+    def close(self):
+        self.flush()
+        if self.path is not None:
+            self.finish_part()
+
+
+class ParquetWriter(PartWriter):
+    extension = "parquet"
+
+    def __init__(self, directory, target_bytes, batch_bytes, on_part, columns=()):
+        super().__init__(directory, target_bytes, batch_bytes, on_part)
+        self.columns = list(columns)
+        self.schema = pa.schema(
+            [pa.field("timestamp", pa.timestamp("ms", tz="UTC"))] +
+            [pa.field(column_name(c), pa.string()) for c in self.columns] +
+            [pa.field("event", pa.string())]
+        )
+        self.writer = None
+        self.file = None
+
+    def open(self):
+        self.file = pa.OSFile(self.path, "wb")
+        # Promoted columns are usually low cardinality; the raw events are not worth a dictionary
+        self.writer = pq.ParquetWriter(self.file, self.schema, compression="zstd",
+                                       use_dictionary=[column_name(c) for c in self.columns])
+
+    def write(self, lines):
+        timestamps = []
+        values = [[] for _ in self.columns]
+        for line in lines:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                event = None
+            if not isinstance(event, dict):
+                event = {}
+            timestamps.append(parse_timestamp(event.get("@timestamp")))
+            for column, path in zip(values, self.columns):
+                column.append(get_field(event, path))
+        try:
+            events = pa.array(lines, type=pa.string())
+        except (pa.ArrowInvalid, UnicodeDecodeError):
+            events = pa.array([line.decode("utf-8", "replace") for line in lines], type=pa.string())
+        table = pa.Table.from_arrays(
+            [pa.array(timestamps, type=self.schema.field("timestamp").type)] +
+            [pa.array(v, type=pa.string()) for v in values] +
+            [events],
+            schema=self.schema
+        )
+        # Sorted row groups give Athena tight min/max statistics to skip on
+        self.writer.write_table(table.sort_by("timestamp"), row_group_size=len(lines))
+
+    def size(self):
+        return self.file.tell()
+
+    def close_file(self):
+        self.writer.close()
+        self.file.close()
+
+
+class JsonZstdWriter(PartWriter):
+    extension = "json.zst"
+
+    def __init__(self, directory, target_bytes, batch_bytes, on_part, columns=()):
+        super().__init__(directory, target_bytes, batch_bytes, on_part)
+        self.file = None
+        self.stream = None
+
+    def open(self):
+        self.file = pa.OSFile(self.path, "wb")
+        self.stream = pa.CompressedOutputStream(self.file, "zstd")
+
+    def write(self, lines):
+        self.stream.write(b"\n".join(lines) + b"\n")
+
+    def size(self):
+        # Lags behind by what the compressor is still holding, so parts run slightly over target
+        return self.file.tell()
+
+    def close_file(self):
+        self.stream.close()
+
+
+WRITERS = {"parquet": ParquetWriter, "json_zstd": JsonZstdWriter}
+
+
+def column_name(path):
+    return path.replace(".", "_").replace("@", "")
+
+
+def get_field(event, path):
+    value = event
+    for key in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, separators=(",", ":"))
+
+
+def parse_timestamp(value):
+    if not isinstance(value, str):
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+
+def s3_client(endpoint=None):
+    if endpoint:
+        # Local S3-compatible stores such as minio need path-style addressing
+        return boto3.client("s3", endpoint_url=endpoint, config=Config(s3={"addressing_style": "path"}))
+    return boto3.client("s3")
+
+
+def list_objects(client, bucket, prefix=""):
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get("Contents", []):
+            yield SourceObject(item["Key"], item["Size"], item.get("ETag", "").strip('"'))
+
+
+def read_lines(client, bucket, key):
+    """Streams the lines of an object, decompressing gzip objects as they are read."""
+    body = client.get_object(Bucket=bucket, Key=key)["Body"]
+    try:
+        stream = gzip.GzipFile(fileobj=body) if key.endswith(".gz") else body.iter_lines(chunk_size=2 ** 16)
+        for line in stream:
+            line = line.rstrip(b"\r\n")
+            if line:
+                yield line
+    finally:
+        body.close()
+
+
+def read_manifest(client, bucket, key):
+    try:
+        return json.loads(client.get_object(Bucket=bucket, Key=key)["Body"].read())
+    except client.exceptions.NoSuchKey:
+        return None
+
+
+def delete_objects(client, bucket, keys):
+    for start in range(0, len(keys), 1000):
+        client.delete_objects(Bucket=bucket, Delete={"Objects": [{"Key": k} for k in keys[start:start + 1000]], "Quiet": True})
+
+
+# Each worker process makes its own client, as boto3 clients can't be shared across processes
+_client = None
+
+
+def init_worker(endpoint):
+    global _client
+    _client = s3_client(endpoint)
+
+
+def compact_partition(config, bucket, partition):
+    """Compacts the objects in one partition that no manifest lists yet, and returns a summary."""
+    client = _client
+    started = time.monotonic()
+    output_prefix = config.output_prefix + partition.prefix
+    manifest_key = output_prefix + MANIFEST_NAME
+    manifest = read_manifest(client, bucket, manifest_key) or {"sources": [], "outputs": [], "rows": 0}
+    compacted = {s["key"] for s in manifest["sources"]}
+    sources = [o for o in partition.objects if o.key not in compacted]
+    summary = {"bucket": bucket, "partition": partition.prefix, "objects_in": len(sources), "bytes_in": sum(o.size for o in sources),
+               "objects_out": 0, "bytes_out": 0, "rows": 0}
+
+    if sources:
+        run_id = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+        directory = tempfile.mkdtemp(dir=config.work_dir)
+        outputs = []
+
+        def upload(path, rows):
+            key = f"{output_prefix}part-{run_id}-{len(outputs):05d}.{writer.extension}"
+            size = os.path.getsize(path)
+            client.upload_file(path, bucket, key)
+            os.remove(path)
+            outputs.append({"key": key, "rows": rows, "bytes": size})
+
+        try:
+            writer = WRITERS[config.format](directory, config.target_file_mb * 2 ** 20, config.row_group_mb * 2 ** 20, upload,
+                                            columns=config.columns)
+            for obj in sources:
+                for line in read_lines(client, bucket, obj.key):
+                    writer.add(line)
+            writer.close()
+
+            manifest.update({
+                "bucket": bucket,
+                "partition": partition.prefix,
+                "hour": partition.hour.isoformat(),
+                "format": config.format,
+                "updated": datetime.now(timezone.utc).isoformat(),
+                "sources": manifest["sources"] + [{"key": o.key, "size": o.size, "etag": o.etag} for o in sources],
+                "outputs": manifest["outputs"] + outputs,
+                "rows": manifest["rows"] + sum(o["rows"] for o in outputs)
+            })
+            client.put_object(Bucket=bucket, Key=manifest_key, Body=json.dumps(manifest, indent=1).encode(), ContentType="application/json")
+        except Exception:
+            # Without a manifest entry these files would be duplicated by the next run
+            delete_objects(client, bucket, [o["key"] for o in outputs])
+            raise
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+        summary.update(objects_out=len(outputs), bytes_out=sum(o["bytes"] for o in outputs), rows=sum(o["rows"] for o in outputs))
+
+    if config.delete_sources:
+        # Includes sources a previous run compacted but failed to delete
+        delete_objects(client, bucket, [o.key for o in partition.objects])
+    summary["seconds"] = round(time.monotonic() - started, 2)
+    return summary
+
+
+def run(config, dry_run=False, now=None):
+    """Compacts every ready partition in the configured buckets and returns the totals."""
+    started = time.monotonic()
+    now = now or datetime.now(timezone.utc)
+    grace = timedelta(minutes=config.grace_minutes)
+    lookback = timedelta(hours=config.lookback_hours)
+    client = s3_client(config.s3_endpoint)
+    totals = {"partitions": 0, "failed": 0, "objects_in": 0, "bytes_in": 0, "objects_out": 0, "bytes_out": 0, "rows": 0}
+
+    def collect(futures):
+        for future in futures:
+            try:
+                summary = future.result()
+            except Exception:
+                log.exception("Failed to compact %s", pending[future])
+                totals["failed"] += 1
+                continue
+            if summary["objects_in"]:
+                totals["partitions"] += 1
+            for key in ("objects_in", "bytes_in", "objects_out", "bytes_out", "rows"):
+                totals[key] += summary[key]
+            log.info(json.dumps(summary))
+
+    pending = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=config.workers, initializer=init_worker, initargs=(config.s3_endpoint,)) as pool:
+        for bucket in config.buckets:
+            listing = list_objects(client, bucket, config.source_prefix)
+            for partition in group_partitions(listing, now, grace, lookback, exclude_prefix=config.output_prefix):
+                if dry_run:
+                    print(json.dumps({"bucket": bucket, "partition": partition.prefix, "objects": len(partition.objects), "bytes": partition.size}))
+                    continue
+                pending[pool.submit(compact_partition, config, bucket, partition)] = f"s3://{bucket}/{partition.prefix}"
+                # Keep the listing only a little ahead of the workers
+                if len(pending) >= config.workers * 2:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    collect(done)
+                    for future in done:
+                        pending.pop(future)
+        collect(concurrent.futures.as_completed(pending))
+
+    totals["seconds"] = round(time.monotonic() - started, 1)
+    return totals
+
+
+def emf(namespace, totals):
+    """The run's totals as a CloudWatch Embedded Metric Format document, like the Logstash healthchecks."""
+    units = {"PartitionsCompacted": "Count", "PartitionsFailed": "Count", "ObjectsIn": "Count", "ObjectsOut": "Count",
+             "BytesIn": "Bytes", "BytesOut": "Bytes", "Rows": "Count", "Duration": "Seconds"}
+    values = {"PartitionsCompacted": totals["partitions"], "PartitionsFailed": totals["failed"], "ObjectsIn": totals["objects_in"],
+              "ObjectsOut": totals["objects_out"], "BytesIn": totals["bytes_in"], "BytesOut": totals["bytes_out"],
+              "Rows": totals["rows"], "Duration": totals["seconds"]}
+    return {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": namespace,
+                "Dimensions": [["Job"]],
+                "Metrics": [{"Name": name, "Unit": unit} for name, unit in units.items()]
+            }]
+        },
+        "Job": "compactor",
+        **values
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="List the partitions that are ready without compacting them")
+    args = parser.parse_args()
+
+    config = CompactorConfig.from_env()
+    totals = run(config, dry_run=args.dry_run)
+    log.info(json.dumps({"totals": totals}))
+    if config.metrics_namespace and not args.dry_run:
+        print(json.dumps(emf(config.metrics_namespace, totals)), flush=True)
+    if totals["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=os.environ.get("COMPACT_LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(message)s")
+    main()
@@ -0,0 +1,71 @@
+"""Finds the hourly partitions in an S3 archive listing that are ready to compact.
+
+Logstash's s3 outputs write many small objects under Hive-style prefixes that end in an hour,
+e.g. beat=winlogbeat/version=7.6.2/name=HOST/log_name=Security/year=2020/month=04/day=01/hour=09/.
+S3 lists keys in order, so each partition's objects are listed together and can be grouped as
+the listing streams past, without holding the whole bucket in memory.
+
+No AWS dependencies, so this can be run against synthetic listings.
+"""
+import re
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Iterator, List, Optional
+
+HOUR_PATTERN = re.compile(r"(?:^|/)year=(\d{4})/month=(\d{1,2})/day=(\d{1,2})/hour=(\d{1,2})/$")
+
+
+@dataclass
+class SourceObject:
+    key: str
+    size: int
+    etag: str = None
+
+
+@dataclass
+class Partition:
+    prefix: str
+    hour: datetime
+    objects: List[SourceObject] = field(default_factory=list)
+
+    @property
+    def size(self):
+        return sum(o.size for o in self.objects)
+
+
+def partition_hour(prefix: str) -> Optional[datetime]:
+    """The UTC hour a partition prefix covers, or None when the prefix isn't hourly."""
+    match = HOUR_PATTERN.search(prefix)
+    if not match:
+        return None
+    try:
+        return datetime(*(int(g) for g in match.groups()), tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+
+def is_closed(hour: datetime, now: datetime, grace: timedelta) -> bool:
+    """An hour is closed once it has ended and Logstash has had `grace` to upload its last files."""
+    return hour + timedelta(hours=1) + grace <= now
+
+
+def group_partitions(objects: Iterable[SourceObject], now: datetime, grace: timedelta, lookback: timedelta,
+                     exclude_prefix: str = None) -> Iterator[Partition]:
+    """Yields the closed hourly partitions within `lookback` of `now`, from a listing in key order."""
+    current = None
+    current_prefix = None
+    for obj in objects:
+        if exclude_prefix and obj.key.startswith(exclude_prefix):
+            continue
+        prefix = obj.key[:obj.key.rfind("/") + 1]
+        if prefix != current_prefix:
+            if current is not None:
+                yield current
+            current_prefix = prefix
+            hour = partition_hour(prefix)
+            ready = hour is not None and is_closed(hour, now, grace) and hour >= now - lookback
+            current = Partition(prefix, hour) if ready else None
+        if current is not None:
+            current.objects.append(obj)
+    if current is not None:
+        yield current
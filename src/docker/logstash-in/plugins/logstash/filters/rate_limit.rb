@@ -0,0 +1,130 @@
+# encoding: utf-8
+# Limits the events each source (a host, log name, event ID or any mix of fields) sends, so a
+# misconfigured or flooding source can't swamp the pipeline or the Splunk licence.
+#
+# Each source has a token bucket that holds up to burst events and refills at events_per_second.
+# Events that find their bucket empty are limited, and handled by action:
+#   * drop: the event is dropped
+#   * sample: one in sample_rate limited events is kept, tagged "_sampled"; the rest are dropped
+#   * archive: the event is kept and tagged "_rate_limited", which the outbound beats pipeline
+#     archives to S3 but doesn't send to Splunk
+#
+# Buckets are kept for at most max_sources sources; the least recently seen is forgotten first, so
+# memory stays bounded however many hosts send. Every report_seconds the top_n sources by events
+# per second are reported, with how many of their events were limited.
+#
+# The same file is in both images (logstash-in and logstash-out); keep them identical.
+#
+# Loaded from path.plugins (see config/logstash.yml). Reports limited and evictions (counters) and
+# tracked_sources and top_sources (gauges; top_sources is JSON) in its node stats, which the
+# healthcheck pipeline turns into CloudWatch metrics.
+
+require "logstash/filters/base"
+require "logstash/namespace"
+require "logstash/json"
+require "thread"
+
+class LogStash::Filters::RateLimit < LogStash::Filters::Base
+    config_name "rate_limit"
+
+    # Field references whose values together name an event's source, as a list or comma separated,
+    # e.g. "[host]" or "[@metadata][hostname],[winlog][event_id]"
+    config :fields, :validate => :array, :required => true
+    # 0 turns the limit off, but the top sources are still reported
+    config :events_per_second, :validate => :number, :default => 0
+    # Defaults to 10 seconds of events_per_second when unset or 0
+    config :burst, :validate => :number, :default => 0
+    config :action, :validate => ["drop", "sample", "archive"], :default => "archive"
+    config :sample_rate, :validate => :number, :default => 100
+    config :max_sources, :validate => :number, :default => 10000
+    config :top_n, :validate => :number, :default => 10
+    config :report_seconds, :validate => :number, :default => 60
+
+    LIMITED_TAG = "_rate_limited"
+    SAMPLED_TAG = "_sampled"
+
+    # One source's bucket, its limited events for sampling, and its events since the last report
+    Source = Struct.new(:tokens, :updated, :limited_total, :events, :limited)
+
+    def register
+        @fields = @fields.flat_map { |field| field.split(",") }.map(&:strip).reject(&:empty?)
+        @burst = @events_per_second * 10 if @burst <= 0
+        # Insertion ordered, and each event moves its source to the end, so the first entry is the least recently seen
+        @sources = {}
+        # Filters are shared by the pipeline's workers
+        @lock = Mutex.new
+        @reported = monotonic
+    end
+
+    def filter(event)
+        key = @fields.map { |field| event.get(field) || "-" }.join("/")
+        now = monotonic
+        limited, count, evicted, report = @lock.synchronize { take(key, now) }
+        metric.increment(:evictions) if evicted
+        report_sources(*report) if report
+
+        if limited
+            metric.increment(:limited)
+            if @action == "archive"
+                event.tag(LIMITED_TAG)
+            elsif @action == "sample" && (@sample_rate <= 1 || count % @sample_rate == 1)
+                event.tag(SAMPLED_TAG)
+            else
+                event.cancel
+                return
+            end
+        end
+        filter_matched(event)
+    end
+
+    private
+
+    def monotonic
+        Process.clock_gettime(Process::CLOCK_MONOTONIC)
+    end
+
+    # [limited, limited events from the source so far, evicted, sources to report]; called holding @lock
+    def take(key, now)
+        evicted = false
+        source = @sources.delete(key)
+        if source.nil?
+            if @sources.size >= @max_sources
+                @sources.shift
+                evicted = true
+            end
+            source = Source.new(@burst.to_f, now, 0, 0, 0)
+        end
+        @sources[key] = source
+
+        source.events += 1
+        limited = false
+        if @events_per_second > 0
+            source.tokens = [source.tokens + (now - source.updated) * @events_per_second, @burst.to_f].min
+            source.updated = now
+            if source.tokens >= 1
+                source.tokens -= 1
+            else
+                limited = true
+                source.limited += 1
+                source.limited_total += 1
+            end
+        end
+
+        report = nil
+        if now - @reported >= @report_seconds
+            report = [@sources.map { |name, s| [name, s.events, s.limited] }, now - @reported]
+            @sources.each_value { |s| s.events = 0; s.limited = 0 }
+            @reported = now
+        end
+        [limited, source.limited_total, evicted, report]
+    end
+
+    # Outside @lock, as ranking every tracked source takes a while
+    def report_sources(sources, seconds)
+        top = sources.max_by(@top_n) { |_name, events, _limited| events }.map do |name, events, limited|
+            { "source" => name, "events_per_second" => (events / seconds).round(2), "limited_per_second" => (limited / seconds).round(2) }
+        end
+        metric.gauge(:tracked_sources, sources.size)
+        metric.gauge(:top_sources, LogStash::Json.dump(top))
+    end
+end
@@ -0,0 +1,62 @@
+# Splits an Event Hubs message whose records would make it too large for a Kinesis record
+# (see queue.claim_check in cdk.context.json) into several messages with a share of the records
+# each, in their original order. The processor's 40-azure_event_hubs.conf splits each message
+# into its records anyway, so what is archived is the same.
+#
+# Messages up to max_bytes are passed through without being parsed. A single record larger than
+# max_bytes gets a message of its own, which the claim_check filter stages in S3.
+
+def register(params)
+    @max_bytes = params.fetch("max_bytes", 524288).to_i
+    raise ArgumentError, "max_bytes must be positive, got #{@max_bytes}" unless @max_bytes > 0
+end
+
+def filter(event)
+    message = event.get("message")
+    return [event] unless message.is_a?(String) && message.bytesize > @max_bytes
+
+    data = LogStash::Json.load(message)
+    records = data.is_a?(Hash) ? data["records"] : nil
+    return [event] unless records.is_a?(Array) && records.size > 1
+
+    # The envelope without its records, and a comma between each record
+    overhead = LogStash::Json.dump(data.merge("records" => [])).bytesize
+    chunks = [[]]
+    size = overhead
+    records.each do |record|
+        record_bytes = LogStash::Json.dump(record).bytesize + 1
+        if size + record_bytes > @max_bytes && !chunks.last.empty?
+            chunks << []
+            size = overhead
+        end
+        chunks.last << record
+        size += record_bytes
+    end
+    return [event] if chunks.size == 1
+
+    chunks.map do |chunk|
+        part = event.clone
+        part.set("message", LogStash::Json.dump(data.merge("records" => chunk)))
+        part
+    end
+rescue
+    event.tag("_azure_chunk_failure")
+    [event]
+end
+
+test "small message" do
+    parameters { { "max_bytes" => 100 } }
+    in_event { { "message" => '{"records":[{"a":1},{"a":2}]}' } }
+    expect("passes it through") do |events|
+        events.size == 1 && events.first.get("message") == '{"records":[{"a":1},{"a":2}]}'
+    end
+end
+
+test "large message" do
+    parameters { { "max_bytes" => 60 } }
+    in_event { { "message" => LogStash::Json.dump("records" => (1..6).map { |i| { "id" => i, "pad" => "x" * 10 } }) } }
+    expect("splits the records across messages under max_bytes, in order") do |events|
+        chunks = events.map { |e| LogStash::Json.load(e.get("message"))["records"] }
+        events.size > 1 && events.all? { |e| e.get("message").bytesize <= 60 } && chunks.flatten.map { |r| r["id"] } == (1..6).to_a
+    end
+end
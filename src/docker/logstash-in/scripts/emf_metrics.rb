@@ -0,0 +1,249 @@
+# Turns a _node/stats poll into CloudWatch Embedded Metric Format (EMF) documents.
+# Used by 05-healthcheck.conf, which prints them to stdout for the awslogs driver to ship;
+# CloudWatch extracts the metrics from the log group, so no PutMetricData calls are made.
+#
+# Counters are reported as the change since the previous poll, so use the Sum statistic
+# (per period) instead of RATE(). The first poll after startup only reports JVM gauges.
+#
+# Documents written in one poll share a timestamp:
+#   * one per pipeline (dimension Pipeline): events, durations, worker utilisation and reloads
+#   * one per filter and output plugin (dimensions Pipeline, Plugin) when plugin_metrics is true,
+#     with matches and failures for filters that count them (e.g. grok), the prefix and
+#     upload stats of the s3_archive output, the request and spill stats of the splunk_hec output,
+#     the cache stats of the dedup filter, the limited events and tracked sources of rate_limit and
+#     the oversized events and S3 staging and fetches of claim_check
+#   * one per rank of the rate_limit filter's noisiest sources (dimensions Pipeline, Plugin, Rank),
+#     with the source's name in the Source property, so a search for Rank 1 finds the noisiest host
+#   * one per latency_trace filter report for its pipeline (dimensions Pipeline, Plugin) and one per
+#     stamping service (dimensions Pipeline, Plugin, Source), with the latency percentiles; each
+#     report is only written once, however often the node stats are polled
+#   * one for the JVM (no dimensions): heap and garbage collection
+
+require "json"
+require "net/http"
+
+PIPELINE_COUNTERS = {
+    "EventsIn" => ["in", "Count"],
+    "EventsOut" => ["out", "Count"],
+    "EventsFiltered" => ["filtered", "Count"],
+    "EventDuration" => ["duration_in_millis", "Milliseconds"],
+    "EventsQueuePushDuration" => ["queue_push_duration_in_millis", "Milliseconds"]
+}
+
+# Config reloads, e.g. by the config_sync pipeline
+RELOAD_COUNTERS = {
+    "Reloads" => "successes",
+    "ReloadFailures" => "failures"
+}
+PLUGIN_COUNTERS = {
+    "PluginEventsOut" => ["out", "Count"],
+    "PluginDuration" => ["duration_in_millis", "Milliseconds"]
+}
+# Reported by some plugins alongside their events: parsing filters such as grok and dissect, dedup, rate_limit, claim_check, s3_archive and splunk_hec
+PLUGIN_STAT_COUNTERS = {
+    "PluginMatches" => "matches",
+    "PluginFailures" => "failures",
+    "PluginEvictions" => "evictions",
+    "PluginRotations" => "rotations",
+    "PluginUploads" => "uploads",
+    "PluginUploadFailures" => "upload_failures",
+    "PluginRequests" => "requests",
+    "PluginRequestFailures" => "request_failures",
+    "PluginSpills" => "spills",
+    "PluginDrops" => "drops",
+    "PluginLookups" => "lookups",
+    "PluginDuplicates" => "duplicates",
+    "PluginLimited" => "limited",
+    "PluginUnstamped" => "unstamped",
+    "PluginOversized" => "oversized",
+    "PluginOversizedBytes" => "oversized_bytes",
+    "PluginStaged" => "staged",
+    "PluginStageFailures" => "stage_failures",
+    "PluginFetched" => "fetched",
+    "PluginFetchFailures" => "fetch_failures"
+}
+# Reported as they are, not as a change
+PLUGIN_GAUGES = {
+    "PluginOpenPrefixes" => ["open_prefixes", "Count"],
+    "PluginUploadQueueDepth" => ["upload_queue_depth", "Count"],
+    "PluginPendingBatches" => ["pending_batches", "Count"],
+    "PluginSpillBytes" => ["spill_bytes", "Bytes"],
+    "PluginCacheEntries" => ["cache_entries", "Count"],
+    "PluginCacheBytes" => ["cache_bytes", "Bytes"],
+    "PluginTrackedSources" => ["tracked_sources", "Count"],
+    "PluginLargestBytes" => ["largest_bytes", "Bytes"]
+}
+SOURCE_UNITS = { "SourceEventRate" => "Count/Second", "SourceLimitedRate" => "Count/Second" }
+# The latency_trace filter's report for the pipeline and for each stamping service
+LATENCY_METRICS = {
+    "LatencyEvents" => ["events", "Count"],
+    "LatencyP50" => ["p50", "Milliseconds"],
+    "LatencyP90" => ["p90", "Milliseconds"],
+    "LatencyP99" => ["p99", "Milliseconds"],
+    "LatencyMax" => ["max", "Milliseconds"]
+}
+
+def register(params)
+    @namespace = params.fetch("namespace")
+    @interval_seconds = params.fetch("interval_seconds", 60).to_i
+    @plugin_metrics = params.fetch("plugin_metrics", "true").to_s == "true"
+    @api = params.fetch("api", "http://localhost:9600")
+    # Sub-minute polls are stored as high-resolution metrics
+    @storage_resolution = @interval_seconds < 60 ? 1 : 60
+    @previous = {}
+    @previous_time = nil
+    @workers = {}
+end
+
+def filter(event)
+    now = (Time.now.to_f * 1000).to_i
+    elapsed_ms = @previous_time ? now - @previous_time : nil
+    @previous_time = now
+    documents = []
+
+    (event.get("pipelines") || {}).each do |pipeline_id, pipeline|
+        next if pipeline_id == "healthcheck" || pipeline_id == "config_sync"
+        events = pipeline["events"] || {}
+        values = {}
+        PIPELINE_COUNTERS.each do |name, (key, _unit)|
+            change = delta("#{pipeline_id}/#{key}", events[key])
+            values[name] = change unless change.nil?
+        end
+        reloads = pipeline["reloads"] || {}
+        RELOAD_COUNTERS.each do |name, key|
+            change = delta("#{pipeline_id}/reloads/#{key}", reloads[key])
+            values[name] = change unless change.nil?
+        end
+
+        # Share of the interval the pipeline's workers spent processing events
+        worker_count = workers(pipeline_id)
+        if elapsed_ms && worker_count && values.key?("EventDuration")
+            values["WorkerUtilization"] = [100.0 * values["EventDuration"] / (elapsed_ms * worker_count), 100.0].min.round(2)
+        end
+        units = PIPELINE_COUNTERS.map { |name, (_key, unit)| [name, unit] }.to_h
+            .merge(RELOAD_COUNTERS.keys.map { |name| [name, "Count"] }.to_h)
+            .merge("WorkerUtilization" => "Percent")
+        documents << document(now, { "Pipeline" => pipeline_id }, values, units) unless values.empty?
+
+        next unless @plugin_metrics
+        plugins = pipeline["plugins"] || {}
+        ((plugins["filters"] || []) + (plugins["outputs"] || [])).each do |plugin|
+            plugin_events = plugin["events"] || {}
+            plugin_name = "#{plugin["name"]}/#{plugin["id"]}"
+            values = {}
+            PLUGIN_COUNTERS.each do |name, (key, _unit)|
+                change = delta("#{pipeline_id}/#{plugin["id"]}/#{key}", plugin_events[key])
+                values[name] = change unless change.nil?
+            end
+            PLUGIN_STAT_COUNTERS.each do |name, key|
+                change = delta("#{pipeline_id}/#{plugin["id"]}/#{key}", plugin[key])
+                values[name] = change unless change.nil?
+            end
+            PLUGIN_GAUGES.each do |name, (key, _unit)|
+                values[name] = plugin[key] unless plugin[key].nil?
+            end
+            # Share of the interval's lookups that found a duplicate, for the dedup filter
+            if values["PluginLookups"].to_i > 0 && values.key?("PluginDuplicates")
+                values["PluginDuplicatePct"] = (100.0 * values["PluginDuplicates"] / values["PluginLookups"]).round(2)
+            end
+            units = (PLUGIN_COUNTERS.to_a + PLUGIN_GAUGES.to_a).map { |name, (_key, unit)| [name, unit] }.to_h
+                .merge(PLUGIN_STAT_COUNTERS.keys.map { |name| [name, "Count"] }.to_h)
+                .merge("PluginDuplicatePct" => "Percent", "PluginOversizedBytes" => "Bytes")
+            documents << document(now, { "Pipeline" => pipeline_id, "Plugin" => plugin_name }, values, units) unless values.empty?
+            documents.concat(top_sources(now, pipeline_id, plugin_name, plugin["top_sources"]))
+            documents.concat(latency(now, pipeline_id, plugin_name, plugin["latency"]))
+        end
+    end
+
+    jvm = event.get("jvm")
+    if jvm
+        mem = jvm["mem"] || {}
+        values = {
+            "JvmHeapUsedPct" => mem["heap_used_percent"],
+            "JvmHeapUsedBytes" => mem["heap_used_in_bytes"],
+            "JvmHeapCommittedBytes" => mem["heap_committed_in_bytes"]
+        }
+        units = { "JvmHeapUsedPct" => "Percent", "JvmHeapUsedBytes" => "Bytes", "JvmHeapCommittedBytes" => "Bytes" }
+        ((jvm["gc"] || {})["collectors"] || {}).each do |collector, stats|
+            prefix = "JvmGc#{collector.capitalize}"
+            values["#{prefix}Time"] = delta("gc/#{collector}/time", stats["collection_time_in_millis"])
+            values["#{prefix}Count"] = delta("gc/#{collector}/count", stats["collection_count"])
+            units["#{prefix}Time"] = "Milliseconds"
+            units["#{prefix}Count"] = "Count"
+        end
+        values.reject! { |_name, value| value.nil? }
+        documents << document(now, {}, values, units)
+    end
+
+    return [] if documents.empty?
+    event.set("[@metadata][emf]", documents.map(&:to_json).join("\n"))
+    [event]
+end
+
+# Change in a counter since the last poll; nil on the first poll, and the raw value when Logstash restarted the counter
+def delta(key, value)
+    return nil if value.nil?
+    previous = @previous[key]
+    @previous[key] = value
+    return nil if previous.nil?
+    value >= previous ? value - previous : value
+end
+
+# Worker count from _node/pipelines, looked up once per pipeline
+def workers(pipeline_id)
+    return @workers[pipeline_id] if @workers.key?(pipeline_id)
+    response = Net::HTTP.get_response(URI("#{@api}/_node/pipelines"))
+    return nil unless response.is_a?(Net::HTTPSuccess)
+    JSON.parse(response.body).fetch("pipelines", {}).each do |id, pipeline|
+        @workers[id] = pipeline["workers"]
+    end
+    @workers[pipeline_id]
+rescue StandardError
+    # The API may not be listening yet; try again on the next poll
+    nil
+end
+
+# The rate_limit filter reports its noisiest sources as a JSON list, noisiest first
+def top_sources(timestamp, pipeline_id, plugin_name, report)
+    return [] unless report.is_a?(String)
+    JSON.parse(report).each_with_index.map do |source, index|
+        values = { "SourceEventRate" => source["events_per_second"], "SourceLimitedRate" => source["limited_per_second"] }
+        dimensions = { "Pipeline" => pipeline_id, "Plugin" => plugin_name, "Rank" => (index + 1).to_s }
+        document(timestamp, dimensions, values, SOURCE_UNITS, "Source" => source["source"])
+    end
+rescue JSON::ParserError
+    []
+end
+
+# The latency_trace filter reports its percentiles as JSON once per report_seconds, with the time it reported
+def latency(timestamp, pipeline_id, plugin_name, report)
+    return [] unless report.is_a?(String)
+    report = JSON.parse(report)
+    key = "#{pipeline_id}/#{plugin_name}/latency"
+    return [] if @previous[key] == report["time"]
+    @previous[key] = report["time"]
+    units = LATENCY_METRICS.map { |name, (_key, unit)| [name, unit] }.to_h
+    dimensions = { "Pipeline" => pipeline_id, "Plugin" => plugin_name }
+    summaries = [[dimensions, report["pipeline"] || {}]]
+    (report["sources"] || {}).each { |source, summary| summaries << [dimensions.merge("Source" => source), summary] }
+    summaries.map do |document_dimensions, summary|
+        values = LATENCY_METRICS.map { |name, (key, _unit)| [name, summary[key]] }.to_h.reject { |_name, value| value.nil? }
+        document(timestamp, document_dimensions, values, units)
+    end
+rescue JSON::ParserError
+    []
+end
+
+# Properties are logged with the metrics but aren't dimensions, so they don't create metrics of their own
+def document(timestamp, dimensions, values, units, properties = {})
+    {
+        "_aws" => {
+            "Timestamp" => timestamp,
+            "CloudWatchMetrics" => [{
+                "Namespace" => @namespace,
+                "Dimensions" => [dimensions.keys],
+                "Metrics" => values.keys.map { |name| { "Name" => name, "Unit" => units[name], "StorageResolution" => @storage_resolution } }
+            }]
+        }
+    }.merge(properties).merge(dimensions).merge(values)
+end
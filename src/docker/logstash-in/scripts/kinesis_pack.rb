@@ -0,0 +1,45 @@
+# Packs an event into a compressed envelope before it is written to Kinesis.
+# Used when queue.aggregation.compression is set in cdk.context.json; the processor's
+# 00-parent.conf pipeline restores the original event with kinesis_unpack.rb.
+#
+# Events smaller than min_bytes are passed through untouched, as the base64 envelope
+# costs more than compression saves on short syslog lines.
+
+require "base64"
+require "stringio"
+require "zlib"
+
+CODECS = ["none", "gzip"]
+
+def register(params)
+    @compression = params.fetch("compression", "gzip")
+    @min_bytes = params.fetch("min_bytes", 0).to_i
+
+    unless CODECS.include?(@compression)
+        raise ArgumentError, "Unsupported Kinesis compression '#{@compression}', expected one of #{CODECS.join(', ')}"
+    end
+end
+
+def filter(event)
+    return [event] if @compression == "none"
+
+    payload = event.to_json
+    return [event] if payload.bytesize < @min_bytes
+
+    packed = LogStash::Event.new(
+        "@packed" => {
+            "codec" => @compression,
+            "data" => Base64.strict_encode64(gzip(payload))
+        }
+    )
+    packed.set("@metadata", event.get("@metadata"))
+    [packed]
+end
+
+def gzip(data)
+    io = StringIO.new("".b)
+    writer = Zlib::GzipWriter.new(io)
+    writer.write(data)
+    writer.close
+    io.string
+end
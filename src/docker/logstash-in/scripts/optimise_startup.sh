@@ -0,0 +1,47 @@
+#!/bin/bash
+# Run at build time by the Dockerfile when STARTUP_MODE=optimised, to cut what every new task does
+# before it accepts events (see docs/logstash.md):
+#   1. Removes the bundled plugins that no pipeline in the image uses, so there are fewer gems to load
+#   2. Dumps a class data sharing (CDS) archive of the JDK's classes, which each JVM maps at start
+#      instead of loading and verifying them again
+#   3. Adds JVM options that skip bytecode verification and never block on /dev/random for entropy
+#
+# Plugins are kept if a pipeline names them (`kinesis {`) or uses them as a codec (`codec => json`),
+# and so are every codec and anything listed in KEEP_PLUGINS (space separated).
+# The same file is in both images (logstash-in and logstash-out); keep them identical.
+set -euo pipefail
+
+LOGSTASH_HOME=/usr/share/logstash
+# The custom config_sync input and s3_archive output use the AWS SDK that the s3 output brings in
+KEEP_PLUGINS="logstash-output-s3 ${KEEP_PLUGINS:-}"
+
+# Plugin names the pipelines refer to
+used=$(cat ${LOGSTASH_HOME}/pipeline/*.conf \
+    | sed -e 's/#.*//' \
+    | grep -oE '(^|[[:space:]])[a-z_0-9]+[[:space:]]*\{|codec[[:space:]]*=>[[:space:]]*"?[a-z_0-9]+' \
+    | grep -oE '[a-z_0-9]+[[:space:]]*\{?$' | tr -d '{ ' | sort -u)
+
+unused=()
+for plugin in $(${LOGSTASH_HOME}/bin/logstash-plugin list 2>/dev/null | grep -E '^logstash-(input|filter|output|integration)-'); do
+    name=${plugin#logstash-*-}
+    if ! grep -qx "${name}" <<< "${used}" && ! grep -qw "${plugin}" <<< "${KEEP_PLUGINS}"; then
+        unused+=("${plugin}")
+    fi
+done
+if [ ${#unused[@]} -gt 0 ]; then
+    echo "Removing unused plugins: ${unused[*]}"
+    # One at a time when removing them together fails, e.g. when one is another's dependency
+    ${LOGSTASH_HOME}/bin/logstash-plugin remove "${unused[@]}" \
+        || for plugin in "${unused[@]}"; do ${LOGSTASH_HOME}/bin/logstash-plugin remove "${plugin}" || true; done
+fi
+
+# The JDK's own classes; Corretto 8 can't archive application classes (AppCDS needs JDK 10 or later)
+java -Xshare:dump
+
+cat >> ${LOGSTASH_HOME}/config/jvm.options <<'OPTIONS'
+
+## Startup optimisations (scripts/optimise_startup.sh)
+-Xshare:auto
+-Xverify:none
+-Djava.security.egd=file:/dev/./urandom
+OPTIONS
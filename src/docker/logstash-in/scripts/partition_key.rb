@@ -0,0 +1,150 @@
+# Sets [@metadata][partition_key], which the kinesis output uses to choose each event's shard.
+# Configured per inbound service with the partitioning node in cdk.context.json.
+#
+# Strategies:
+#   * random: a new key for every event, which spreads events evenly over the shards
+#   * host: the first of host_fields the event has (e.g. the beat's hostname, or the syslog sender)
+#   * field: the first of fields the event has
+#
+# With host and field, each source's events go to one shard in order, so the processor task that
+# leases the shard sees all of them and can keep per-source state in memory. A source that sends
+# more than hot_key_bytes_per_second through this task in a window_seconds window is salted for the
+# next window: its key gets one of salt_buckets suffixes in turn, spreading it over that many shards
+# (and losing its ordering) until it cools down. Events with none of the fields get a random key.
+#
+# Each pipeline worker counts bytes on its own, without a lock, and adds its counts to the shared
+# window when its own window ends. Events are sized by their message when it's a string; others are
+# serialised once every sample_every events of their key, and the sizes in between are estimated.
+#
+# The test blocks below run when the pipeline starts and stop it if the script is broken.
+
+require "securerandom"
+
+STRATEGIES = ["random", "host", "field"]
+# Kinesis partition keys are at most 256 characters, which leaves room for a salt suffix
+MAX_KEY_LENGTH = 240
+
+# One pipeline worker's counts for its current window
+WorkerWindow = Struct.new(:started, :bytes, :sizes, :sequence)
+
+def register(params)
+    @strategy = params.fetch("strategy", "random")
+    unless STRATEGIES.include?(@strategy)
+        raise ArgumentError, "Unsupported partitioning strategy '#{@strategy}', expected one of #{STRATEGIES.join(', ')}"
+    end
+    fields = @strategy == "host" ? params.fetch("host_fields", "") : params.fetch("fields", "")
+    @fields = fields.split(",").map(&:strip).reject(&:empty?)
+    if @strategy == "field" && @fields.empty?
+        raise ArgumentError, "The field partitioning strategy needs at least one field"
+    end
+    @salt_buckets = params.fetch("salt_buckets", 8).to_i
+    @hot_key_bytes_per_second = params.fetch("hot_key_bytes_per_second", 262144).to_f
+    @window_seconds = params.fetch("window_seconds", 10).to_f
+    @sample_every = params.fetch("sample_every", 100).to_i
+
+    # Bytes per key that workers have added to the current window, and the keys salted for it.
+    # The lock is only taken when a worker's window ends; @hot is replaced rather than changed
+    @lock = Mutex.new
+    @bytes = Hash.new(0)
+    @hot = {}
+    @window_started = now
+    # Each worker thread's WorkerWindow is a thread local under this name, unique to this filter
+    @worker_key = :"partition_key_#{object_id}"
+end
+
+def filter(event)
+    key = nil
+    @fields.each do |field|
+        value = event.get(field)
+        next if value.nil? || value == ""
+        key = value.to_s[0, MAX_KEY_LENGTH]
+        break
+    end
+    event.set("[@metadata][partition_key]", key ? salt(key, event) : SecureRandom.uuid)
+    [event]
+end
+
+def salt(key, event)
+    window = worker_window
+    window.bytes[key] += event_bytes(window, key, event)
+    return key unless @hot.key?(key) && @salt_buckets > 1
+    window.sequence += 1
+    "#{key}##{window.sequence % @salt_buckets}"
+end
+
+# This worker's window, after adding the last one's counts to the shared window once it's over
+def worker_window
+    time = now
+    window = Thread.current[@worker_key]
+    if window.nil?
+        window = Thread.current[@worker_key] = WorkerWindow.new(time, Hash.new(0), {}, 0)
+    elsif time - window.started >= @window_seconds
+        roll_window(window.bytes, time)
+        window.started = time
+        window.bytes = Hash.new(0)
+        window.sizes = {}
+    end
+    window
+end
+
+# Adds a worker's counts to the shared window, and starts a new one once it's over, salting the keys that were hot in it
+def roll_window(bytes, time)
+    @lock.synchronize do
+        bytes.each { |key, count| @bytes[key] += count }
+        elapsed = time - @window_started
+        return if elapsed < @window_seconds
+        limit = @hot_key_bytes_per_second * elapsed
+        hot = {}
+        @bytes.each { |key, count| hot[key] = true if count > limit }
+        @hot = hot
+        @bytes = Hash.new(0)
+        @window_started = time
+    end
+end
+
+# Syslog events are mostly their message. Others are serialised as they'll be written, for the first
+# of every sample_every events of a key in the worker's window, and take that size until the next
+def event_bytes(window, key, event)
+    message = event.get("message")
+    return message.bytesize if message.is_a?(String)
+    size, count = window.sizes[key]
+    size = event.to_json.bytesize if count.nil? || count % @sample_every == 0
+    window.sizes[key] = [size, (count || 0) + 1]
+    size
+end
+
+def now
+    Process.clock_gettime(Process::CLOCK_MONOTONIC)
+end
+
+test "random" do
+    parameters { { "strategy" => "random" } }
+    in_event { { "message" => "hello", "host" => "10.0.0.1" } }
+    expect("sets a random key") do |events|
+        events.first.get("[@metadata][partition_key]").length == 36
+    end
+end
+
+test "host" do
+    parameters { { "strategy" => "host", "host_fields" => "[agent][hostname], [host][name]" } }
+    in_event { { "message" => "hello", "host" => { "name" => "WKS00001" } } }
+    expect("uses the first host field the event has") do |events|
+        events.first.get("[@metadata][partition_key]") == "WKS00001"
+    end
+end
+
+test "field on events without a string message" do
+    parameters { { "strategy" => "field", "fields" => "[observer][name]", "sample_every" => "2" } }
+    in_event { { "message" => { "records" => [] }, "observer" => { "name" => "fw01" } } }
+    expect("sizes the event and uses the field") do |events|
+        events.first.get("[@metadata][partition_key]") == "fw01"
+    end
+end
+
+test "field without a value" do
+    parameters { { "strategy" => "field", "fields" => "[observer][name]" } }
+    in_event { { "message" => "hello" } }
+    expect("falls back to a random key") do |events|
+        events.first.get("[@metadata][partition_key]").length == 36
+    end
+end
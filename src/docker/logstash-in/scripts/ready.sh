@@ -0,0 +1,17 @@
+#!/bin/bash
+# Container health check: succeeds once every pipeline in config/pipelines.yml, or every pipeline named
+# as an argument, is running. Logstash only lists a pipeline in its node stats once its inputs have
+# started, so a task that passes is accepting events, not just running a JVM.
+#
+# Used by the ECS container health check when a service has a `readiness` node in cdk.context.json.
+# The same file is in both images (logstash-in and logstash-out); keep them identical.
+
+pipelines=("$@")
+if [ ${#pipelines[@]} -eq 0 ]; then
+    mapfile -t pipelines < <(sed -n 's/^- pipeline\.id: *\([^ ]*\).*/\1/p' /usr/share/logstash/config/pipelines.yml)
+fi
+
+stats=$(curl -sf --max-time 4 "http://localhost:9600/_node/stats/pipelines") || exit 1
+for pipeline in "${pipelines[@]}"; do
+    grep -q "\"${pipeline}\":{" <<< "${stats}" || exit 1
+done
@@ -0,0 +1,141 @@
+# encoding: utf-8
+# Moves events too large for a Kinesis record (1 MiB) through an S3 staging bucket, so they are
+# archived like any other event instead of being rejected by Kinesis and lost.
+#
+# With mode "stage" (logstash-in, the last filter before the kinesis output) each event is
+# serialised as the kinesis output would write it. One larger than max_bytes is gzipped to
+# `<prefix>/YYYY/MM/DD/HH/<uuid>.json.gz` in the bucket and replaced by a small reference,
+# { "@claim_check" => { "bucket", "key", "bytes" } }, which keeps the event's @metadata (and so
+# its partition key). Without a bucket, or when the upload fails, the event is passed on unchanged.
+#
+# With mode "fetch" (logstash-out's parent pipeline, first after the kinesis input) each reference
+# is replaced by the event it points at, before dedup or any child pipeline sees it. References to
+# any bucket but the configured one are refused. An event that can't be fetched keeps its
+# reference and is tagged _claim_check_failure, so it is archived by the fallback pipeline and can
+# be replayed from the staging bucket by hand until the bucket's lifecycle rule expires it.
+#
+# The size check serialises every event once more, which costs about as much as the kinesis
+# output's own serialisation; it is only configured when queue.claim_check is set.
+#
+# The same file is in both images (logstash-in and logstash-out); keep them identical.
+#
+# Loaded from path.plugins (see config/logstash.yml). Reports oversized, oversized_bytes, staged,
+# stage_failures, fetched and fetch_failures (counters) and largest_bytes (a gauge) in its node
+# stats, which the healthcheck pipeline turns into CloudWatch metrics.
+
+require "logstash/filters/base"
+require "logstash/namespace"
+require "logstash/json"
+require "logstash/plugin_mixins/aws_config"
+require "aws-sdk"
+require "securerandom"
+require "stringio"
+require "zlib"
+
+class LogStash::Filters::ClaimCheck < LogStash::Filters::Base
+    include LogStash::PluginMixins::AwsConfig::V2
+
+    config_name "claim_check"
+
+    config :mode, :validate => ["stage", "fetch"], :required => true
+    # The staging bucket; an empty value leaves oversized events unchanged (stage) or refuses every reference (fetch)
+    config :bucket, :validate => :string, :default => ""
+    # Key prefix for staged events, e.g. the inbound service's name
+    config :prefix, :validate => :string, :default => ""
+    # Largest serialised event sent through Kinesis as it is
+    config :max_bytes, :validate => :number, :default => 1_000_000
+    config :target, :validate => :string, :default => "[@claim_check]"
+    # Passed to the S3 client, e.g. { "force_path_style" => true }
+    config :additional_settings, :validate => :hash, :default => {}
+
+    FAILURE_TAG = "_claim_check_failure"
+
+    def register
+        @prefix = @prefix.split("/").reject(&:empty?).join("/")
+        @largest = 0
+        @client = Aws::S3::Client.new(client_options) unless @bucket.empty?
+        if @mode == "stage" && @client.nil?
+            @logger.warn("No staging bucket, so events over max_bytes are passed to Kinesis unchanged", :max_bytes => @max_bytes)
+        end
+    end
+
+    def filter(event, &block)
+        @mode == "stage" ? stage(event, &block) : fetch(event, &block)
+    end
+
+    private
+
+    def stage(event)
+        payload = event.to_json
+        size = payload.bytesize
+        # Events from several workers race here, but a missed maximum is corrected by the next one
+        if size > @largest
+            @largest = size
+            metric.gauge(:largest_bytes, size)
+        end
+        return filter_matched(event) if size <= @max_bytes
+
+        metric.increment(:oversized)
+        metric.increment(:oversized_bytes, size)
+        return filter_matched(event) if @client.nil?
+
+        key = staging_key
+        begin
+            @client.put_object(bucket: @bucket, key: key, body: gzip(payload), content_type: "application/json", content_encoding: "gzip")
+        rescue => e
+            metric.increment(:stage_failures)
+            @logger.warn("Couldn't stage an oversized event, so it is passed to Kinesis unchanged", :bytes => size, :key => key, :error => e.message)
+            return filter_matched(event)
+        end
+        metric.increment(:staged)
+
+        reference = LogStash::Event.new
+        reference.set(@target, { "bucket" => @bucket, "key" => key, "bytes" => size })
+        reference.set("@metadata", event.get("@metadata"))
+        filter_matched(reference)
+        yield reference
+        event.cancel
+    end
+
+    def fetch(event)
+        claim = event.get(@target)
+        return filter_matched(event) unless claim.is_a?(Hash)
+
+        begin
+            if claim["bucket"] != @bucket
+                raise ArgumentError, "references a bucket other than the staging bucket #{@bucket.inspect}"
+            end
+            body = @client.get_object(bucket: claim["bucket"], key: claim["key"]).body.read
+            restored = LogStash::Event.new(LogStash::Json.load(Zlib::GzipReader.new(StringIO.new(body)).read))
+        rescue => e
+            metric.increment(:fetch_failures)
+            @logger.warn("Couldn't fetch a staged event, so its reference is passed on", :claim => claim, :error => e.message)
+            event.tag(FAILURE_TAG)
+            return filter_matched(event)
+        end
+        metric.increment(:fetched)
+
+        restored.set("@metadata", event.get("@metadata"))
+        filter_matched(restored)
+        yield restored
+        event.cancel
+    end
+
+    def staging_key
+        path = Time.now.utc.strftime("%Y/%m/%d/%H/#{SecureRandom.uuid}.json.gz")
+        @prefix.empty? ? path : "#{@prefix}/#{path}"
+    end
+
+    def gzip(data)
+        io = StringIO.new("".b)
+        writer = Zlib::GzipWriter.new(io)
+        writer.write(data)
+        writer.close
+        io.string
+    end
+
+    def client_options
+        options = aws_options_hash || {}
+        options.merge(@additional_settings.map { |key, value| [key.to_sym, value] }.to_h)
+    end
+end
@@ -0,0 +1,176 @@
+# encoding: utf-8
+# Drops (or tags) events the processor has already seen within the last ttl seconds.
+#
+# Duplicates reach the processor when winlogbeat resends after a connection reset, when Kinesis
+# delivers a record twice, and when the KCL replays records after a lease moves. Each event is
+# fingerprinted from the listed fields, or from the whole event less ignore_fields when it has none
+# of them, and the fingerprint is looked up in one of two stores, both held within memory_mib:
+#   * cache: the fingerprints themselves, oldest first, expired after ttl and evicted early when the
+#     budget is full. Exact, so an event is never mistaken for a duplicate.
+#   * bloom: two Bloom filters, the current one and the one before it, swapped every ttl. Holds many
+#     more fingerprints in the same memory, but a small share of unique events look like duplicates.
+#
+# The store is in memory, so it only sees the events of its own task. Partitioning inbound
+# services by host keeps a source's events, and their duplicates, on one shard and so one task.
+#
+# Loaded from path.plugins (see config/logstash.yml). Reports lookups, duplicates and evictions
+# (counters) and cache_entries and cache_bytes (gauges) in its node stats, which the healthcheck
+# pipeline turns into CloudWatch metrics.
+
+require "logstash/filters/base"
+require "logstash/namespace"
+require "logstash/json"
+require "digest"
+require "thread"
+
+class LogStash::Filters::Dedup < LogStash::Filters::Base
+    config_name "dedup"
+
+    # Field references that together identify an event, as a list or comma separated, e.g.
+    # "[winlog][computer_name],[winlog][channel],[winlog][record_id]"
+    config :fields, :validate => :array, :default => []
+    config :ttl, :validate => :number, :default => 600
+    config :memory_mib, :validate => :number, :default => 64
+    config :mode, :validate => ["cache", "bloom"], :default => "cache"
+    config :action, :validate => ["drop", "tag"], :default => "drop"
+    # Added to duplicates when action is "tag"
+    config :duplicate_tag, :validate => :string, :default => "_duplicate"
+    # Top-level fields left out of a whole event's fingerprint because they differ between copies of
+    # it, such as the receive stamp of the latency_trace filter
+    config :ignore_fields, :validate => :array, :default => ["latency_trace"]
+
+    GAUGE_SECONDS = 5
+
+    # Fingerprints in insertion order, which with one ttl for all is also expiry order
+    class Cache
+        # Estimated heap for one entry: the hash entry, its key and its expiry
+        ENTRY_BYTES = 96
+
+        def initialize(memory_bytes, ttl)
+            @capacity = [memory_bytes / ENTRY_BYTES, 1].max
+            @ttl = ttl
+            @entries = {}
+        end
+
+        # [duplicate, evictions]
+        def check(digest, now)
+            key = digest.unpack("q").first
+            evictions = 0
+            while (oldest = @entries.first) && oldest[1] <= now
+                @entries.shift
+            end
+            return [true, 0] if @entries.key?(key)
+            if @entries.size >= @capacity
+                @entries.shift
+                evictions = 1
+            end
+            @entries[key] = now + @ttl
+            [false, evictions]
+        end
+
+        def entries
+            @entries.size
+        end
+
+        def bytes
+            @entries.size * ENTRY_BYTES
+        end
+    end
+
+    # Two generations of Bloom filter, so a fingerprint is remembered for between ttl and twice ttl
+    class Bloom
+        HASHES = 5
+
+        def initialize(memory_bytes, ttl, now)
+            @size = [memory_bytes / 2, 1].max
+            @bits = @size * 8
+            @ttl = ttl
+            @current = new_generation
+            @previous = new_generation
+            @rotated = now
+            @entries = 0
+        end
+
+        def check(digest, now)
+            if now - @rotated >= @ttl
+                @previous = @current
+                @current = new_generation
+                @rotated = now
+                @entries = 0
+            end
+            # Double hashing over 32 bit halves of the digest keeps the arithmetic in fixnums
+            h1, h2 = digest.unpack("LL")
+            h2 |= 1
+            positions = Array.new(HASHES) { |i| (h1 + i * h2) % @bits }
+            return [true, 0] if set?(@current, positions) || set?(@previous, positions)
+            positions.each { |p| @current.setbyte(p >> 3, @current.getbyte(p >> 3) | (1 << (p & 7))) }
+            @entries += 1
+            [false, 0]
+        end
+
+        # Fingerprints added to the current generation
+        def entries
+            @entries
+        end
+
+        def bytes
+            @size * 2
+        end
+
+        private
+
+        def new_generation
+            ("\0" * @size).force_encoding(Encoding::BINARY)
+        end
+
+        def set?(generation, positions)
+            positions.all? { |p| generation.getbyte(p >> 3)[p & 7] == 1 }
+        end
+    end
+
+    def register
+        @fields = @fields.flat_map { |field| field.split(",") }.map(&:strip).reject(&:empty?)
+        memory_bytes = (@memory_mib * 1024 * 1024).to_i
+        now = Time.now.to_i
+        @store = @mode == "bloom" ? Bloom.new(memory_bytes, @ttl.to_i, now) : Cache.new(memory_bytes, @ttl.to_i)
+        # Filters are shared by the pipeline's workers
+        @lock = Mutex.new
+        @gauged = 0
+    end
+
+    def filter(event)
+        digest = fingerprint(event)
+        now = Time.now.to_i
+        duplicate, evictions = @lock.synchronize { @store.check(digest, now) }
+        metric.increment(:lookups)
+        metric.increment(:evictions, evictions) if evictions > 0
+        gauge(now) if now - @gauged >= GAUGE_SECONDS
+
+        if duplicate
+            metric.increment(:duplicates)
+            @action == "drop" ? event.cancel : event.tag(@duplicate_tag)
+        else
+            filter_matched(event)
+        end
+    end
+
+    private
+
+    # MD5 is enough to tell events apart; nothing here needs to resist collisions made on purpose
+    def fingerprint(event)
+        values = @fields.map { |field| event.get(field) }
+        return Digest::MD5.digest(LogStash::Json.dump(values)) unless values.compact.empty?
+        ignored = @ignore_fields.select { |field| event.include?(field) }
+        return Digest::MD5.digest(event.to_json) if ignored.empty?
+        hash = event.to_hash
+        ignored.each { |field| hash.delete(field) }
+        Digest::MD5.digest(LogStash::Json.dump(hash))
+    end
+
+    def gauge(now)
+        @gauged = now
+        entries, bytes = @lock.synchronize { [@store.entries, @store.bytes] }
+        metric.gauge(:cache_entries, entries)
+        metric.gauge(:cache_bytes, bytes)
+    end
+end
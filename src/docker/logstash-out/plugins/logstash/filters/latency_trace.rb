@@ -0,0 +1,180 @@
+# encoding: utf-8
+# Measures how long events take from the inbound service that received them to the outbound
+# pipeline that archives them, so the staleness of the data in S3 is known for each source.
+#
+# With mode "stamp" (logstash-in) each event gets a target field holding the time it was stamped,
+# in epoch milliseconds, and the name of the service that stamped it. The field is an ordinary
+# one, so it survives Kinesis, compression and the processor's split of Azure batches.
+#
+# With mode "measure" (logstash-out, in each child pipeline before its outputs) the time since
+# the stamp is counted in a histogram per stamping service and one for the whole pipeline, and
+# the field is removed unless keep is set. Every report_seconds the count, p50, p90, p99 and
+# maximum of each are reported, and with slowest set, the slowest events of the interval are
+# logged with their trace_fields.
+#
+# The histograms have four buckets per power of two, so a percentile is reported as the top of
+# its bucket, at most 25% over the true value. Latency is measured across two hosts' clocks, so
+# values below the clock skew between tasks (a few milliseconds with NTP) read as 0.
+#
+# The same file is in both images (logstash-in and logstash-out); keep them identical.
+#
+# Loaded from path.plugins (see config/logstash.yml). Reports measured and unstamped (counters)
+# and latency (a gauge; JSON) in its node stats, which the healthcheck pipeline turns into
+# CloudWatch metrics.
+
+require "logstash/filters/base"
+require "logstash/namespace"
+require "logstash/json"
+require "thread"
+
+class LogStash::Filters::LatencyTrace < LogStash::Filters::Base
+    config_name "latency_trace"
+
+    config :mode, :validate => ["stamp", "measure"], :required => true
+    config :target, :validate => :string, :default => "[latency_trace]"
+    # The name stamped on each event, e.g. the inbound service's name
+    config :service, :validate => :string, :default => "unknown"
+    # Leave the stamp on measured events, so it is archived with them
+    config :keep, :validate => :boolean, :default => false
+    config :report_seconds, :validate => :number, :default => 60
+    # Slowest events logged each report; 0 logs none
+    config :slowest, :validate => :number, :default => 0
+    # Field references logged with each slow event, e.g. "[host][name]"
+    config :trace_fields, :validate => :array, :default => []
+    # Stamping services with a histogram of their own; events from others only count for the pipeline
+    config :max_sources, :validate => :number, :default => 100
+
+    # 4 exact buckets for 0-3 ms, then 4 per power of two up to 2^31 ms
+    BUCKETS = 4 + 29 * 4
+    PERCENTILES = { "p50" => 0.5, "p90" => 0.9, "p99" => 0.99 }
+
+    # One histogram's bucket counts, event count and largest value
+    Histogram = Struct.new(:counts, :events, :max)
+
+    def register
+        @fields = @trace_fields.flat_map { |field| field.split(",") }.map(&:strip).reject(&:empty?)
+        @received_field = "#{@target}[received_ms]"
+        @service_field = "#{@target}[service]"
+        @histograms = {}
+        @total = new_histogram
+        # [latency, event details] of the interval's slowest events, slowest first
+        @slow = []
+        # Filters are shared by the pipeline's workers
+        @lock = Mutex.new
+        @reported = monotonic
+    end
+
+    def filter(event)
+        if @mode == "stamp"
+            event.set(@received_field, now_ms)
+            event.set(@service_field, @service)
+            return filter_matched(event)
+        end
+
+        received = event.get(@received_field)
+        unless received.is_a?(Integer)
+            metric.increment(:unstamped)
+            return filter_matched(event)
+        end
+        latency = [now_ms - received, 0].max
+        source = event.get(@service_field).to_s
+        event.remove(@target) unless @keep
+        metric.increment(:measured)
+
+        report = @lock.synchronize { record(source, latency, event) }
+        report_latency(*report) if report
+        filter_matched(event)
+    end
+
+    private
+
+    def now_ms
+        Process.clock_gettime(Process::CLOCK_REALTIME, :millisecond)
+    end
+
+    def monotonic
+        Process.clock_gettime(Process::CLOCK_MONOTONIC)
+    end
+
+    def new_histogram
+        Histogram.new(Array.new(BUCKETS, 0), 0, 0)
+    end
+
+    def bucket(latency)
+        return latency if latency < 4
+        exponent = [latency.bit_length - 1, 30].min
+        4 + (exponent - 2) * 4 + ((latency >> (exponent - 2)) & 3)
+    end
+
+    # The largest latency that falls in a bucket
+    def bucket_top(index)
+        return index if index < 4
+        exponent = (index - 4) / 4 + 2
+        ((4 + (index - 4) % 4 + 1) << (exponent - 2)) - 1
+    end
+
+    # The histograms and slow events to report, when one is due; called holding @lock
+    def record(source, latency, event)
+        histogram = @histograms[source]
+        if histogram.nil? && @histograms.size < @max_sources
+            histogram = @histograms[source] = new_histogram
+        end
+        index = bucket(latency)
+        add(histogram, index, latency) unless histogram.nil?
+        add(@total, index, latency)
+        # Only events slower than the slowest kept so far pay for their details
+        if @slowest > 0 && (@slow.size < @slowest || latency > @slow.last[0])
+            position = @slow.bsearch_index { |entry| entry[0] < latency } || @slow.size
+            @slow.insert(position, [latency, details(source, latency, event)])
+            @slow.pop if @slow.size > @slowest
+        end
+
+        now = monotonic
+        return nil if now - @reported < @report_seconds
+        report = [@total, @histograms, @slow]
+        @total = new_histogram
+        @histograms = {}
+        @slow = []
+        @reported = now
+        report
+    end
+
+    def add(histogram, index, latency)
+        histogram.counts[index] += 1
+        histogram.events += 1
+        histogram.max = latency if latency > histogram.max
+    end
+
+    def details(source, latency, event)
+        fields = @fields.map { |field| [field, event.get(field)] }.to_h
+        { "source" => source, "latency_ms" => latency }.merge(fields)
+    end
+
+    # Outside @lock, as reading every bucket takes a while
+    def report_latency(total, histograms, slow)
+        report = {
+            "time" => now_ms,
+            "pipeline" => summary(total),
+            "sources" => histograms.map { |source, histogram| [source, summary(histogram)] }.to_h
+        }
+        metric.gauge(:latency, LogStash::Json.dump(report))
+        @logger.info("Slowest events", :events => slow.map(&:last)) unless slow.empty?
+    end
+
+    def summary(histogram)
+        result = { "events" => histogram.events, "max" => histogram.max }
+        return result if histogram.events == 0
+        PERCENTILES.each do |name, share|
+            rank = (share * histogram.events).ceil
+            seen = 0
+            histogram.counts.each_with_index do |count, index|
+                seen += count
+                if seen >= rank
+                    result[name] = [bucket_top(index), histogram.max].min
+                    break
+                end
+            end
+        end
+        result
+    end
+end
@@ -0,0 +1,318 @@
+# encoding: utf-8
+# Keeps the pipeline configs, grok patterns and filter scripts of a running task in step with a
+# bundle in S3, so a config change reaches the service without a new image or new tasks.
+#
+# The bundle is a gzipped tar of pipelines/, patterns/ and scripts/, laid out like
+# src/docker/logstash-in and logstash-out. Every interval seconds the input checks its ETag, and
+# when it has changed:
+#   1. stages the bundle over a copy of the live config and runs `logstash --config.test_and_exit`
+#      on it, which checks every pipeline in pipelines.yml; the bundle is rejected if that fails
+#   2. writes the changed files over the live ones, scripts and patterns first. With
+#      config.reload.automatic, Logstash then reloads only the pipelines whose file changed, so a
+#      header line on each .conf holds a digest of the scripts and patterns it uses, and a
+#      pipeline also reloads when they change
+#   3. waits for those pipelines to reload, from the node stats API, and puts the previous files
+#      back if one fails or doesn't reload within verify_timeout, so Logstash goes back to the
+#      config that was running
+# A bundle that is rejected or rolled back isn't tried again until it changes. Files the bundle
+# doesn't have are left as they are, and files outside those directories, of other types or in
+# protected are ignored.
+#
+# Reloading a pipeline stops its inputs, drains its queue and starts it again. The processor's
+# child pipelines reload without losing events, since the parent waits for them to come back; a
+# change to 00-parent.conf restarts the Kinesis input, and a change to an inbound pipeline its
+# listeners.
+#
+# Loaded from path.plugins (see config/logstash.yml). Emits an event for each bundle it applies,
+# rejects or rolls back, and counts them (applied, rejected, rollbacks) in its node stats.
+# The same file is in both images (logstash-in and logstash-out); keep them identical.
+
+require "logstash/inputs/base"
+require "logstash/namespace"
+require "logstash/plugin_mixins/aws_config"
+require "aws-sdk"
+require "digest"
+require "fileutils"
+require "json"
+require "net/http"
+require "open3"
+require "rubygems/package"
+require "stringio"
+require "stud/interval"
+require "tmpdir"
+require "yaml"
+require "zlib"
+
+class LogStash::Inputs::ConfigSync < LogStash::Inputs::Base
+    include LogStash::PluginMixins::AwsConfig::V2
+
+    config_name "config_sync"
+
+    # Nothing is synced while this is empty
+    config :bucket, :validate => :string, :default => ""
+    config :key, :validate => :string, :default => "config.tar.gz"
+    # Seconds between checks for a new bundle
+    config :interval, :validate => :number, :default => 30
+    # Seconds to wait for the changed pipelines to reload before rolling back
+    config :verify_timeout, :validate => :number, :default => 120
+    # Heap for the `logstash --config.test_and_exit` run that validates a bundle
+    config :validate_heap, :validate => :string, :default => "384m"
+    # Paths in the bundle that are never applied, such as this pipeline's own config
+    config :protected, :validate => :array, :default => ["pipelines/05-config_sync.conf"]
+    config :home, :validate => :string, :default => "/usr/share/logstash"
+    config :api, :validate => :string, :default => "http://localhost:9600"
+    config :temporary_directory, :validate => :string, :default => File.join(Dir.tmpdir, "logstash", "config_sync")
+    # Passed to the S3 client, e.g. { "force_path_style" => true }
+    config :additional_settings, :validate => :hash, :default => {}
+
+    # Directory in the bundle => [directory under home, the files it may hold]
+    DIRECTORIES = {
+        "pipelines" => ["pipeline", /\A[\w.-]+\.conf\z/],
+        "patterns" => ["patterns", /\A[\w.-]+\z/],
+        "scripts" => ["scripts", /\A[\w.-]+\.(rb|yml)\z/]
+    }
+    HEADER = "# config_sync "
+    VERIFY_POLL_SECONDS = 2
+
+    def register
+        @client = Aws::S3::Client.new(client_options) unless @bucket.empty?
+        # The last bundle applied, and the last one rejected or rolled back
+        @applied_etag = nil
+        @skipped_etag = nil
+        FileUtils.mkdir_p(@temporary_directory)
+    end
+
+    def run(queue)
+        if @bucket.empty?
+            # Stay running, so the pipeline counts as started (see scripts/ready.sh)
+            @logger.info("No bucket to sync pipeline config from")
+            Stud.stoppable_sleep(@interval) { stop? } until stop?
+            return
+        end
+        until stop?
+            begin
+                sync(queue)
+            rescue => e
+                @logger.warn("Failed to sync pipeline config", :bucket => @bucket, :key => @key, :error => e.message)
+            end
+            Stud.stoppable_sleep(@interval) { stop? }
+        end
+    end
+
+    private
+
+    def sync(queue)
+        head = begin
+            @client.head_object(:bucket => @bucket, :key => @key)
+        rescue Aws::S3::Errors::NotFound
+            return
+        end
+        etag = head.etag
+        return if etag == @applied_etag || etag == @skipped_etag
+
+        bundle, ignored = read_bundle(@client.get_object(:bucket => @bucket, :key => @key).body.read)
+        details = { "etag" => etag, "version_id" => head.version_id, "ignored" => ignored }
+
+        error = validate(bundle)
+        if error
+            @skipped_etag = etag
+            return report(queue, :rejected, details.merge("error" => error))
+        end
+
+        before = pipeline_stats
+        changes = changed_files(bundle)
+        pipelines = pipelines_for(changes.keys)
+        details.update("files" => changes.keys.map { |path| path.sub("#{@home}/", "") }, "pipelines" => pipelines)
+        previous = {}
+        begin
+            write_files(changes, previous)
+            error = verify(pipelines, before)
+        rescue
+            write_files(previous)
+            raise
+        end
+        if error
+            write_files(previous)
+            @skipped_etag = etag
+            return report(queue, :rollbacks, details.merge("error" => error))
+        end
+        @applied_etag = etag
+        report(queue, :applied, details)
+    end
+
+    # {path in the bundle => content} for the files that can be applied, and the paths that can't
+    def read_bundle(data)
+        bundle = {}
+        ignored = []
+        tar = Gem::Package::TarReader.new(Zlib::GzipReader.new(StringIO.new(data)))
+        tar.each do |entry|
+            next unless entry.file?
+            path = entry.full_name.sub(%r{\A\./}, "")
+            directory, name = path.split("/", 2)
+            rule = DIRECTORIES[directory]
+            if rule.nil? || name.nil? || !(name =~ rule[1]) || @protected.include?(path)
+                ignored << path
+            else
+                bundle[path] = entry.read || ""
+            end
+        end
+        [bundle, ignored]
+    ensure
+        tar.close if tar
+    end
+
+    # Runs Logstash's own config test over a copy of the live config with the bundle on top; nil when it passes
+    def validate(bundle)
+        staging = Dir.mktmpdir("bundle", @temporary_directory)
+        DIRECTORIES.each_value do |live, _pattern|
+            FileUtils.mkdir_p(File.join(staging, live))
+            FileUtils.cp_r(Dir.glob(File.join(@home, live, "*")), File.join(staging, live))
+        end
+        bundle.each { |path, content| File.write(File.join(staging, live_path(path).sub("#{@home}/", "")), content) }
+        bundle.each do |path, content|
+            next unless path.end_with?(".yml")
+            begin
+                YAML.load(content)
+            rescue Psych::SyntaxError => e
+                return "#{path}: #{e.message}"
+            end
+        end
+
+        settings = File.join(staging, "config")
+        FileUtils.cp_r(File.join(@home, "config"), settings)
+        pipelines_yml = File.join(settings, "pipelines.yml")
+        File.write(pipelines_yml, File.read(pipelines_yml).gsub("#{@home}/pipeline/", "#{staging}/pipeline/"))
+        env = { "LS_JAVA_OPTS" => "-Xms64m -Xmx#{@validate_heap}", "CONFIG_RELOAD_AUTOMATIC" => "false" }
+        output, status = Open3.capture2e(env, File.join(@home, "bin", "logstash"), "--path.settings", settings,
+                                         "--path.data", File.join(staging, "data"), "--path.logs", File.join(staging, "logs"),
+                                         "--config.test_and_exit")
+        return nil if status.success?
+        errors = output.lines.grep(/ERROR|FATAL/)
+        (errors.empty? ? output.lines : errors).last(5).join.strip
+    ensure
+        FileUtils.rm_rf(staging) if staging
+    end
+
+    # {live path => new content} for every file the bundle changes, including the .conf files whose
+    # scripts or patterns change, which get a new header so that Logstash reloads their pipelines
+    def changed_files(bundle)
+        incoming = bundle.map { |path, content| [live_path(path), content] }.to_h
+        current = {}
+        DIRECTORIES.each_value do |live, _pattern|
+            Dir.glob(File.join(@home, live, "*")).each { |path| current[path] = File.read(path) if File.file?(path) }
+        end
+        merged = current.merge(incoming)
+
+        changes = incoming.reject { |path, content| path.end_with?(".conf") || current[path] == content }
+        merged.each do |path, content|
+            next unless path.end_with?(".conf")
+            header, body = split_header(content)
+            live_header, live_body = split_header(current[path] || "")
+            digest = dependencies_digest(body, merged)
+            header = digest if digest != dependencies_digest(live_body, current)
+            header ||= live_header if incoming.key?(path)
+            updated = header ? "#{HEADER}#{header}\n#{body}" : body
+            changes[path] = updated if updated != current[path]
+        end
+        changes
+    end
+
+    def split_header(content)
+        return [nil, content] unless content.start_with?(HEADER)
+        header, body = content.split("\n", 2)
+        [header.sub(HEADER, ""), body || ""]
+    end
+
+    # Digest of the scripts a pipeline names, and of every pattern file when it uses the patterns directory
+    def dependencies_digest(body, files)
+        scripts_dir = File.join(@home, "scripts", "")
+        patterns_dir = File.join(@home, "patterns")
+        used = files.keys.sort.select do |path|
+            (path.start_with?(scripts_dir) && body.include?(path)) ||
+                (path.start_with?(patterns_dir) && body.include?(patterns_dir))
+        end
+        Digest::SHA256.hexdigest(used.map { |path| "#{path}\0#{files[path]}" }.join("\0"))[0, 16]
+    end
+
+    # Writes files in place, scripts and patterns before pipelines, and records what was there before
+    # in previous, with nil for files that didn't exist, which writing back deletes
+    def write_files(changes, previous = {})
+        changes.sort_by { |path, _content| path.end_with?(".conf") ? 1 : 0 }.each do |path, content|
+            previous[path] = File.file?(path) ? File.read(path) : nil
+            if content.nil?
+                FileUtils.rm_f(path)
+            else
+                FileUtils.mkdir_p(File.dirname(path))
+                temporary = File.join(File.dirname(path), ".#{File.basename(path)}.sync")
+                File.write(temporary, content)
+                File.rename(temporary, path)
+            end
+        end
+    end
+
+    def live_path(path)
+        directory, name = path.split("/", 2)
+        File.join(@home, DIRECTORIES[directory][0], name)
+    end
+
+    # The IDs of the pipelines in pipelines.yml whose .conf is one of paths
+    def pipelines_for(paths)
+        names = paths.select { |path| path.end_with?(".conf") }.map { |path| File.basename(path) }
+        entries = YAML.safe_load(File.read(File.join(@home, "config", "pipelines.yml"))) || []
+        entries.select { |entry| names.include?(File.basename(expand(entry["path.config"].to_s))) }.map { |entry| entry["pipeline.id"] }
+    end
+
+    # Substitutes ${NAME} and ${NAME:default} like Logstash does
+    def expand(value)
+        value.gsub(/\$\{([a-zA-Z_.][a-zA-Z0-9_.]*)(?::([^}]*))?\}/) { ENV.fetch($1, $2.to_s) }
+    end
+
+    # Waits for each pipeline to reload; nil when they all did, otherwise why not
+    def verify(pipelines, before)
+        pending = pipelines.dup
+        deadline = Time.now + @verify_timeout
+        until pending.empty?
+            return "#{pending.join(", ")} did not reload within #{@verify_timeout}s" if Time.now > deadline || stop?
+            Stud.stoppable_sleep(VERIFY_POLL_SECONDS) { stop? }
+            stats = pipeline_stats
+            pending.dup.each do |id|
+                reloads = (stats[id] || {})["reloads"] || {}
+                previous = before[id] || {}
+                if reloads["failures"].to_i > previous["failures"].to_i
+                    message = (reloads["last_error"] || {})["message"]
+                    return "#{id} failed to reload: #{message}"
+                end
+                pending.delete(id) if reloads["successes"].to_i > previous["successes"].to_i
+            end
+        end
+        nil
+    end
+
+    # {pipeline ID => reloads} from the node stats API
+    def pipeline_stats
+        response = Net::HTTP.get_response(URI("#{@api}/_node/stats/pipelines"))
+        return {} unless response.is_a?(Net::HTTPSuccess)
+        (JSON.parse(response.body)["pipelines"] || {}).map { |id, pipeline| [id, { "reloads" => pipeline["reloads"] }] }.to_h
+    rescue StandardError
+        {}
+    end
+
+    def report(queue, result, details)
+        metric.increment(result)
+        outcome = { :rejected => "rejected", :rollbacks => "rolled_back", :applied => "applied" }[result]
+        log_details = details.merge("bucket" => @bucket, "key" => @key)
+        if result == :applied
+            @logger.info("Applied pipeline config bundle", log_details)
+        else
+            @logger.warn("Pipeline config bundle #{outcome.tr("_", " ")}", log_details)
+        end
+        event = LogStash::Event.new("config_sync" => log_details.merge("result" => outcome))
+        decorate(event)
+        queue << event
+    end
+
+    def client_options
+        options = aws_options_hash || {}
+        options.merge(@additional_settings.map { |key, value| [key.to_sym, value] }.to_h)
+    end
+end
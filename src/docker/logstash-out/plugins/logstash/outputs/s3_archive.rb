@@ -0,0 +1,264 @@
+# encoding: utf-8
+# Archives events to S3 in the same layout as the s3 output, for prefixes with a high cardinality
+# (e.g. one per host and log name).
+#
+# The s3 output keeps a temporary file open for every prefix it has seen, and closes and uploads
+# them all together every time_file minutes. With thousands of hosts that is thousands of open
+# files, more heap and ephemeral disk, and a burst of small uploads every time_file. This output:
+#   * keeps at most max_open_prefixes files open, and closes the least recently written one
+#     when another prefix needs a file
+#   * shortens each file's time_file by a random share of up to time_file_jitter, so files
+#     opened together are not closed together
+#   * uploads closed files from a queue of at most upload_queue_size files with upload_workers
+#     threads; when the queue is full the pipeline waits, which bounds the disk used
+#
+# Loaded from path.plugins (see config/logstash.yml). Reports open_prefixes and upload_queue_depth
+# (gauges) and evictions, rotations, uploads and upload_failures (counters) in its node stats,
+# which the healthcheck pipeline turns into CloudWatch metrics.
+
+require "logstash/outputs/base"
+require "logstash/namespace"
+require "logstash/plugin_mixins/aws_config"
+require "aws-sdk"
+require "fileutils"
+require "securerandom"
+require "thread"
+require "tmpdir"
+require "zlib"
+
+class LogStash::Outputs::S3Archive < LogStash::Outputs::Base
+    include LogStash::PluginMixins::AwsConfig::V2
+
+    config_name "s3_archive"
+    concurrency :shared
+    default :codec, "json_lines"
+
+    config :bucket, :validate => :string, :required => true
+    # Supports field references, e.g. "name=%{[@metadata][hostname]}/year=%{+YYYY}"
+    config :prefix, :validate => :string, :default => ""
+    # Bytes on disk before a file is closed and uploaded
+    config :size_file, :validate => :number, :default => 5 * 1024 * 1024
+    # Minutes before a file is closed and uploaded
+    config :time_file, :validate => :number, :default => 15
+    # Largest share of time_file taken off each file's deadline at random, from 0 to 1
+    config :time_file_jitter, :validate => :number, :default => 0.25
+    config :max_open_prefixes, :validate => :number, :default => 1000
+    config :upload_workers, :validate => :number, :default => 4
+    config :upload_queue_size, :validate => :number, :default => 16
+    config :encoding, :validate => ["none", "gzip"], :default => "none"
+    config :canned_acl, :validate => ["private", "public-read", "public-read-write", "authenticated-read", "aws-exec-read", "bucket-owner-read", "bucket-owner-full-control", "log-delivery-write"], :default => "private"
+    config :temporary_directory, :validate => :string, :default => File.join(Dir.tmpdir, "logstash", "s3_archive")
+    # Upload files left in temporary_directory by a previous run
+    config :restore, :validate => :boolean, :default => true
+    # Seconds between attempts to upload a file; uploads are retried until they succeed
+    config :retry_delay, :validate => :number, :default => 1
+    # Passed to the S3 client, e.g. { "force_path_style" => true }
+    config :additional_settings, :validate => :hash, :default => {}
+
+    SWEEP_SECONDS = 5
+
+    # A temporary file for one prefix. Only written and closed while holding its lock.
+    class ArchiveFile
+        attr_reader :key, :path, :deadline, :lock
+
+        def initialize(key, path, gzip, deadline)
+            @key = key
+            @path = path
+            @deadline = deadline
+            @lock = Mutex.new
+            @file = File.open(path, "ab")
+            @io = gzip ? Zlib::GzipWriter.new(@file) : @file
+            @written = false
+            @closed = false
+        end
+
+        # The file's size on disk, or nil once it has been closed so the caller opens a new one
+        def write(data)
+            return nil if @closed
+            @io.write(data)
+            @written = true
+            @file.size
+        end
+
+        # True when the file holds events to upload
+        def close
+            return false if @closed
+            @closed = true
+            @io.close
+            @written
+        end
+    end
+
+    def register
+        @bucket_resource = Aws::S3::Bucket.new(@bucket, client_options)
+        @upload_options = { :acl => @canned_acl }
+        @upload_options[:content_encoding] = "gzip" if @encoding == "gzip"
+        FileUtils.mkdir_p(@temporary_directory)
+
+        # Insertion ordered, and each write moves its prefix to the end, so the first entry is the least recently written
+        @files = {}
+        @lock = Mutex.new
+        @queue = SizedQueue.new(@upload_queue_size)
+        @workers = Array.new(@upload_workers) { Thread.new { upload_loop } }
+        restore_files if @restore
+
+        @stopping = false
+        @sweeper = Thread.new do
+            until @stopping
+                sleep(SWEEP_SECONDS)
+                sweep
+            end
+        end
+    end
+
+    def multi_receive_encoded(events_and_encoded)
+        events_and_encoded.each do |event, encoded|
+            prefix = clean_prefix(event.sprintf(@prefix))
+            loop do
+                file = open_file(prefix)
+                # Another thread may have closed the file since it was looked up
+                size = file.lock.synchronize { file.write(encoded) }
+                next if size.nil?
+                rotate(prefix, file) if size >= @size_file
+                break
+            end
+        end
+    end
+
+    def close
+        @stopping = true
+        @sweeper.wakeup if @sweeper.alive?
+        @sweeper.join
+        files = @lock.synchronize do
+            open = @files.values
+            @files.clear
+            open
+        end
+        files.each { |file| finish(file) }
+        @workers.size.times { @queue.push(:stop) }
+        @workers.each(&:join)
+    end
+
+    private
+
+    def client_options
+        options = aws_options_hash || {}
+        options.merge(@additional_settings.map { |key, value| [key.to_sym, value] }.to_h)
+    end
+
+    # S3 keys can't start with "/", and ".." would escape the temporary directory
+    def clean_prefix(prefix)
+        prefix.split("/").reject { |part| part.empty? || part == "." || part == ".." }.join("/")
+    end
+
+    def open_file(prefix)
+        evicted = nil
+        file = @lock.synchronize do
+            file = @files.delete(prefix)
+            if file.nil?
+                evicted = @files.shift[1] if @files.size >= @max_open_prefixes
+                file = new_file(prefix)
+            end
+            @files[prefix] = file
+        end
+        if evicted
+            metric.increment(:evictions)
+            finish(evicted)
+        end
+        file
+    end
+
+    def new_file(prefix)
+        extension = @encoding == "gzip" ? "txt.gz" : "txt"
+        name = "ls.s3.#{SecureRandom.uuid}.#{Time.now.utc.strftime("%Y-%m-%dT%H.%M")}.part0.#{extension}"
+        key = prefix.empty? ? name : "#{prefix}/#{name}"
+        # Kept flat, with the key alongside for restore_files, so prefixes don't leave directories behind
+        path = File.join(@temporary_directory, name)
+        File.write("#{path}.key", key)
+        deadline = Time.now + @time_file * 60 * (1 - rand * @time_file_jitter)
+        ArchiveFile.new(key, path, @encoding == "gzip", deadline)
+    end
+
+    # Closes a full file, unless another thread already has
+    def rotate(prefix, file)
+        current = @lock.synchronize { @files.delete(prefix) if @files[prefix].equal?(file) }
+        return unless current
+        metric.increment(:rotations)
+        finish(file)
+    end
+
+    # Closes files past their deadline, least recently written first
+    def sweep
+        now = Time.now
+        expired = @lock.synchronize do
+            due = @files.select { |_prefix, file| file.deadline <= now }
+            due.each_key { |prefix| @files.delete(prefix) }
+            due.values
+        end
+        metric.increment(:rotations, expired.size) unless expired.empty?
+        expired.each { |file| finish(file) }
+        metric.gauge(:open_prefixes, @lock.synchronize { @files.size })
+        metric.gauge(:upload_queue_depth, @queue.size)
+    rescue => e
+        @logger.error("Failed to close expired files", :exception => e.class, :message => e.message)
+    end
+
+    # Blocks while the upload queue is full
+    def finish(file)
+        if file.lock.synchronize { file.close }
+            @queue.push([file.key, file.path])
+        else
+            FileUtils.rm_f([file.path, "#{file.path}.key"])
+        end
+    end
+
+    def upload_loop
+        loop do
+            job = @queue.pop
+            break if job == :stop
+            key, path = job
+            begin
+                @bucket_resource.object(key).upload_file(path, @upload_options)
+                FileUtils.rm_f([path, "#{path}.key"])
+                metric.increment(:uploads)
+            rescue => e
+                metric.increment(:upload_failures)
+                @logger.warn("Failed to upload file, retrying", :key => key, :exception => e.class, :message => e.message)
+                sleep(@retry_delay)
+                retry
+            end
+        end
+    end
+
+    # Queues files left by a previous run. Their gzip streams were never finished, so they are rewritten first.
+    def restore_files
+        FileUtils.rm_f(Dir.glob(File.join(@temporary_directory, "*.recovering")))
+        Dir.glob(File.join(@temporary_directory, "*.key")).sort.each do |key_path|
+            path = key_path.chomp(".key")
+            key = File.read(key_path)
+            if !File.file?(path) || (path.end_with?(".gz") && !recover_gzip(path))
+                FileUtils.rm_f([path, key_path])
+                next
+            end
+            @logger.info("Uploading file left by a previous run", :key => key)
+            @queue.push([key, path])
+        end
+    end
+
+    # Rewrites what can be read of an unfinished gzip file; false when nothing could be
+    def recover_gzip(path)
+        recovered = "#{path}.recovering"
+        bytes = 0
+        Zlib::GzipWriter.open(recovered) do |out|
+            File.open(path, "rb") do |file|
+                begin
+                    reader = Zlib::GzipReader.new(file)
+                    loop { bytes += out.write(reader.readpartial(16384)) }
+                rescue EOFError, Zlib::Error
+                end
+            end
+        end
+        File.rename(recovered, path)
+        bytes > 0
+    end
+end
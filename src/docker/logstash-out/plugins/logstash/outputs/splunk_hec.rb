@@ -0,0 +1,397 @@
+# encoding: utf-8
+# Sends events to a Splunk HTTP Event Collector (HEC), without a Universal Forwarder in between.
+#
+# Events are added to a batch, which is sent when it holds batch_size events or batch_bytes of
+# JSON, or when its first event is linger_ms old. Batches are gzip compressed and sent by
+# max_in_flight threads, each holding a keep-alive connection to the collector.
+#
+# Sending never holds up the pipeline, so a slow or unreachable collector doesn't hold up the
+# pipeline's other outputs (e.g. the S3 archive):
+#   * sealed batches wait in a queue of at most queue_size batches in memory
+#   * when that is full they spill to files in spill_directory, and are sent from there once the
+#     collector catches up. Spilled files left by a previous run are sent after a restart.
+#   * when the spilled files reach max_spill_bytes, new batches are dropped (on_spill_full => "drop")
+#     or the pipeline waits (on_spill_full => "block")
+#
+# Batches the collector refuses as malformed (400) or too large (413) are dropped; any other
+# failure is retried with a backoff of up to retry_max_interval seconds.
+#
+# Loaded from path.plugins (see config/logstash.yml). Reports pending_batches and spill_bytes
+# (gauges) and requests, request_failures, spills and drops (counters) in its node stats, which
+# the healthcheck pipeline turns into CloudWatch metrics.
+
+require "logstash/outputs/base"
+require "logstash/namespace"
+require "logstash/json"
+require "fileutils"
+require "net/http"
+require "openssl"
+require "stringio"
+require "thread"
+require "tmpdir"
+require "uri"
+require "zlib"
+
+class LogStash::Outputs::SplunkHec < LogStash::Outputs::Base
+    config_name "splunk_hec"
+    concurrency :shared
+
+    # The collector, e.g. https://splunk.example.com:8088. Events are posted to /services/collector/event
+    # unless the URL has a path. When empty the output is disabled and drops what it receives.
+    config :url, :validate => :string, :default => ""
+    config :token, :validate => :password
+    # HEC metadata for each event. Support field references; empty values are left for the token's defaults.
+    config :index, :validate => :string, :default => ""
+    config :source, :validate => :string, :default => ""
+    config :sourcetype, :validate => :string, :default => ""
+    config :host, :validate => :string, :default => ""
+    config :batch_size, :validate => :number, :default => 500
+    # Bytes of JSON, before compression
+    config :batch_bytes, :validate => :number, :default => 1024 * 1024
+    # Milliseconds before a batch that isn't full is sent
+    config :linger_ms, :validate => :number, :default => 1000
+    # Requests sent at once, each on its own keep-alive connection
+    config :max_in_flight, :validate => :number, :default => 4
+    # Sealed batches held in memory before they spill to disk
+    config :queue_size, :validate => :number, :default => 8
+    config :compression, :validate => ["none", "gzip"], :default => "gzip"
+    config :spill_directory, :validate => :string, :default => File.join(Dir.tmpdir, "logstash", "splunk_hec")
+    config :max_spill_bytes, :validate => :number, :default => 1024 * 1024 * 1024
+    config :on_spill_full, :validate => ["drop", "block"], :default => "drop"
+    # Seconds
+    config :timeout, :validate => :number, :default => 30
+    config :keep_alive_timeout, :validate => :number, :default => 30
+    config :retry_initial_interval, :validate => :number, :default => 1
+    config :retry_max_interval, :validate => :number, :default => 60
+    # Seconds to keep sending queued batches on shutdown; the rest spill to disk
+    config :shutdown_timeout, :validate => :number, :default => 10
+    config :ssl_verify, :validate => :boolean, :default => true
+
+    DEFAULT_PATH = "/services/collector/event"
+    SPILL_PATTERN = /\Ahec\.\d+\.(\d+)\.(gz|json)\z/
+    # Refused for what the batch holds, so sending it again won't help
+    DROPPED_STATUSES = [400, 413]
+    DROP_WARNING_SECONDS = 60
+
+    # A sealed batch, in memory or spilled to `path`
+    Batch = Struct.new(:payload, :count, :path, :size)
+
+    # Batches waiting to be sent: up to `memory_size` in memory, then spilled to files of up to
+    # `max_spill_bytes` in all. Oldest first within each; memory is sent before disk, since HEC
+    # indexes events by their own time.
+    class BatchQueue
+        attr_reader :spill_bytes
+
+        def initialize(directory, extension, memory_size, max_spill_bytes)
+            @directory = directory
+            @extension = extension
+            @memory_size = memory_size
+            @max_spill_bytes = max_spill_bytes
+            @memory = []
+            @spilled = []
+            @spill_bytes = 0
+            @sequence = 0
+            @closed = false
+            @lock = Mutex.new
+            @cond = ConditionVariable.new
+        end
+
+        # Adds spilled files left by a previous run
+        def restore
+            files = Dir.glob(File.join(@directory, "hec.*")).select { |path| File.basename(path) =~ SPILL_PATTERN }.sort
+            @lock.synchronize do
+                files.each do |path|
+                    size = File.size(path)
+                    @spilled << Batch.new(nil, File.basename(path)[SPILL_PATTERN, 1].to_i, path, size)
+                    @spill_bytes += size
+                end
+                @cond.broadcast
+            end
+            files.size
+        end
+
+        # :memory or :spilled, or :full when the batch didn't fit and `block` is false
+        def push(batch, block)
+            @lock.synchronize do
+                loop do
+                    if @memory.size < @memory_size
+                        @memory << batch
+                        @cond.broadcast
+                        return :memory
+                    end
+                    if @spill_bytes + batch.payload.bytesize <= @max_spill_bytes
+                        spill(batch)
+                        @cond.broadcast
+                        return :spilled
+                    end
+                    return :full unless block
+                    @cond.wait(@lock)
+                end
+            end
+        end
+
+        # Blocks until there is a batch. Once closed, returns nil when memory is empty or the deadline has passed.
+        def pop
+            @lock.synchronize do
+                loop do
+                    if @closed
+                        return nil if @memory.empty? || Time.now >= @closed
+                        return @memory.shift.tap { @cond.broadcast }
+                    end
+                    return @memory.shift.tap { @cond.broadcast } unless @memory.empty?
+                    return @spilled.shift unless @spilled.empty?
+                    @cond.wait(@lock)
+                end
+            end
+        end
+
+        # Returns a batch that couldn't be sent to the disk, e.g. at shutdown
+        def put_back(batch)
+            @lock.synchronize do
+                if batch.path
+                    @spilled.unshift(batch)
+                else
+                    spill(batch, true)
+                end
+            end
+        end
+
+        # Forgets a batch that was sent or dropped
+        def release(batch)
+            return unless batch.path
+            FileUtils.rm_f(batch.path)
+            @lock.synchronize do
+                @spill_bytes -= batch.size
+                @cond.broadcast
+            end
+        end
+
+        # Stops handing out spilled batches, and memory ones after `deadline`
+        def close(deadline)
+            @lock.synchronize do
+                @closed = deadline
+                @cond.broadcast
+            end
+        end
+
+        # Spills what is left in memory, for the next run
+        def drain
+            @lock.synchronize do
+                @memory.each { |batch| spill(batch, true) }
+                count = @memory.size
+                @memory.clear
+                count
+            end
+        end
+
+        def depth
+            @lock.synchronize { @memory.size + @spilled.size }
+        end
+
+        private
+
+        # Written to a temporary name first, so restore never sees half a file
+        def spill(batch, shutdown = false)
+            @sequence += 1
+            name = format("hec.%d%06d.%d.%s", (Time.now.to_f * 1_000_000).to_i, @sequence % 1_000_000, batch.count, @extension)
+            path = File.join(@directory, name)
+            File.binwrite("#{path}.tmp", batch.payload)
+            File.rename("#{path}.tmp", path)
+            size = batch.payload.bytesize
+            @spill_bytes += size
+            @spilled << Batch.new(nil, batch.count, path, size) unless shutdown
+        end
+    end
+
+    def register
+        @enabled = !@url.to_s.strip.empty?
+        unless @enabled
+            @logger.info("No url set, so events are dropped")
+            return
+        end
+        @uri = URI.parse(@url)
+        @path = @uri.path.to_s.empty? || @uri.path == "/" ? DEFAULT_PATH : @uri.path
+        @headers = {
+            "Content-Type" => "application/json",
+            "Authorization" => "Splunk #{@token && @token.value}"
+        }
+        @headers["Content-Encoding"] = "gzip" if @compression == "gzip"
+
+        FileUtils.mkdir_p(@spill_directory)
+        FileUtils.rm_f(Dir.glob(File.join(@spill_directory, "*.tmp")))
+        @queue = BatchQueue.new(@spill_directory, @compression == "gzip" ? "gz" : "json", @queue_size, @max_spill_bytes)
+        restored = @queue.restore
+        @logger.info("Sending batches spilled by a previous run", :batches => restored) if restored > 0
+
+        # The open batch; only touched while holding @lock
+        @lock = Mutex.new
+        @lines = []
+        @bytes = 0
+        @opened = nil
+
+        @stopping = false
+        @senders = Array.new(@max_in_flight) { Thread.new { send_loop } }
+        @linger = Thread.new do
+            until @stopping
+                sleep([@linger_ms / 4000.0, 0.05].max)
+                seal_expired
+            end
+        end
+    end
+
+    def multi_receive(events)
+        return unless @enabled
+        events.each do |event|
+            line = envelope(event)
+            full = @lock.synchronize do
+                @opened ||= Time.now
+                @lines << line
+                @bytes += line.bytesize + 1
+                take if @lines.size >= @batch_size || @bytes >= @batch_bytes
+            end
+            enqueue(full) if full
+        end
+    end
+
+    def close
+        return unless @enabled
+        @stopping = true
+        @linger.wakeup if @linger.alive?
+        @linger.join
+        remaining = @lock.synchronize { take }
+        enqueue(remaining) if remaining
+        @queue.close(Time.now + @shutdown_timeout)
+        @senders.each(&:join)
+        spilled = @queue.drain
+        @logger.info("Spilled unsent batches to disk for the next run", :batches => spilled) if spilled > 0
+    end
+
+    private
+
+    # The HEC event envelope. The event's own JSON is spliced in, so it is only serialised once.
+    def envelope(event)
+        fields = { "time" => event.get("@timestamp").to_f.round(3) }
+        { "host" => @host, "source" => @source, "sourcetype" => @sourcetype, "index" => @index }.each do |name, format|
+            next if format.empty?
+            value = event.sprintf(format)
+            fields[name] = value unless value.empty?
+        end
+        "#{LogStash::Json.dump(fields).chomp("}")},\"event\":#{event.to_json}}"
+    end
+
+    # Returns the open batch's lines and starts a new one; called holding @lock
+    def take
+        return nil if @lines.empty?
+        lines = @lines
+        @lines = []
+        @bytes = 0
+        @opened = nil
+        lines
+    end
+
+    def seal_expired
+        expired = @lock.synchronize { take if @opened && Time.now - @opened >= @linger_ms / 1000.0 }
+        enqueue(expired) if expired
+        metric.gauge(:pending_batches, @queue.depth)
+        metric.gauge(:spill_bytes, @queue.spill_bytes)
+    rescue => e
+        @logger.error("Failed to send expired batch", :exception => e.class, :message => e.message)
+    end
+
+    # Compresses outside @lock, so pipeline workers aren't held up by each other's batches
+    def enqueue(lines)
+        body = lines.join("\n")
+        payload = @compression == "gzip" ? gzip(body) : body
+        case @queue.push(Batch.new(payload, lines.size), @on_spill_full == "block")
+        when :spilled
+            metric.increment(:spills)
+        when :full
+            metric.increment(:drops, lines.size)
+            # Once per DROP_WARNING_SECONDS, as every batch is dropped until the collector catches up
+            now = Time.now
+            if @last_drop_warning.nil? || now - @last_drop_warning >= DROP_WARNING_SECONDS
+                @last_drop_warning = now
+                @logger.warn("Spill directory is full, dropping batches", :events => lines.size, :spill_bytes => @queue.spill_bytes)
+            end
+        end
+    end
+
+    def gzip(body)
+        io = StringIO.new("".b)
+        writer = Zlib::GzipWriter.new(io, Zlib::BEST_SPEED)
+        writer.write(body)
+        writer.close
+        io.string
+    end
+
+    def send_loop
+        http = nil
+        while (batch = @queue.pop)
+            batch.payload ||= File.binread(batch.path)
+            http = deliver(http, batch)
+        end
+    rescue => e
+        @logger.error("Sender stopped", :exception => e.class, :message => e.message)
+    ensure
+        disconnect(http)
+    end
+
+    # Sends a batch until it is accepted or refused, and returns the connection to reuse
+    def deliver(http, batch)
+        delay = @retry_initial_interval
+        loop do
+            begin
+                http ||= connect
+                response = http.request(post(batch))
+                status = response.code.to_i
+                if status == 200
+                    metric.increment(:requests)
+                    @queue.release(batch)
+                    return http
+                end
+                metric.increment(:request_failures)
+                if DROPPED_STATUSES.include?(status)
+                    metric.increment(:drops, batch.count)
+                    @logger.error("Collector refused batch, dropping it", :status => status, :events => batch.count, :response => response.body.to_s[0, 512])
+                    @queue.release(batch)
+                    return http
+                end
+                @logger.warn("Collector failed batch, retrying", :status => status, :response => response.body.to_s[0, 512], :retry_in => delay)
+            rescue IOError, SystemCallError, SocketError, Timeout::Error, OpenSSL::SSL::SSLError, Net::HTTPBadResponse => e
+                metric.increment(:request_failures)
+                @logger.warn("Failed to send batch, retrying", :exception => e.class, :message => e.message, :retry_in => delay)
+                disconnect(http)
+                http = nil
+            end
+            # Waits out the backoff, unless shutting down, when the batch is kept on disk for the next run
+            deadline = Time.now + delay
+            sleep(0.1) until @stopping || Time.now >= deadline
+            if @stopping
+                @queue.put_back(batch)
+                return http
+            end
+            delay = [delay * 2, @retry_max_interval].min
+        end
+    end
+
+    def connect
+        http = Net::HTTP.new(@uri.host, @uri.port)
+        http.use_ssl = @uri.scheme == "https"
+        http.verify_mode = OpenSSL::SSL::VERIFY_NONE if http.use_ssl? && !@ssl_verify
+        http.open_timeout = @timeout
+        http.read_timeout = @timeout
+        http.keep_alive_timeout = @keep_alive_timeout
+        http.start
+    end
+
+    def disconnect(http)
+        http.finish if http && http.started?
+    rescue IOError
+    end
+
+    def post(batch)
+        request = Net::HTTP::Post.new(@path, @headers)
+        request.body = batch.payload
+        request
+    end
+end
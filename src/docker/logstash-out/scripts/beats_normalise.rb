@@ -0,0 +1,85 @@
+# Resolves the fields 30-beats.conf needs for routing and S3 prefixes across Beats v6 and v7
+# schemas in one pass, driven by the mapping table in beats_fields.yml.
+#
+# The table is compiled once on register, so each event costs one lookup per candidate field
+# until a value is found; adding fields or agent versions only adds rows to the table.
+#
+# The test blocks below run when the pipeline starts and stop it if a mapping is broken.
+
+require "yaml"
+
+def register(params)
+    mapping = YAML.safe_load(File.read(params.fetch("mapping", "/usr/share/logstash/scripts/beats_fields.yml")))
+    @fields = mapping.map do |row|
+        unless row["target"] && row["sources"].is_a?(Array) && !row["sources"].empty?
+            raise ArgumentError, "Each beats field mapping needs a target and a list of sources: #{row.inspect}"
+        end
+        unless [nil, "integer"].include?(row["type"])
+            raise ArgumentError, "Unsupported type '#{row["type"]}' for #{row["target"]}, expected integer"
+        end
+        {
+            target: row["target"],
+            sources: row["sources"],
+            integer: row["type"] == "integer",
+            sanitise: row["sanitise"] && Regexp.union(row["sanitise"].chars),
+            default: row["default"]
+        }
+    end
+end
+
+def filter(event)
+    @fields.each do |field|
+        value = nil
+        field[:sources].each do |source|
+            value = event.get(source)
+            break unless value.nil? || value == ""
+        end
+        value = field[:default] if value.nil? || value == ""
+        next if value.nil?
+
+        if field[:integer]
+            value = value.is_a?(String) ? value.delete(",").to_i : value.to_i
+        else
+            value = value.to_s
+            value = value.gsub(field[:sanitise], "_") if field[:sanitise]
+        end
+        event.set(field[:target], value)
+    end
+    [event]
+end
+
+test "v6 winlogbeat" do
+    parameters { { "mapping" => "/usr/share/logstash/scripts/beats_fields.yml" } }
+    in_event { { "event_id" => "4624", "log_name" => "Security", "beat" => { "name" => "WKS00001" } } }
+    expect("resolves v6 fields") do |events|
+        e = events.first
+        e.get("[@metadata][event_id]") == 4624 && e.get("[@metadata][log_name]") == "Security" && e.get("[@metadata][hostname]") == "WKS00001"
+    end
+end
+
+test "v7 winlogbeat" do
+    parameters { { "mapping" => "/usr/share/logstash/scripts/beats_fields.yml" } }
+    in_event { { "winlog" => { "event_id" => 1, "channel" => "Microsoft-Windows-Sysmon/Operational" }, "agent" => { "hostname" => "WKS00002" }, "type" => "beats" } }
+    expect("resolves v7 fields and sanitises the log name") do |events|
+        e = events.first
+        e.get("[@metadata][event_id]") == 1 && e.get("[@metadata][log_name]") == "Microsoft-Windows-Sysmon_Operational" && e.get("[@metadata][hostname]") == "WKS00002"
+    end
+end
+
+test "v7 filebeat module" do
+    parameters { { "mapping" => "/usr/share/logstash/scripts/beats_fields.yml" } }
+    in_event { { "event" => { "module" => "system" }, "agent" => { "hostname" => "web01" }, "type" => "beats" } }
+    expect("uses the module as the log name and leaves event_id unset") do |events|
+        e = events.first
+        e.get("[@metadata][log_name]") == "system" && e.get("[@metadata][event_id]").nil?
+    end
+end
+
+test "packetbeat without a host" do
+    parameters { { "mapping" => "/usr/share/logstash/scripts/beats_fields.yml" } }
+    in_event { { "type" => "beats" } }
+    expect("falls back to the type and an UNKNOWN host") do |events|
+        e = events.first
+        e.get("[@metadata][log_name]") == "beats" && e.get("[@metadata][hostname]") == "UNKNOWN"
+    end
+end
@@ -0,0 +1,28 @@
+# Restores events that logstash-in packed into a compressed envelope (see kinesis_pack.rb).
+# KPL aggregated records are already split back into individual events by the kinesis input,
+# so this only needs to handle the optional compression.
+
+require "base64"
+require "stringio"
+require "zlib"
+
+def register(params)
+end
+
+def filter(event)
+    packed = event.get("@packed")
+    return [event] unless packed.is_a?(Hash)
+
+    case packed["codec"]
+    when "gzip"
+        data = Zlib::GzipReader.new(StringIO.new(Base64.strict_decode64(packed["data"]))).read
+    else
+        event.tag("_kinesis_unpack_unknown_codec")
+        return [event]
+    end
+
+    [LogStash::Event.new(LogStash::Json.load(data))]
+rescue
+    event.tag("_kinesis_unpack_failure")
+    [event]
+end
@@ -0,0 +1,193 @@
+# Finishes the syslog header that 20-syslog.conf split with dissect, and chooses the vendor
+# pattern set for the message from the routing table in syslog_routes.yml.
+#
+#   * RFC 3164: checks the dissected header has a timestamp, hostname and tag where they should
+#     be, tagging "_syslog_header_failure" for 20-syslog.conf's grok fallback when it doesn't, and
+#     splits the tag (e.g. "sshd[123]:") into syslog_program and syslog_pid
+#   * RFC 5424: removes "-" (nil) header fields and moves structured data to syslog_structured_data
+#   * sets [@metadata][syslog_vendor] when a route matches
+#
+# Exact program names are a hash lookup, so the cost per event doesn't grow with the table.
+# The test blocks below run when the pipeline starts and stop it if a route is broken.
+
+require "yaml"
+
+# "Oct 11 22:14:15", with the day's padding removed by dissect, and optional fractional seconds
+RFC3164_TIMESTAMP = /\A[A-Z][a-z]{2} \d{1,2} \d{2}:\d{2}:\d{2}(?:[.,]\d+)?\z/
+# Set by the RFC 3164 dissect, and wrong when the header isn't the shape it expects
+RFC3164_FIELDS = ["syslog_timestamp", "syslog_hostname", "syslog_tag", "syslog_message"]
+
+def register(params)
+    routes = YAML.safe_load(File.read(params.fetch("routes", "/usr/share/logstash/scripts/syslog_routes.yml")))
+    @programs = {}
+    @rules = []
+    routes.each do |row|
+        vendor = row["vendor"]
+        unless vendor && (row["programs"] || row["program_pattern"] || row["hosts"])
+            raise ArgumentError, "Each syslog route needs a vendor and programs, a program_pattern or hosts: #{row.inspect}"
+        end
+        (row["programs"] || []).each { |program| @programs[program] ||= vendor }
+        if row["program_pattern"] || row["hosts"]
+            @rules << {
+                vendor: vendor,
+                program: row["program_pattern"] && Regexp.new(row["program_pattern"]),
+                host: row["hosts"] && Regexp.new(row["hosts"])
+            }
+        end
+    end
+end
+
+def filter(event)
+    if event.get("syslog_version")
+        rfc5424(event)
+    elsif !rfc3164(event)
+        return [event]
+    end
+
+    vendor = route(event.get("syslog_program"), event.get("syslog_hostname"))
+    event.set("[@metadata][syslog_vendor]", vendor) if vendor
+    [event]
+end
+
+# False when the dissected header is wrong, e.g. without a hostname ("<13>Oct 11 22:14:15 sshd[1]: ...")
+# or with a year ("<166>Apr 01 2020 09:00:00 asa01 : ..."); its fields are removed for the grok fallback
+def rfc3164(event)
+    tag = event.get("syslog_tag")
+    # Parsed by the grok fallback, which has no tag
+    return true if tag.nil?
+    unless tag.end_with?(":") && !event.get("syslog_hostname").to_s.end_with?(":") &&
+           RFC3164_TIMESTAMP.match?(event.get("syslog_timestamp").to_s)
+        RFC3164_FIELDS.each { |field| event.remove(field) }
+        event.tag("_syslog_header_failure")
+        return false
+    end
+    event.remove("syslog_tag")
+    program = tag.chomp(":")
+    if program.end_with?("]") && (open = program.index("["))
+        event.set("syslog_pid", program[open + 1...-1])
+        program = program[0...open]
+    end
+    event.set("syslog_program", program)
+    true
+end
+
+def rfc5424(event)
+    ["syslog_program", "syslog_pid", "syslog_msgid"].each do |field|
+        event.remove(field) if event.get(field) == "-"
+    end
+    message = event.get("syslog_message").to_s
+    if message == "-" || message.start_with?("- ")
+        event.set("syslog_message", message[2..-1] || "")
+    elsif message.start_with?("[")
+        length = structured_data_length(message)
+        event.set("syslog_structured_data", message[0...length])
+        event.set("syslog_message", message[length..-1].sub(/\A /, ""))
+    end
+end
+
+# Length of the SD-ELEMENTs at the start of a message; "]" inside quoted values doesn't end them
+def structured_data_length(message)
+    quoted = false
+    escaped = false
+    message.each_char.with_index do |char, index|
+        if escaped
+            escaped = false
+        elsif char == "\\"
+            escaped = true
+        elsif char == "\""
+            quoted = !quoted
+        elsif char == "]" && !quoted && message[index + 1] != "["
+            return index + 1
+        end
+    end
+    message.length
+end
+
+def route(program, host)
+    vendor = program && @programs[program]
+    return vendor if vendor
+    @rules.each do |rule|
+        next if rule[:program] && !(program && rule[:program].match?(program))
+        next if rule[:host] && !(host && rule[:host].match?(host))
+        return rule[:vendor]
+    end
+    nil
+end
+
+test "rfc3164 with a pid" do
+    parameters { { "routes" => "/usr/share/logstash/scripts/syslog_routes.yml" } }
+    in_event { { "syslog_timestamp" => "Oct 18 10:15:01", "syslog_hostname" => "fw01", "syslog_tag" => "filterlog[4021]:", "syslog_message" => "5,,,1000000103,igb0,match,block,in,4" } }
+    expect("splits the tag and routes by program") do |events|
+        e = events.first
+        e.get("syslog_program") == "filterlog" && e.get("syslog_pid") == "4021" && e.get("syslog_tag").nil? && e.get("[@metadata][syslog_vendor]") == "pfsense"
+    end
+end
+
+test "rfc3164 without a tag" do
+    parameters { { "routes" => "/usr/share/logstash/scripts/syslog_routes.yml" } }
+    in_event { { "syslog_timestamp" => "Oct 11 22:14:15", "syslog_hostname" => "printer01", "syslog_tag" => "Paper", "syslog_message" => "jam in tray 2" } }
+    expect("leaves the header to the grok fallback") do |events|
+        e = events.first
+        e.get("tags") == ["_syslog_header_failure"] && e.get("syslog_hostname").nil? && e.get("syslog_message").nil? &&
+            e.get("[@metadata][syslog_vendor]").nil?
+    end
+end
+
+test "rfc3164 without a hostname" do
+    parameters { { "routes" => "/usr/share/logstash/scripts/syslog_routes.yml" } }
+    # <13>Oct 11 22:14:15 sshd[1]: Accepted publickey for deploy
+    in_event { { "syslog_timestamp" => "Oct 11 22:14:15", "syslog_hostname" => "sshd[1]:", "syslog_tag" => "Accepted", "syslog_message" => "publickey for deploy" } }
+    expect("leaves the header to the grok fallback") do |events|
+        e = events.first
+        e.get("tags") == ["_syslog_header_failure"] && e.get("syslog_hostname").nil? && e.get("syslog_tag").nil? &&
+            e.get("syslog_program").nil? && e.get("[@metadata][syslog_vendor]").nil?
+    end
+end
+
+test "rfc3164 with a year" do
+    parameters { { "routes" => "/usr/share/logstash/scripts/syslog_routes.yml" } }
+    # <166>Apr 01 2020 09:00:00 asa01 : %ASA-6-302013: Built outbound TCP connection
+    in_event { { "syslog_timestamp" => "Apr 01 2020", "syslog_hostname" => "09:00:00", "syslog_tag" => "asa01", "syslog_message" => ": %ASA-6-302013: Built outbound TCP connection" } }
+    expect("leaves the header to the grok fallback") do |events|
+        e = events.first
+        e.get("tags") == ["_syslog_header_failure"] && e.get("syslog_timestamp").nil? && e.get("syslog_hostname").nil? &&
+            e.get("[@metadata][syslog_vendor]").nil?
+    end
+end
+
+test "rfc3164 from the grok fallback" do
+    parameters { { "routes" => "/usr/share/logstash/scripts/syslog_routes.yml" } }
+    in_event { { "syslog_timestamp" => "Oct 11 22:14:15", "syslog_hostname" => "app03", "syslog_program" => "sshd", "syslog_pid" => "9921", "syslog_message" => "Disconnected" } }
+    expect("routes by the program grok found") do |events|
+        e = events.first
+        e.get("tags").nil? && e.get("[@metadata][syslog_vendor]") == "linux"
+    end
+end
+
+test "cisco asa" do
+    parameters { { "routes" => "/usr/share/logstash/scripts/syslog_routes.yml" } }
+    in_event { { "syslog_timestamp" => "Oct 18 10:15:03", "syslog_hostname" => "asa01", "syslog_tag" => "%ASA-6-302013:", "syslog_message" => "Built outbound TCP connection" } }
+    expect("routes by program pattern") do |events|
+        events.first.get("[@metadata][syslog_vendor]") == "cisco_asa"
+    end
+end
+
+test "rfc5424 with structured data" do
+    parameters { { "routes" => "/usr/share/logstash/scripts/syslog_routes.yml" } }
+    in_event { { "syslog_version" => "1", "syslog_hostname" => "app01", "syslog_program" => "sshd", "syslog_pid" => "812", "syslog_msgid" => "-",
+                 "syslog_message" => "[origin ip=\"10.0.0.1\"][meta note=\"a ] b\"] Accepted publickey for bob" } }
+    expect("separates the structured data and drops nil fields") do |events|
+        e = events.first
+        e.get("syslog_structured_data") == "[origin ip=\"10.0.0.1\"][meta note=\"a ] b\"]" && e.get("syslog_message") == "Accepted publickey for bob" &&
+            e.get("syslog_msgid").nil? && e.get("[@metadata][syslog_vendor]") == "linux"
+    end
+end
+
+test "rfc5424 without structured data" do
+    parameters { { "routes" => "/usr/share/logstash/scripts/syslog_routes.yml" } }
+    in_event { { "syslog_version" => "1", "syslog_hostname" => "app01", "syslog_program" => "-", "syslog_pid" => "-", "syslog_msgid" => "-", "syslog_message" => "- hello" } }
+    expect("strips the nil structured data") do |events|
+        e = events.first
+        e.get("syslog_message") == "hello" && e.get("syslog_program").nil? && e.get("syslog_structured_data").nil?
+    end
+end
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+"""Replays archived events from S3 back into the Kinesis queue, so the processor parses and routes them again.
+
+Use it after fixing a parser or routing rule, to reprocess the events that landed under
+`type=fallback/` or were archived with the old rules. The replayer lists the objects under a key
+prefix whose partition hour is in [start, end) (see selection.py), streams each one through gzip,
+and writes its events to the stream with PutRecords, from `workers` threads at once.
+
+Every PutRecords call waits on one rate limiter shared by the workers, so replay takes at most
+`max_bytes_per_second` and `max_records_per_second` of the stream's write capacity. When Kinesis
+throttles, the limiter halves its rate and recovers by 5% a second, giving live traffic the shards back.
+
+Progress is written to the `checkpoint` object every `checkpoint_seconds`: the listing position
+before which every object has been sent, and the objects finished after it. Run again with the same
+settings and checkpoint to resume; an object that was part way through is sent again in full, so
+replay is at least once.
+
+Configured with environment variables, see ReplayConfig.from_env.
+"""
+import argparse
+import collections
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import List
+
+import boto3
+from botocore.config import Config
+
+from selection import is_selected, parse_hour, partition_fields, prepare
+
+log = logging.getLogger("replayer")
+
+# PutRecords limits
+MAX_BATCH_RECORDS = 500
+MAX_BATCH_BYTES = 5 * 2 ** 20
+MAX_RECORD_BYTES = 2 ** 20
+MAX_ATTEMPTS = 10
+
+
+@dataclass
+class ReplayConfig:
+    buckets: List[str]
+    stream_name: str
+    prefix: str = ""
+    start: datetime = None
+    end: datetime = None
+    exclude_prefixes: List[str] = field(default_factory=lambda: ["compacted/", "_replay/"])
+    tag: str = "replayed"
+    workers: int = 8
+    max_bytes_per_second: float = 2 ** 20
+    max_records_per_second: float = 1000
+    checkpoint: str = None
+    checkpoint_seconds: float = 30
+    s3_endpoint: str = None
+    kinesis_endpoint: str = None
+    metrics_namespace: str = None
+
+    @classmethod
+    def from_env(cls, env=os.environ):
+        """REPLAY_BUCKETS (comma separated) and REPLAY_STREAM_NAME are required; the rest are optional
+        REPLAY_* settings named like the fields. REPLAY_START and REPLAY_END are ISO 8601 hours, e.g.
+        2020-04-01T09, and REPLAY_CHECKPOINT an s3://bucket/key URI. Without REPLAY_CHECKPOINT, a
+        REPLAY_CHECKPOINT_PREFIX URI gives each replay a checkpoint named after its settings, so
+        running the same replay again resumes it."""
+        config = cls(
+            buckets = [b.strip() for b in env["REPLAY_BUCKETS"].split(",") if b.strip()],
+            stream_name = env["REPLAY_STREAM_NAME"],
+            prefix = env.get("REPLAY_PREFIX", ""),
+            start = parse_hour(env.get("REPLAY_START")),
+            end = parse_hour(env.get("REPLAY_END")),
+            exclude_prefixes = [p.strip() for p in env.get("REPLAY_EXCLUDE_PREFIXES", "compacted/,_replay/").split(",") if p.strip()],
+            tag = env.get("REPLAY_TAG", "replayed"),
+            workers = int(env.get("REPLAY_WORKERS", 8)),
+            max_bytes_per_second = float(env.get("REPLAY_MAX_BYTES_PER_SECOND", 2 ** 20)),
+            max_records_per_second = float(env.get("REPLAY_MAX_RECORDS_PER_SECOND", 1000)),
+            checkpoint = env.get("REPLAY_CHECKPOINT") or None,
+            checkpoint_seconds = float(env.get("REPLAY_CHECKPOINT_SECONDS", 30)),
+            s3_endpoint = env.get("REPLAY_S3_ENDPOINT") or None,
+            kinesis_endpoint = env.get("REPLAY_KINESIS_ENDPOINT") or None,
+            metrics_namespace = env.get("REPLAY_METRICS_NAMESPACE") or None
+        )
+        if not config.buckets:
+            raise ValueError("Set REPLAY_BUCKETS")
+        if not config.checkpoint and env.get("REPLAY_CHECKPOINT_PREFIX"):
+            job_id = hashlib.sha1(json.dumps(config.job(), sort_keys=True).encode()).hexdigest()[:16]
+            config.checkpoint = f"{env['REPLAY_CHECKPOINT_PREFIX']}{job_id}.json"
+        if config.checkpoint and not config.checkpoint.startswith("s3://"):
+            raise ValueError("REPLAY_CHECKPOINT must be an s3://bucket/key URI")
+        if config.start and config.end and config.start >= config.end:
+            raise ValueError("REPLAY_START must be before REPLAY_END")
+        return config
+
+    def job(self):
+        """The settings a checkpoint is only valid for."""
+        return {"buckets": self.buckets, "stream_name": self.stream_name, "prefix": self.prefix,
+                "start": self.start and self.start.isoformat(), "end": self.end and self.end.isoformat()}
+
+
+class RateLimiter(object):
+    """Spaces the workers' PutRecords calls so that together they stay under a bytes and records rate.
+
+    Each call is given the next free slot, as long as its batch takes at the current rate, so bursts
+    never exceed one batch. `throttled` halves the rate, down to `min_scale`, and it then recovers
+    by `recovery` of the full rate a second.
+    """
+    def __init__(self, bytes_per_second, records_per_second, min_scale=0.1, recovery=0.05):
+        self.bytes_per_second = bytes_per_second
+        self.records_per_second = records_per_second
+        self.min_scale = min_scale
+        self.recovery = recovery
+        self.scale = 1.0
+        self.lock = threading.Lock()
+        self.next_free = time.monotonic()
+        self.last_change = self.next_free
+
+    def acquire(self, records, size):
+        with self.lock:
+            now = time.monotonic()
+            if self.scale < 1.0 and now - self.last_change >= 1.0:
+                self.scale = min(1.0, self.scale + self.recovery * (now - self.last_change))
+                self.last_change = now
+            seconds = max(size / (self.bytes_per_second * self.scale), records / (self.records_per_second * self.scale))
+            start = max(now, self.next_free)
+            self.next_free = start + seconds
+        if start > now:
+            time.sleep(start - now)
+
+    def throttled(self):
+        with self.lock:
+            self.scale = max(self.min_scale, self.scale / 2)
+            self.last_change = time.monotonic()
+
+
+class Checkpoint(object):
+    """Tracks which listed objects have been sent, in listing order.
+
+    `after` is the last key before which every object has been sent, so a resumed listing starts
+    after it; `done` holds the objects finished beyond it, which are skipped when they are listed again.
+    """
+    def __init__(self, state=None):
+        state = state or {}
+        self.after = dict(state.get("after", {}))
+        self.done = {bucket: set(keys) for bucket, keys in state.get("done", {}).items()}
+        self.in_flight = collections.OrderedDict()
+
+    def is_done(self, bucket, key):
+        return key in self.done.get(bucket, ())
+
+    def started(self, bucket, key):
+        self.in_flight[(bucket, key)] = False
+
+    def finished(self, bucket, key):
+        self.in_flight[(bucket, key)] = True
+        self.done.setdefault(bucket, set()).add(key)
+        # Move each bucket's position past the objects finished at the front of the listing
+        while self.in_flight:
+            (first_bucket, first_key), is_finished = next(iter(self.in_flight.items()))
+            if not is_finished:
+                break
+            self.in_flight.popitem(last=False)
+            self.after[first_bucket] = first_key
+            self.done[first_bucket].discard(first_key)
+
+    def state(self, job, totals):
+        # Objects skipped on resume are finished but never in flight, so drop those the position has passed
+        done = {b: sorted(k for k in keys if k > self.after.get(b, "")) for b, keys in self.done.items()}
+        return {"job": job, "after": self.after, "done": {b: keys for b, keys in done.items() if keys}, "totals": totals}
+
+
+class KinesisWriter(object):
+    """Batches an object's records into PutRecords calls, retrying the records Kinesis rejects."""
+    def __init__(self, client, stream_name, limiter, totals):
+        self.client = client
+        self.stream_name = stream_name
+        self.limiter = limiter
+        self.totals = totals
+        self.batch = []
+        self.batch_bytes = 0
+
+    def add(self, data):
+        # A random key spreads replayed events evenly, rather than onto the shards of busy live sources
+        record = {"Data": data, "PartitionKey": uuid.uuid4().hex}
+        size = len(data) + 32
+        if size > MAX_RECORD_BYTES:
+            self.totals.add(oversized=1)
+            return
+        if len(self.batch) >= MAX_BATCH_RECORDS or self.batch_bytes + size > MAX_BATCH_BYTES:
+            self.flush()
+        self.batch.append(record)
+        self.batch_bytes += size
+
+    def flush(self):
+        records, size = self.batch, self.batch_bytes
+        self.batch, self.batch_bytes = [], 0
+        for attempt in range(MAX_ATTEMPTS):
+            if not records:
+                return
+            self.limiter.acquire(len(records), size)
+            try:
+                response = self.client.put_records(StreamName=self.stream_name, Records=records)
+            except self.client.exceptions.ProvisionedThroughputExceededException:
+                failed = records
+            else:
+                failed = [r for r, result in zip(records, response["Records"]) if "ErrorCode" in result]
+                self.totals.add(records=len(records) - len(failed), bytes=size - sum(len(r["Data"]) + 32 for r in failed))
+            if failed:
+                self.totals.add(throttled=len(failed))
+                self.limiter.throttled()
+                time.sleep(min(10, 0.1 * 2 ** attempt))
+            records, size = failed, sum(len(r["Data"]) + 32 for r in failed)
+        raise RuntimeError(f"{len(records)} records were still rejected after {MAX_ATTEMPTS} attempts")
+
+
+class Totals(object):
+    def __init__(self, **values):
+        self.lock = threading.Lock()
+        self.values = dict({"objects": 0, "failed": 0, "records": 0, "bytes": 0, "throttled": 0, "oversized": 0}, **values)
+
+    def add(self, **values):
+        with self.lock:
+            for k, v in values.items():
+                self.values[k] += v
+
+    def copy(self):
+        with self.lock:
+            return dict(self.values)
+
+
+def clients(config):
+    # Clients are shared by the worker threads, so need a connection each
+    client_config = Config(max_pool_connections=config.workers * 2, retries={"max_attempts": 3})
+    s3_config = client_config.merge(Config(s3={"addressing_style": "path"})) if config.s3_endpoint else client_config
+    s3 = boto3.client("s3", endpoint_url=config.s3_endpoint, config=s3_config)
+    kinesis = boto3.client("kinesis", endpoint_url=config.kinesis_endpoint, config=client_config)
+    return s3, kinesis
+
+
+def split_uri(uri):
+    bucket, _, key = uri[len("s3://"):].partition("/")
+    return bucket, key
+
+
+def read_checkpoint(client, config):
+    if not config.checkpoint:
+        return Checkpoint()
+    bucket, key = split_uri(config.checkpoint)
+    try:
+        state = json.loads(client.get_object(Bucket=bucket, Key=key)["Body"].read())
+    except client.exceptions.NoSuchKey:
+        return Checkpoint()
+    if state.get("job") != config.job():
+        raise ValueError(f"{config.checkpoint} is for another replay: {json.dumps(state.get('job'))}")
+    log.info("Resuming from %s", json.dumps(state["after"]))
+    return Checkpoint(state)
+
+
+def write_checkpoint(client, config, checkpoint, totals):
+    if config.checkpoint:
+        bucket, key = split_uri(config.checkpoint)
+        body = json.dumps(checkpoint.state(config.job(), totals.copy()), indent=1).encode()
+        client.put_object(Bucket=bucket, Key=key, Body=body, ContentType="application/json")
+
+
+def list_objects(client, config, bucket, after=None):
+    paginator = client.get_paginator("list_objects_v2")
+    kwargs = {"Bucket": bucket, "Prefix": config.prefix}
+    if after:
+        kwargs["StartAfter"] = after
+    for page in paginator.paginate(**kwargs):
+        for item in page.get("Contents", []):
+            if is_selected(item["Key"], config.start, config.end, config.exclude_prefixes):
+                yield item["Key"], item["Size"]
+
+
+def read_lines(client, bucket, key):
+    """Streams the lines of an object, decompressing gzip objects as they are read."""
+    body = client.get_object(Bucket=bucket, Key=key)["Body"]
+    try:
+        stream = gzip.GzipFile(fileobj=body) if key.endswith(".gz") else body.iter_lines(chunk_size=2 ** 16)
+        for line in stream:
+            line = line.rstrip(b"\r\n")
+            if line:
+                yield line
+    finally:
+        body.close()
+
+
+def replay_object(s3, kinesis, limiter, totals, config, bucket, key):
+    """Sends every event in one object; it only counts as done once all its records are accepted."""
+    writer = KinesisWriter(kinesis, config.stream_name, limiter, totals)
+    fields = partition_fields(key)
+    for line in read_lines(s3, bucket, key):
+        writer.add(prepare(line, fields, config.tag))
+    writer.flush()
+
+
+def run(config, dry_run=False):
+    """Replays every selected object in the configured buckets and returns the totals."""
+    started = time.monotonic()
+    s3, kinesis = clients(config)
+    limiter = RateLimiter(config.max_bytes_per_second, config.max_records_per_second)
+    totals = Totals()
+    checkpoint = read_checkpoint(s3, config)
+
+    def collect(futures):
+        for future in futures:
+            bucket, key = pending.pop(future)
+            try:
+                future.result()
+            except Exception:
+                # Left in flight, so the checkpoint stays before it and a resumed run sends it again
+                log.exception("Failed to replay s3://%s/%s", bucket, key)
+                totals.add(failed=1)
+                continue
+            checkpoint.finished(bucket, key)
+            totals.add(objects=1)
+
+    pending = {}
+    last_checkpoint = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config.workers) as pool:
+        for bucket in config.buckets:
+            for key, size in list_objects(s3, config, bucket, checkpoint.after.get(bucket)):
+                if checkpoint.is_done(bucket, key):
+                    continue
+                if dry_run:
+                    print(json.dumps({"bucket": bucket, "key": key, "bytes": size}))
+                    continue
+                checkpoint.started(bucket, key)
+                pending[pool.submit(replay_object, s3, kinesis, limiter, totals, config, bucket, key)] = (bucket, key)
+                # Keep the listing only a little ahead of the workers
+                if len(pending) >= config.workers * 2:
+                    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    collect(done)
+                if time.monotonic() - last_checkpoint >= config.checkpoint_seconds:
+                    write_checkpoint(s3, config, checkpoint, totals)
+                    log.info(json.dumps({"progress": totals.copy()}))
+                    last_checkpoint = time.monotonic()
+        collect(list(concurrent.futures.as_completed(pending)))
+    if not dry_run:
+        write_checkpoint(s3, config, checkpoint, totals)
+
+    result = totals.copy()
+    result["seconds"] = round(time.monotonic() - started, 1)
+    return result
+
+
+def emf(namespace, totals):
+    """The run's totals as a CloudWatch Embedded Metric Format document, like the compactor's."""
+    units = {"ObjectsReplayed": "Count", "ObjectsFailed": "Count", "RecordsReplayed": "Count", "BytesReplayed": "Bytes",
+             "RecordsThrottled": "Count", "RecordsOversized": "Count", "Duration": "Seconds"}
+    values = {"ObjectsReplayed": totals["objects"], "ObjectsFailed": totals["failed"], "RecordsReplayed": totals["records"],
+              "BytesReplayed": totals["bytes"], "RecordsThrottled": totals["throttled"], "RecordsOversized": totals["oversized"],
+              "Duration": totals["seconds"]}
+    return {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": namespace,
+                "Dimensions": [["Job"]],
+                "Metrics": [{"Name": name, "Unit": unit} for name, unit in units.items()]
+            }]
+        },
+        "Job": "replay",
+        **values
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--prefix", help="Overrides REPLAY_PREFIX")
+    parser.add_argument("--start", help="Overrides REPLAY_START")
+    parser.add_argument("--end", help="Overrides REPLAY_END")
+    parser.add_argument("--dry-run", action="store_true", help="List the objects that would be replayed without sending them")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    for name in ("prefix", "start", "end"):
+        if getattr(args, name) is not None:
+            env[f"REPLAY_{name.upper()}"] = getattr(args, name)
+    config = ReplayConfig.from_env(env)
+    totals = run(config, dry_run=args.dry_run)
+    log.info(json.dumps({"totals": totals}))
+    if config.metrics_namespace and not args.dry_run:
+        print(json.dumps(emf(config.metrics_namespace, totals)), flush=True)
+    if totals["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=os.environ.get("REPLAY_LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(message)s")
+    main()
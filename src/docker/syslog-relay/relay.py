@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""Syslog relay for `relay` inbound services.
+
+A network load balancer spreads TCP connections, not events, so one chatty sender pins one
+Logstash task. The relay sits between the load balancer and a `cloudmap` Logstash service: it
+accepts long-lived syslog connections and dispatches each message to one of the Logstash
+tasks, which it finds by resolving the service's Cloud Map DNS name.
+
+Messages may be newline delimited or octet counted (RFC 6587) and are forwarded newline
+delimited, each after "@relay {sender's address} " so Logstash can restore the sender as the
+event's [host] (see pipelines/20-syslog.conf in logstash-in). Every client connection has a bounded buffer, and so does every backend, so when
+Logstash falls behind the relay stops reading and TCP pushes back on the senders.
+
+Configured with environment variables, see RelayConfig.from_env.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+log = logging.getLogger("relay")
+
+DISPATCH_MODES = ("least_loaded", "round_robin")
+# Digits in an RFC 6587 octet count; a longer run of digits starts a newline delimited message
+MAX_OCTET_COUNT_DIGITS = 9
+# Bytes skipped at a time from an octet counted message longer than max_message_bytes
+SKIP_CHUNK_BYTES = 65536
+# Put before each forwarded message, followed by the sender's address and a space
+PEER_PREFIX = b"@relay "
+
+
+@dataclass
+class RelayConfig:
+    ports: List[int]
+    backend_port: int
+    backend_dns_name: str = None
+    backends: List[Tuple[str, int]] = field(default_factory=list)
+    listen_host: str = None
+    dispatch: str = "least_loaded"
+    connection_buffer: int = 1000
+    backend_buffer: int = 5000
+    max_message_bytes: int = 65536
+    discovery_interval_seconds: float = 15
+    stats_interval_seconds: float = 60
+
+    @classmethod
+    def from_env(cls, env=os.environ):
+        """RELAY_PORTS and RELAY_BACKEND_PORT are required, plus either RELAY_BACKEND_DNS_NAME
+        (resolved every RELAY_DISCOVERY_INTERVAL_SECONDS) or a static RELAY_BACKENDS list of host:port."""
+        backends = []
+        for backend in filter(None, env.get("RELAY_BACKENDS", "").split(",")):
+            host, port = backend.strip().rsplit(":", 1)
+            backends.append((host, int(port)))
+        config = cls(
+            ports = [int(p) for p in env["RELAY_PORTS"].split(",")],
+            backend_port = int(env["RELAY_BACKEND_PORT"]),
+            backend_dns_name = env.get("RELAY_BACKEND_DNS_NAME") or None,
+            backends = backends,
+            dispatch = env.get("RELAY_DISPATCH", "least_loaded"),
+            connection_buffer = int(env.get("RELAY_CONNECTION_BUFFER", 1000)),
+            backend_buffer = int(env.get("RELAY_BACKEND_BUFFER", 5000)),
+            max_message_bytes = int(env.get("RELAY_MAX_MESSAGE_BYTES", 65536)),
+            discovery_interval_seconds = float(env.get("RELAY_DISCOVERY_INTERVAL_SECONDS", 15)),
+            stats_interval_seconds = float(env.get("RELAY_STATS_INTERVAL_SECONDS", 60))
+        )
+        if config.dispatch not in DISPATCH_MODES:
+            raise ValueError(f"Unknown RELAY_DISPATCH '{config.dispatch}'; expected one of {', '.join(DISPATCH_MODES)}")
+        if not config.backend_dns_name and not config.backends:
+            raise ValueError("Set RELAY_BACKEND_DNS_NAME or RELAY_BACKENDS")
+        return config
+
+
+class Backend(object):
+    """A connection to one Logstash task, fed from a bounded queue of messages."""
+    def __init__(self, address, queue_size):
+        self.address = address
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.connected = False
+        self.removed = False
+        self.sent = 0
+        self.task = None
+
+    @property
+    def load(self):
+        return self.queue.qsize()
+
+    @property
+    def available(self):
+        return self.connected and not self.removed and not self.queue.full()
+
+    async def run(self, relay, batch_size=500):
+        backoff = 1
+        # A removed backend finishes what it has queued before it goes away
+        while not (self.removed and self.queue.empty()):
+            try:
+                _, writer = await asyncio.open_connection(*self.address)
+            except OSError as e:
+                log.warning("Cannot connect to %s:%s: %s", *self.address, e)
+                relay.requeue(self)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+                continue
+            self.connected = True
+            backoff = 1
+            batch = []
+            try:
+                while not (self.removed and self.queue.empty()):
+                    try:
+                        batch = [await asyncio.wait_for(self.queue.get(), timeout=1)]
+                    except asyncio.TimeoutError:
+                        continue
+                    while len(batch) < batch_size and not self.queue.empty():
+                        batch.append(self.queue.get_nowait())
+                    writer.write(b"".join(batch))
+                    await writer.drain()
+                    self.sent += len(batch)
+                    batch = []
+            except (ConnectionError, OSError) as e:
+                log.warning("Lost connection to %s:%s: %s", *self.address, e)
+            finally:
+                self.connected = False
+                writer.close()
+            # Anything not yet written goes to the other backends; a batch that failed mid-write may be delivered twice
+            relay.requeue(self, batch)
+
+
+class Dispatcher(object):
+    """Chooses the backend for each message."""
+    def __init__(self, mode):
+        self.mode = mode
+        self.next = 0
+
+    def choose(self, backends):
+        available = [b for b in backends if b.available]
+        if not available:
+            return None
+        self.next = (self.next + 1) % len(available)
+        if self.mode == "round_robin":
+            return available[self.next]
+        # Fewest queued messages wins; rotating the starting point spreads ties
+        return min(available[self.next:] + available[:self.next], key=lambda b: b.load)
+
+
+class Relay(object):
+    def __init__(self, config):
+        self.config = config
+        self.dispatcher = Dispatcher(config.dispatch)
+        self.backends = {}
+        self.connections = 0
+        self.received = 0
+        self.truncated = 0
+        self.servers = []
+        self.tasks = []
+
+    async def start(self):
+        for port in self.config.ports:
+            self.servers.append(await asyncio.start_server(self.handle_client, host=self.config.listen_host, port=port, limit=self.config.max_message_bytes))
+        if self.config.backends:
+            self.update_backends(set(self.config.backends))
+        if self.config.backend_dns_name:
+            self.tasks.append(asyncio.ensure_future(self.discover()))
+        self.tasks.append(asyncio.ensure_future(self.report()))
+        log.info("Relaying ports %s with %s dispatch", self.config.ports, self.config.dispatch)
+
+    async def close(self):
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        for task in self.tasks + [b.task for b in self.backends.values()]:
+            task.cancel()
+
+    def update_backends(self, addresses):
+        for address in addresses - set(self.backends):
+            backend = Backend(address, self.config.backend_buffer)
+            backend.task = asyncio.ensure_future(backend.run(self))
+            self.backends[address] = backend
+            log.info("Added backend %s:%s", *address)
+        for address in set(self.backends) - addresses:
+            self.backends.pop(address).removed = True
+            log.info("Removed backend %s:%s", *address)
+
+    async def discover(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                infos = await loop.getaddrinfo(self.config.backend_dns_name, self.config.backend_port, type=socket.SOCK_STREAM)
+                addresses = {(info[4][0], self.config.backend_port) for info in infos}
+                if addresses:
+                    self.update_backends(addresses)
+            except socket.gaierror as e:
+                log.warning("Cannot resolve %s: %s", self.config.backend_dns_name, e)
+            await asyncio.sleep(self.config.discovery_interval_seconds)
+
+    async def dispatch(self, message):
+        while True:
+            backend = self.dispatcher.choose(self.backends.values())
+            if backend is not None:
+                backend.queue.put_nowait(message)
+                return
+            # Every backend is full or down; waiting here stops the client connections being read
+            await asyncio.sleep(0.05)
+
+    def requeue(self, backend, batch=()):
+        """Hands a backend's undelivered messages to the others."""
+        messages = list(batch)
+        while not backend.queue.empty():
+            messages.append(backend.queue.get_nowait())
+        for message in messages:
+            asyncio.ensure_future(self.dispatch(message))
+
+    async def handle_client(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        # Logstash sees every message as coming from the relay, so each one carries its sender
+        prefix = PEER_PREFIX + peer[0].encode() + b" "
+        self.connections += 1
+        buffer = asyncio.Queue(maxsize=self.config.connection_buffer)
+        forwarder = asyncio.ensure_future(self.forward(buffer))
+        try:
+            while True:
+                message = await self.read_message(reader)
+                if message is None:
+                    break
+                self.received += 1
+                await buffer.put(prefix + message)
+            await buffer.join()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            log.info("Connection from %s closed: %s", peer, e)
+        finally:
+            self.connections -= 1
+            forwarder.cancel()
+            writer.close()
+
+    async def forward(self, buffer):
+        while True:
+            message = await buffer.get()
+            await self.dispatch(message)
+            buffer.task_done()
+
+    async def read_message(self, reader):
+        """Reads one syslog message, octet counted or newline delimited, and returns it newline terminated."""
+        start = await reader.read(1)
+        if not start:
+            return None
+        # An octet count is a run of digits, not starting with 0, then a space. Any other start, such as
+        # the timestamp of a message without a <PRI>, is the start of a newline delimited message
+        if start in b"123456789":
+            while len(start) <= MAX_OCTET_COUNT_DIGITS and start[-1:].isdigit():
+                byte = await reader.read(1)
+                if not byte:
+                    return start + b"\n"
+                start += byte
+            if start.endswith(b" "):
+                return await self.read_octet_counted(reader, int(start[:-1]))
+            if start.endswith(b"\n"):
+                return start
+        try:
+            return start + await reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError as e:
+            return start + e.partial + b"\n"
+        except asyncio.LimitOverrunError as e:
+            # Forward the start of an oversized message and skip the rest of it
+            self.truncated += 1
+            message = start + await reader.readexactly(e.consumed)
+            while True:
+                try:
+                    await reader.readuntil(b"\n")
+                    break
+                except asyncio.LimitOverrunError as overrun:
+                    await reader.readexactly(overrun.consumed)
+            return message[:self.config.max_message_bytes - 1] + b"\n"
+
+    async def read_octet_counted(self, reader, length):
+        """Reads the `length` bytes of an RFC 6587 octet counted message, whose count has been read."""
+        if length <= self.config.max_message_bytes:
+            message = await reader.readexactly(length)
+            return message.rstrip(b"\n") + b"\n"
+        # Forward the start of an oversized message and skip the rest of it
+        self.truncated += 1
+        message = await reader.readexactly(self.config.max_message_bytes - 1)
+        remaining = length - len(message)
+        while remaining > 0:
+            remaining -= len(await reader.readexactly(min(remaining, SKIP_CHUNK_BYTES)))
+        return message.rstrip(b"\n") + b"\n"
+
+    def stats(self):
+        return {
+            "connections": self.connections,
+            "received": self.received,
+            "truncated": self.truncated,
+            "backends": {f"{host}:{port}": {"connected": b.connected, "queued": b.load, "sent": b.sent}
+                         for (host, port), b in self.backends.items()}
+        }
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(self.config.stats_interval_seconds)
+            log.info(json.dumps({"timestamp": int(time.time()), **self.stats()}))
+
+
+async def main():
+    relay = Relay(RelayConfig.from_env())
+    await relay.start()
+    await asyncio.gather(*(server.serve_forever() for server in relay.servers))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=os.environ.get("RELAY_LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(message)s")
+    asyncio.run(main())
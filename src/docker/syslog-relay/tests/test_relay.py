@@ -0,0 +1,107 @@
+"""Tests for the syslog relay's framing (src/docker/syslog-relay/relay.py).
+
+Run from src/docker/syslog-relay with `python3 -m pytest tests`.
+"""
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from relay import Relay, RelayConfig  # noqa: E402
+
+PREFIX = b"@relay 127.0.0.1 "
+
+
+class FakeLogstash(object):
+    """Collects the newline delimited messages it is sent."""
+    def __init__(self):
+        self.messages = []
+        self.server = None
+        self.handlers = []
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, host="127.0.0.1", port=0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        self.handlers.append(asyncio.current_task())
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            self.messages.append(line)
+        writer.close()
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        for handler in self.handlers:
+            handler.cancel()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+
+
+class RelayFramingTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.receiver = FakeLogstash()
+        port = await self.receiver.start()
+        self.relay = Relay(RelayConfig(ports=[0], listen_host="127.0.0.1", backend_port=port,
+                                       backends=[("127.0.0.1", port)], max_message_bytes=1000))
+        await self.relay.start()
+        self.port = self.relay.servers[0].sockets[0].getsockname()[1]
+        while not all(b.connected for b in self.relay.backends.values()):
+            await asyncio.sleep(0.01)
+
+    async def asyncTearDown(self):
+        await self.relay.close()
+        await self.receiver.close()
+
+    async def relay_stream(self, data, expected):
+        """Sends `data` on one connection and returns what the receiver gets, once it has `expected` messages."""
+        _, writer = await asyncio.open_connection("127.0.0.1", self.port)
+        writer.write(data)
+        await writer.drain()
+        writer.write_eof()
+        for _ in range(500):
+            if len(self.receiver.messages) >= expected:
+                break
+            await asyncio.sleep(0.01)
+        writer.close()
+        return self.receiver.messages
+
+    async def test_newline_delimited(self):
+        messages = await self.relay_stream(b"<13>Oct 11 22:14:15 host app: one\n<13>Oct 11 22:14:16 host app: two\n", 2)
+        self.assertEqual(messages, [
+            PREFIX + b"<13>Oct 11 22:14:15 host app: one\n",
+            PREFIX + b"<13>Oct 11 22:14:16 host app: two\n"
+        ])
+
+    async def test_newline_delimited_starting_with_digits(self):
+        data = b"2020-04-01T09:00:00Z host app: msg\n12\n1234567890 host app: long run\n0 host app: zero\n"
+        messages = await self.relay_stream(data, 4)
+        self.assertEqual(messages, [
+            PREFIX + b"2020-04-01T09:00:00Z host app: msg\n",
+            PREFIX + b"12\n",
+            PREFIX + b"1234567890 host app: long run\n",
+            PREFIX + b"0 host app: zero\n"
+        ])
+        self.assertEqual(self.relay.received, 4)
+
+    async def test_octet_counted(self):
+        messages = await self.relay_stream(b"12 <13>app: one13 <13>app: two\n", 2)
+        self.assertEqual(messages, [PREFIX + b"<13>app: one\n", PREFIX + b"<13>app: two\n"])
+
+    async def test_octet_counted_then_newline_delimited(self):
+        messages = await self.relay_stream(b"12 <13>app: one2020-04-01T09:00:00Z host app: two\n", 2)
+        self.assertEqual(messages, [PREFIX + b"<13>app: one\n", PREFIX + b"2020-04-01T09:00:00Z host app: two\n"])
+
+    async def test_oversized_octet_counted_is_truncated(self):
+        messages = await self.relay_stream(b"5000 " + b"x" * 5000 + b"12 <13>app: one", 2)
+        self.assertEqual(messages, [PREFIX + b"x" * 999 + b"\n", PREFIX + b"<13>app: one\n"])
+        self.assertEqual(self.relay.truncated, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
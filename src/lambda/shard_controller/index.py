@@ -0,0 +1,110 @@
+"""Reshards the Kinesis queue between configured bounds.
+
+Invoked on a schedule, and by CloudWatch alarms (via SNS) when writes are throttled.
+"""
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import boto3
+
+from scaling import METRICS_DELAY_MINUTES, MetricPoint, ScalingConfig, decide, fill_minutes
+
+LAST_SCALED_TAG = "shard-controller:last-scaled"
+
+kinesis = boto3.client("kinesis")
+cloudwatch = boto3.client("cloudwatch")
+
+
+def get_config():
+    return ScalingConfig(
+        min_shard_count = int(os.environ["MIN_SHARD_COUNT"]),
+        max_shard_count = int(os.environ["MAX_SHARD_COUNT"]),
+        target_utilization_percent = float(os.environ["TARGET_UTILIZATION_PERCENT"]),
+        scale_in_utilization_percent = float(os.environ["SCALE_IN_UTILIZATION_PERCENT"]),
+        scale_out_cooldown_seconds = int(os.environ["SCALE_OUT_COOLDOWN_SECONDS"]),
+        scale_in_cooldown_seconds = int(os.environ["SCALE_IN_COOLDOWN_SECONDS"])
+    )
+
+
+def get_metrics(stream_name, minutes):
+    """Returns per-minute MetricPoints covering at least the last `minutes` minutes whose metrics have arrived, oldest first."""
+    end = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    start = end - timedelta(minutes=minutes + METRICS_DELAY_MINUTES)
+    names = {
+        "incoming_bytes": "IncomingBytes",
+        "incoming_records": "IncomingRecords",
+        "throttled_records": "WriteProvisionedThroughputExceeded"
+    }
+    queries = [{
+        "Id": key,
+        "MetricStat": {
+            "Metric": {
+                "Namespace": "AWS/Kinesis",
+                "MetricName": metric_name,
+                "Dimensions": [{"Name": "StreamName", "Value": stream_name}]
+            },
+            "Period": 60,
+            "Stat": "Sum"
+        }
+    } for key, metric_name in names.items()]
+
+    points = {}
+    paginator = cloudwatch.get_paginator("get_metric_data")
+    for page in paginator.paginate(MetricDataQueries=queries, StartTime=start, EndTime=end):
+        for result in page["MetricDataResults"]:
+            for timestamp, value in zip(result["Timestamps"], result["Values"]):
+                setattr(points.setdefault(int(timestamp.timestamp()), MetricPoint()), result["Id"], value)
+    return fill_minutes(points, int(start.timestamp()), int(end.timestamp()))
+
+
+def get_last_scaled_at(stream_name):
+    tags = kinesis.list_tags_for_stream(StreamName=stream_name)["Tags"]
+    for tag in tags:
+        if tag["Key"] == LAST_SCALED_TAG:
+            return float(tag["Value"])
+    return None
+
+
+def handler(event, context):
+    stream_name = os.environ["STREAM_NAME"]
+    config = get_config()
+
+    summary = kinesis.describe_stream_summary(StreamName=stream_name)["StreamDescriptionSummary"]
+    if summary["StreamStatus"] != "ACTIVE":
+        print(json.dumps({"stream": stream_name, "action": "none", "reason": f"stream is {summary['StreamStatus']}"}))
+        return
+
+    current = summary["OpenShardCount"]
+    metrics = get_metrics(stream_name, config.scale_in_window_minutes)
+    now = time.time()
+    decision = decide(current, metrics, config, now, get_last_scaled_at(stream_name))
+
+    if decision.changed(current):
+        try:
+            kinesis.update_shard_count(
+                StreamName = stream_name,
+                TargetShardCount = decision.target_shard_count,
+                ScalingType = "UNIFORM_SCALING"
+            )
+        except (kinesis.exceptions.LimitExceededException, kinesis.exceptions.ResourceInUseException) as e:
+            # UpdateShardCount allows few calls a day, and none while the stream is already resharding;
+            # the next run tries again
+            print(json.dumps({
+                "stream": stream_name,
+                "action": "none",
+                "current_shard_count": current,
+                "target_shard_count": decision.target_shard_count,
+                "reason": f"{decision.reason}; reshard skipped: {e}"
+            }))
+            return
+        kinesis.add_tags_to_stream(StreamName=stream_name, Tags={LAST_SCALED_TAG: str(int(now))})
+
+    print(json.dumps({
+        "stream": stream_name,
+        "action": "reshard" if decision.changed(current) else "none",
+        "current_shard_count": current,
+        "target_shard_count": decision.target_shard_count,
+        "reason": decision.reason
+    }))
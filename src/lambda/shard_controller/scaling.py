@@ -0,0 +1,116 @@
+"""Shard scaling decisions for the Kinesis queue.
+
+This module has no AWS dependencies so the decision logic can be exercised against
+synthetic metric series; index.py gathers the metrics and applies the decision.
+"""
+import math
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+# Kinesis per-shard write limits
+SHARD_BYTES_PER_SECOND = 1024 * 1024
+SHARD_RECORDS_PER_SECOND = 1000
+# Kinesis metrics reach CloudWatch a minute or two late, so the last few minutes may have no datapoints yet
+METRICS_DELAY_MINUTES = 3
+
+
+@dataclass
+class ScalingConfig:
+    min_shard_count: int
+    max_shard_count: int
+    # Scale out when the busiest minute exceeds this, and size the stream to bring it back here
+    target_utilization_percent: float = 70
+    # Only scale in when every minute in the scale-in window is below this
+    scale_in_utilization_percent: float = 30
+    scale_out_cooldown_seconds: int = 300
+    scale_in_cooldown_seconds: int = 3600
+    # Minutes of metrics considered for each direction; scale in looks further back so it doesn't flap
+    scale_out_window_minutes: int = 5
+    scale_in_window_minutes: int = 30
+
+
+@dataclass
+class MetricPoint:
+    """Sums for one minute of stream metrics."""
+    incoming_bytes: float = 0
+    incoming_records: float = 0
+    throttled_records: float = 0
+
+
+@dataclass
+class Decision:
+    target_shard_count: int
+    reason: str
+
+    def changed(self, current_shard_count: int) -> bool:
+        return self.target_shard_count != current_shard_count
+
+
+def utilization(point: MetricPoint, shard_count: int) -> float:
+    """Percentage of the stream's write capacity used, by whichever of bytes or records is closer to its limit."""
+    bytes_pct = point.incoming_bytes / 60 / (shard_count * SHARD_BYTES_PER_SECOND) * 100
+    records_pct = point.incoming_records / 60 / (shard_count * SHARD_RECORDS_PER_SECOND) * 100
+    return max(bytes_pct, records_pct)
+
+
+def fill_minutes(points: Dict[int, MetricPoint], start: int, end: int) -> List[MetricPoint]:
+    """A per-minute series from `start` up to `end` (epoch seconds on minute boundaries), oldest first.
+
+    Kinesis writes no datapoints for a minute without writes, so minutes missing from `points` are zero.
+    The series stops METRICS_DELAY_MINUTES before `end`, or after the latest point if that's later, so
+    minutes whose metrics haven't arrived yet aren't taken for quiet ones.
+    """
+    end = max(end - METRICS_DELAY_MINUTES * 60, max(points, default=start) + 60)
+    return [points.get(minute, MetricPoint()) for minute in range(start, end, 60)]
+
+
+def clamp(target: int, current: int, config: ScalingConfig) -> int:
+    """Brings target into the configured range, then as close to it as one reshard can get from current."""
+    target = max(config.min_shard_count, min(config.max_shard_count, target))
+    # UpdateShardCount can at most double or halve the shard count in one call, so a stream far
+    # outside the range steps towards it over several calls
+    return max(math.ceil(current / 2), min(current * 2, target))
+
+
+def decide(current: int, metrics: List[MetricPoint], config: ScalingConfig,
+           now: float, last_scaled_at: Optional[float] = None) -> Decision:
+    """Returns the shard count the stream should have.
+
+    `metrics` is a per-minute series, oldest first, ending at `now` (epoch seconds).
+    `last_scaled_at` is when the stream was last resharded, if known.
+    """
+    if current < config.min_shard_count or current > config.max_shard_count:
+        return Decision(clamp(current, current, config), "shard count outside configured range")
+    if not metrics:
+        return Decision(current, "no metrics")
+
+    since_scaled = now - last_scaled_at if last_scaled_at is not None else math.inf
+
+    recent = metrics[-config.scale_out_window_minutes:]
+    peak = max(utilization(p, current) for p in recent)
+    throttled = sum(p.throttled_records for p in recent)
+
+    if peak > config.target_utilization_percent or throttled > 0:
+        if since_scaled < config.scale_out_cooldown_seconds:
+            return Decision(current, "scale out cooldown")
+        target = math.ceil(current * peak / config.target_utilization_percent)
+        if throttled > 0:
+            # Throttled writes mean the metrics understate demand, so add headroom beyond what was accepted
+            target = max(target, math.ceil(current * 1.5))
+        target = clamp(target, current, config)
+        if target > current:
+            return Decision(target, f"peak utilisation {peak:.0f}%, {throttled:.0f} throttled records")
+        return Decision(current, "at max_shard_count")
+
+    window = metrics[-config.scale_in_window_minutes:]
+    if len(window) < config.scale_in_window_minutes:
+        return Decision(current, "not enough history to scale in")
+    peak = max(utilization(p, current) for p in window)
+    if peak < config.scale_in_utilization_percent and current > config.min_shard_count:
+        if since_scaled < config.scale_in_cooldown_seconds:
+            return Decision(current, "scale in cooldown")
+        target = clamp(max(1, math.ceil(current * peak / config.target_utilization_percent)), current, config)
+        if target < current:
+            return Decision(target, f"peak utilisation {peak:.0f}% over {len(window)} minutes")
+
+    return Decision(current, "within target")
@@ -0,0 +1,123 @@
+"""Publishes how unevenly writes are spread over the Kinesis queue's shards.
+
+Invoked on a schedule. Reads each open shard's IncomingBytes shard-level metric and prints
+CloudWatch Embedded Metric Format (EMF) documents, which CloudWatch extracts from the log group:
+ShardSkew, MaxShardUtilization and HotShards for the stream, and ShardSkew and ShardUtilization
+for each shard.
+"""
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import boto3
+
+from skew import SkewConfig, measure
+
+kinesis = boto3.client("kinesis")
+cloudwatch = boto3.client("cloudwatch")
+
+
+def get_config():
+    return SkewConfig(
+        skew_threshold = float(os.environ["SKEW_THRESHOLD"]),
+        min_utilization_percent = float(os.environ["MIN_UTILIZATION_PERCENT"])
+    )
+
+
+def enable_shard_metrics(stream_name, summary):
+    """Turns on the IncomingBytes shard-level metric; returns False when it wasn't already on."""
+    enabled = [m for e in summary.get("EnhancedMonitoring", []) for m in e.get("ShardLevelMetrics", [])]
+    if "IncomingBytes" in enabled or "ALL" in enabled:
+        return True
+    kinesis.enable_enhanced_monitoring(StreamName=stream_name, ShardLevelMetrics=["IncomingBytes"])
+    return False
+
+
+def get_open_shards(stream_name):
+    shards = []
+    kwargs = {"StreamName": stream_name}
+    while True:
+        page = kinesis.list_shards(**kwargs)
+        shards += [s["ShardId"] for s in page["Shards"] if "EndingSequenceNumber" not in s["SequenceNumberRange"]]
+        if not page.get("NextToken"):
+            return shards
+        kwargs = {"NextToken": page["NextToken"]}
+
+
+def get_shard_bytes(stream_name, shard_ids, minutes):
+    """Returns each shard's incoming bytes per second over the last `minutes` minutes."""
+    end = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    start = end - timedelta(minutes=minutes)
+    rates = {shard_id: 0.0 for shard_id in shard_ids}
+    # GetMetricData takes at most 500 queries per call
+    for offset in range(0, len(shard_ids), 500):
+        batch = shard_ids[offset:offset + 500]
+        queries = [{
+            "Id": f"s{offset + i}",
+            "MetricStat": {
+                "Metric": {
+                    "Namespace": "AWS/Kinesis",
+                    "MetricName": "IncomingBytes",
+                    "Dimensions": [
+                        {"Name": "StreamName", "Value": stream_name},
+                        {"Name": "ShardId", "Value": shard_id}
+                    ]
+                },
+                "Period": minutes * 60,
+                "Stat": "Sum"
+            }
+        } for i, shard_id in enumerate(batch)]
+        paginator = cloudwatch.get_paginator("get_metric_data")
+        for page in paginator.paginate(MetricDataQueries=queries, StartTime=start, EndTime=end):
+            for result in page["MetricDataResults"]:
+                shard_id = shard_ids[int(result["Id"][1:])]
+                rates[shard_id] += sum(result["Values"]) / (minutes * 60)
+    return rates
+
+
+def emf(namespace, dimensions, values, units):
+    return json.dumps({
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": namespace,
+                "Dimensions": [list(dimensions)],
+                "Metrics": [{"Name": name, "Unit": units[name]} for name in values]
+            }]
+        },
+        **dimensions,
+        **values
+    })
+
+
+def handler(event, context):
+    stream_name = os.environ["STREAM_NAME"]
+    namespace = os.environ["METRICS_NAMESPACE"]
+    minutes = int(os.environ["PERIOD_MINUTES"])
+
+    summary = kinesis.describe_stream_summary(StreamName=stream_name)["StreamDescriptionSummary"]
+    if not enable_shard_metrics(stream_name, summary):
+        print(json.dumps({"stream": stream_name, "action": "enabled IncomingBytes shard-level metrics"}))
+        return
+
+    report = measure(get_shard_bytes(stream_name, get_open_shards(stream_name), minutes), get_config())
+    if not report.shards:
+        return
+
+    print(emf(namespace, {"StreamName": stream_name}, {
+        "ShardSkew": round(report.skew, 3),
+        "MaxShardUtilization": round(report.max_utilization_percent, 2),
+        "HotShards": len(report.hot_shards)
+    }, {"ShardSkew": "None", "MaxShardUtilization": "Percent", "HotShards": "Count"}))
+    for shard in report.shards:
+        print(emf(namespace, {"StreamName": stream_name, "ShardId": shard.shard_id}, {
+            "ShardSkew": round(shard.skew, 3),
+            "ShardUtilization": round(shard.utilization_percent, 2)
+        }, {"ShardSkew": "None", "ShardUtilization": "Percent"}))
+
+    print(json.dumps({
+        "stream": stream_name,
+        "skew": round(report.skew, 3),
+        "hot_shards": [s.shard_id for s in report.hot_shards]
+    }))
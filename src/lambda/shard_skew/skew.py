@@ -0,0 +1,73 @@
+"""Measures how unevenly writes are spread over the Kinesis queue's shards.
+
+This module has no AWS dependencies, so src/benchmark/partition_skew.py reports simulated
+partitioning strategies the same way; index.py gathers the per-shard metrics and publishes the report.
+"""
+import hashlib
+from dataclasses import dataclass
+from typing import Dict, List
+
+# Kinesis per-shard write limit
+SHARD_BYTES_PER_SECOND = 1024 * 1024
+# Partition keys are MD5 hashed into a 128 bit hash key space, which the shards divide between them
+HASH_KEY_SPACE = 2 ** 128
+
+
+@dataclass
+class SkewConfig:
+    # A shard is hot when it takes this many times the mean shard's bytes...
+    skew_threshold: float = 2.0
+    # ...and uses at least this % of its write limit, so a quiet stream isn't reported
+    min_utilization_percent: float = 25
+
+
+@dataclass
+class ShardLoad:
+    shard_id: str
+    bytes_per_second: float
+    # Bytes relative to the mean shard; 1.0 is an even share
+    skew: float
+    utilization_percent: float
+    hot: bool
+
+
+@dataclass
+class SkewReport:
+    shards: List[ShardLoad]
+
+    @property
+    def skew(self) -> float:
+        return max((s.skew for s in self.shards), default=0.0)
+
+    @property
+    def max_utilization_percent(self) -> float:
+        return max((s.utilization_percent for s in self.shards), default=0.0)
+
+    @property
+    def hot_shards(self) -> List[ShardLoad]:
+        return [s for s in self.shards if s.hot]
+
+
+def measure(bytes_per_second_by_shard: Dict[str, float], config: SkewConfig) -> SkewReport:
+    """Returns each shard's share of the writes, from its incoming bytes per second."""
+    if not bytes_per_second_by_shard:
+        return SkewReport([])
+    mean = sum(bytes_per_second_by_shard.values()) / len(bytes_per_second_by_shard)
+    shards = []
+    for shard_id, rate in sorted(bytes_per_second_by_shard.items()):
+        skew = rate / mean if mean > 0 else 0.0
+        utilization = rate / SHARD_BYTES_PER_SECOND * 100
+        shards.append(ShardLoad(
+            shard_id = shard_id,
+            bytes_per_second = rate,
+            skew = skew,
+            utilization_percent = utilization,
+            hot = skew >= config.skew_threshold and utilization >= config.min_utilization_percent
+        ))
+    return SkewReport(shards)
+
+
+def shard_for_key(partition_key: str, shard_count: int) -> int:
+    """The shard a partition key is written to when the hash key space is split evenly, as UNIFORM_SCALING leaves it."""
+    hash_key = int(hashlib.md5(partition_key.encode("utf-8")).hexdigest(), 16)
+    return hash_key * shard_count // HASH_KEY_SPACE
@@ -0,0 +1,103 @@
+"""Tests for the shard controller's scaling decisions (src/lambda/shard_controller/scaling.py).
+
+Run from src/lambda with `python3 -m pytest tests`.
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "shard_controller"))
+
+from scaling import METRICS_DELAY_MINUTES, MetricPoint, ScalingConfig, clamp, decide, fill_minutes  # noqa: E402
+
+NOW = 1_000_000
+
+
+def minutes(count: int, utilization_percent: float, shards: int):
+    """A flat series of `count` minutes at `utilization_percent` of `shards` shards' byte limit."""
+    incoming = shards * 1024 * 1024 * 60 * utilization_percent / 100
+    return [MetricPoint(incoming_bytes = incoming) for _ in range(count)]
+
+
+class ClampTest(unittest.TestCase):
+
+    def test_below_min_steps_up_by_doubling(self):
+        config = ScalingConfig(min_shard_count = 4, max_shard_count = 16)
+        self.assertEqual(clamp(1, 1, config), 2)
+        self.assertEqual(clamp(2, 2, config), 4)
+
+    def test_above_max_steps_down_by_halving(self):
+        config = ScalingConfig(min_shard_count = 1, max_shard_count = 4)
+        self.assertEqual(clamp(20, 20, config), 10)
+        self.assertEqual(clamp(10, 10, config), 5)
+        self.assertEqual(clamp(5, 5, config), 4)
+
+    def test_within_range_is_bounded_by_one_reshard(self):
+        config = ScalingConfig(min_shard_count = 1, max_shard_count = 64)
+        self.assertEqual(clamp(40, 4, config), 8)
+        self.assertEqual(clamp(1, 8, config), 4)
+        self.assertEqual(clamp(6, 4, config), 6)
+
+    def test_scale_out_stops_at_max(self):
+        config = ScalingConfig(min_shard_count = 1, max_shard_count = 6)
+        self.assertEqual(clamp(12, 4, config), 6)
+
+
+class FillMinutesTest(unittest.TestCase):
+
+    START = 600_000
+
+    def test_missing_minutes_are_zero(self):
+        points = {self.START: MetricPoint(incoming_bytes = 5), self.START + 120: MetricPoint(incoming_bytes = 7)}
+        series = fill_minutes(points, self.START, self.START + 600)
+        self.assertEqual([p.incoming_bytes for p in series], [5, 0, 7, 0, 0, 0, 0])
+
+    def test_recent_datapoints_are_kept(self):
+        points = {self.START + 540: MetricPoint(incoming_bytes = 9)}
+        series = fill_minutes(points, self.START, self.START + 600)
+        self.assertEqual(len(series), 10)
+        self.assertEqual(series[-1].incoming_bytes, 9)
+
+    def test_gappy_lagging_series_scales_in(self):
+        # Datapoints for 1 minute in 3, none for the last 2: a quiet stream whose metrics are late
+        window = ScalingConfig(min_shard_count = 1, max_shard_count = 8).scale_in_window_minutes
+        end = self.START + (window + METRICS_DELAY_MINUTES) * 60
+        incoming = 8 * 1024 * 1024 * 60 * 5 / 100
+        points = {minute: MetricPoint(incoming_bytes = incoming) for minute in range(self.START, end - 120, 180)}
+        series = fill_minutes(points, self.START, end)
+        self.assertGreaterEqual(len(series), window)
+        decision = decide(8, series, ScalingConfig(min_shard_count = 1, max_shard_count = 8), NOW)
+        self.assertEqual(decision.target_shard_count, 4)
+
+    def test_idle_stream_scales_in(self):
+        config = ScalingConfig(min_shard_count = 1, max_shard_count = 8)
+        end = self.START + (config.scale_in_window_minutes + METRICS_DELAY_MINUTES) * 60
+        decision = decide(8, fill_minutes({}, self.START, end), config, NOW)
+        self.assertEqual(decision.target_shard_count, 4)
+
+
+class DecideTest(unittest.TestCase):
+
+    def test_below_min_moves_towards_range_without_exceeding_double(self):
+        config = ScalingConfig(min_shard_count = 4, max_shard_count = 8)
+        decision = decide(1, [], config, NOW)
+        self.assertEqual(decision.target_shard_count, 2)
+        self.assertEqual(decision.reason, "shard count outside configured range")
+
+    def test_above_max_moves_towards_range_without_going_below_half(self):
+        config = ScalingConfig(min_shard_count = 1, max_shard_count = 2)
+        self.assertEqual(decide(16, [], config, NOW).target_shard_count, 8)
+
+    def test_scale_out_on_high_utilisation(self):
+        config = ScalingConfig(min_shard_count = 1, max_shard_count = 8)
+        decision = decide(2, minutes(5, 140, 2), config, NOW)
+        self.assertEqual(decision.target_shard_count, 4)
+
+    def test_scale_in_after_quiet_window(self):
+        config = ScalingConfig(min_shard_count = 1, max_shard_count = 8)
+        decision = decide(8, minutes(30, 5, 8), config, NOW)
+        self.assertEqual(decision.target_shard_count, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()